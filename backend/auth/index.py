@@ -1,19 +1,358 @@
 import json
 import os
+import time
+import threading
+import bisect
+import functools
+import random
 import hashlib
 import secrets
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
 
-def escape_sql_string(s: str) -> str:
-    """Экранирует строки для безопасного использования в SQL"""
-    return s.replace("'", "''")
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
 
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            # Ожидание long-poll (фаза wait) не делает запрос медленным
+            if total_ms - timing.phases.get('wait', 0.0) >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> Tuple[Any, Dict[str, Any]]:
+    """Берёт тёплое соединение из пула контейнера или открывает новое"""
+    started = time.perf_counter()
+    while True:
+        with _db_pool_lock:
+            item = _db_pool.pop() if _db_pool else None
+        if item is None:
+            break
+        conn, released_at = item
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SEC:
+            try:
+                with conn.cursor() as check_cur:
+                    check_cur.execute('SELECT 1')
+            except psycopg2.Error:
+                conn.close()
+                continue
+        record_timing('db_connect', started)
+        return conn, {'reused': True, 'connect_ms': (time.perf_counter() - started) * 1000}
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=PooledConnection)
+    conn.autocommit = True
+    record_timing('db_connect', started)
+    return conn, {'reused': False, 'connect_ms': (time.perf_counter() - started) * 1000}
+
+def release_db_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def statement_metric(query: Any) -> str:
+    """Имя метрики для запроса: q_<имя> для EXECUTE подготовленного запроса"""
+    head = (query[:80].decode('utf-8', errors='replace') if isinstance(query, bytes) else query[:80]).split()
+    if head[:1] == ['EXECUTE']:
+        return f'q_{head[1]}'
+    if head[:1] == ['PREPARE']:
+        return 'db_prepare'
+    return 'db_sql'
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, который записывает время запросов и разбора строк в фазы текущего запроса"""
+    def execute(self, query: Any, vars: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            record_timing(statement_metric(query), started)
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_timing('db_decode', started)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_timing('db_decode', started)
+        return rows
+
+    def fetchall(self) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_timing('db_decode', started)
+        return rows
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит подготовленные на нём запросы"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.cursor_factory = TimedCursor
+
+_stmt_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из PREPARED_STATEMENTS; PREPARE делается один раз на соединение"""
+    conn = cur.connection
+    if name in conn.prepared:
+        _stmt_stats['hits'] += 1
+    else:
+        cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+        _stmt_stats['misses'] += 1
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def note_db_timing(db_timing: Dict[str, Any]) -> None:
+    """Добавляет в лог запроса сведения о соединении и кэше подготовленных запросов"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields.update({
+            'db_reused': db_timing['reused'],
+            'stmt_cache_hits': _stmt_stats['hits'],
+            'stmt_cache_misses': _stmt_stats['misses']
+        })
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '60'))
+
+_session_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def get_auth_token(event: Dict[str, Any]) -> Optional[str]:
+    """Достаёт X-Auth-Token из заголовков запроса"""
+    headers = event.get('headers') or {}
+    return headers.get('X-Auth-Token') or headers.get('x-auth-token')
+
+def verify_auth_token(cur: Any, token: str) -> Optional[int]:
+    """
+    Возвращает user_id сессии или None. Проверенные токены живут в LRU-кэше
+    контейнера не дольше SESSION_CACHE_TTL_SEC — это и есть окно отзыва.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > now:
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+    
+    execute_prepared(cur, 'verify_session', (token_hash,))
+    row = cur.fetchone()
+    
+    with _session_cache_lock:
+        if not row:
+            _session_cache.pop(token_hash, None)
+            return None
+        _session_cache[token_hash] = (row[0], now + min(SESSION_CACHE_TTL_SEC, float(row[1])))
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return row[0]
+
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'verify_session': """
+        SELECT user_id, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP))
+        FROM t_p37705306_strim_boom_project.sessions
+        WHERE token_hash = $1 AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'session_create': """
+        INSERT INTO t_p37705306_strim_boom_project.sessions (token_hash, user_id, expires_at)
+        VALUES ($1, $2, CURRENT_TIMESTAMP + make_interval(days => $3))
+    """,
+    'session_revoke': """
+        UPDATE t_p37705306_strim_boom_project.sessions
+        SET revoked_at = CURRENT_TIMESTAMP
+        WHERE token_hash = $1 AND revoked_at IS NULL
+    """,
+    'user_by_email': """
+        SELECT id FROM t_p37705306_strim_boom_project.users WHERE email = $1
+    """,
+    # Смена пароля и отзыв всех прежних сессий пользователя одним запросом (одна транзакция);
+    # последней колонкой возвращаются хеши отозванных токенов для сброса кэша контейнера
+    'user_reregister': """
+        WITH updated AS (
+            UPDATE t_p37705306_strim_boom_project.users 
+            SET username = $1, password_hash = $2, avatar = $3 
+            WHERE email = $4 
+            RETURNING id, username, email, avatar, boombucks
+        ), revoked AS (
+            UPDATE t_p37705306_strim_boom_project.sessions
+            SET revoked_at = CURRENT_TIMESTAMP
+            WHERE user_id IN (SELECT id FROM updated) AND revoked_at IS NULL
+            RETURNING token_hash
+        )
+        SELECT id, username, email, avatar, boombucks, ARRAY(SELECT token_hash FROM revoked)
+        FROM updated
+    """,
+    'user_register': """
+        INSERT INTO t_p37705306_strim_boom_project.users (username, email, password_hash, avatar, boombucks) 
+        VALUES ($1, $2, $3, $4, 0) 
+        RETURNING id, username, email, avatar, boombucks
+    """,
+    # Пустой параметр оставляет поле как есть: $1 username, $2 avatar, $3 email
+    'user_update_profile': """
+        UPDATE t_p37705306_strim_boom_project.users 
+        SET username = COALESCE($1, username), avatar = COALESCE($2, avatar) 
+        WHERE email = $3 
+        RETURNING id, username, email, avatar, boombucks
+    """,
+    'user_login': """
+        SELECT id, username, email, avatar, boombucks 
+        FROM t_p37705306_strim_boom_project.users 
+        WHERE email = $1 AND password_hash = $2
+    """
+}
+
+SESSION_LIFETIME_DAYS = int(os.environ.get('SESSION_LIFETIME_DAYS', '30'))
+
+def create_session(cur: Any, user_id: int) -> str:
+    """Выпускает токен и сохраняет его хеш в таблицу sessions"""
+    token = secrets.token_urlsafe(32)
+    execute_prepared(cur, 'session_create', (hashlib.sha256(token.encode()).hexdigest(), user_id, SESSION_LIFETIME_DAYS))
+    return token
+
+def forget_sessions(token_hashes: List[str]) -> None:
+    """Убирает отозванные сессии из кэша; остальные контейнеры увидят отзыв в пределах SESSION_CACHE_TTL_SEC"""
+    with _session_cache_lock:
+        for token_hash in token_hashes:
+            _session_cache.pop(token_hash, None)
+
+def revoke_session(cur: Any, token: str) -> None:
+    """Отзывает сессию"""
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    execute_prepared(cur, 'session_revoke', (token_hash,))
+    forget_sessions([token_hash])
+
+@instrument_handler('auth')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Регистрация и авторизация пользователей
-    Args: event с httpMethod, body (email, password, username)
+    Args: event с httpMethod, body (action: register/login/update_profile/verify/logout, email, password, username)
     Returns: HTTP response с токеном или ошибкой
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -42,11 +381,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     body_data = json.loads(event.get('body', '{}'))
     action = body_data.get('action')
     
-    database_url = os.environ.get('DATABASE_URL')
-    
     try:
-        conn = psycopg2.connect(database_url)
-        conn.autocommit = True
+        conn, db_timing = get_db_connection()
         cur = conn.cursor()
         
         if action == 'register':
@@ -62,30 +398,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            username = escape_sql_string(username)
-            email = escape_sql_string(email)
             password_hash = hashlib.sha256(password.encode()).hexdigest()
-            avatar = f'https://api.dicebear.com/7.x/avataaars/svg?seed={escape_sql_string(username)}'
+            avatar = f'https://api.dicebear.com/7.x/avataaars/svg?seed={username}'
             
-            cur.execute(f"SELECT id FROM t_p37705306_strim_boom_project.users WHERE email = '{email}'")
+            execute_prepared(cur, 'user_by_email', (email,))
             existing_user = cur.fetchone()
             
             if existing_user:
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.users 
-                    SET username = '{username}', password_hash = '{password_hash}', avatar = '{avatar}' 
-                    WHERE email = '{email}' 
-                    RETURNING id, username, email, avatar, boombucks
-                """)
+                # Старые токены после смены пароля больше не действуют
+                execute_prepared(cur, 'user_reregister', (username, password_hash, avatar, email))
+                user = cur.fetchone()
+                forget_sessions(user[5])
             else:
-                cur.execute(f"""
-                    INSERT INTO t_p37705306_strim_boom_project.users (username, email, password_hash, avatar, boombucks) 
-                    VALUES ('{username}', '{email}', '{password_hash}', '{avatar}', 0) 
-                    RETURNING id, username, email, avatar, boombucks
-                """)
-            user = cur.fetchone()
+                execute_prepared(cur, 'user_register', (username, email, password_hash, avatar))
+                user = cur.fetchone()
             
-            token = secrets.token_urlsafe(32)
+            token = create_session(cur, user[0])
             
             return {
                 'statusCode': 200,
@@ -115,14 +443,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            email = escape_sql_string(email)
             password_hash = hashlib.sha256(password.encode()).hexdigest()
             
-            cur.execute(f"""
-                SELECT id, username, email, avatar, boombucks 
-                FROM t_p37705306_strim_boom_project.users 
-                WHERE email = '{email}' AND password_hash = '{password_hash}'
-            """)
+            execute_prepared(cur, 'user_login', (email, password_hash))
             user = cur.fetchone()
             
             if not user:
@@ -133,7 +456,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            token = secrets.token_urlsafe(32)
+            token = create_session(cur, user[0])
             
             return {
                 'statusCode': 200,
@@ -164,18 +487,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            email = escape_sql_string(email)
-            update_fields = []
-            
-            if username:
-                username = escape_sql_string(username)
-                update_fields.append(f"username = '{username}'")
-            
-            if avatar:
-                avatar = escape_sql_string(avatar)
-                update_fields.append(f"avatar = '{avatar}'")
-            
-            if not update_fields:
+            if not username and not avatar:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -183,12 +495,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                UPDATE t_p37705306_strim_boom_project.users 
-                SET {', '.join(update_fields)} 
-                WHERE email = '{email}' 
-                RETURNING id, username, email, avatar, boombucks
-            """)
+            execute_prepared(cur, 'user_update_profile', (username or None, avatar or None, email))
             user = cur.fetchone()
             
             if not user:
@@ -214,6 +521,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
+        elif action == 'verify':
+            auth_token = get_auth_token(event) or body_data.get('token')
+            user_id = verify_auth_token(cur, auth_token) if auth_token else None
+            
+            if user_id is None:
+                return {
+                    'statusCode': 401,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid or expired token'}),
+                    'isBase64Encoded': False
+                }
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'userId': user_id}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'logout':
+            auth_token = get_auth_token(event) or body_data.get('token')
+            
+            if not auth_token:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Token required'}),
+                    'isBase64Encoded': False
+                }
+            
+            revoke_session(cur, auth_token)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True}),
+                'isBase64Encoded': False
+            }
+        
         else:
             return {
                 'statusCode': 400,
@@ -233,4 +579,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+            note_db_timing(db_timing)
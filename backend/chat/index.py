@@ -1,17 +1,1004 @@
 import json
+import hashlib
 import os
-from typing import Dict, Any
+import time
+import select
+import threading
+import bisect
+import functools
+import random
+import base64
+import gzip
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
 
-def escape_sql_string(s: str) -> str:
-    """Экранирует строки для безопасного использования в SQL"""
-    return s.replace("'", "''")
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            # Ожидание long-poll (фаза wait) не делает запрос медленным
+            if total_ms - timing.phases.get('wait', 0.0) >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', '16'))
+
+_compressed_cache: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+class CachedBody(str):
+    """Тело ответа из кэша контейнера: его сжатые формы тоже кэшируются"""
+
+def accepted_encoding(event: Dict[str, Any]) -> Optional[str]:
+    """Лучшее поддерживаемое кодирование из Accept-Encoding (br, затем gzip); q=0 запрещает"""
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    weights: Dict[str, float] = {}
+    for part in headers.get('accept-encoding', '').split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        if params.strip().startswith('q='):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best = max(supported, key=lambda name: weights.get(name, weights.get('*', 0.0)))
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+def compress_body(body: str, encoding: str) -> str:
+    """Сжатое тело в base64 для шлюза"""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    return base64.b64encode(compressed).decode('ascii')
+
+def compress_response(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+    """
+    Сжимает тело ответа длиннее COMPRESS_MIN_BYTES по Accept-Encoding клиента и отдаёт
+    его шлюзу в base64. Сжатые формы CachedBody кэшируются, остальные сжимаются заново.
+    """
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = handler(event, context)
+        body = response.get('body')
+        if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES:
+            return response
+        headers = dict(response.get('headers') or {})
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = accepted_encoding(event)
+        if encoding is None:
+            return {**response, 'headers': headers}
+        
+        started = time.perf_counter()
+        key = (encoding, body)
+        encoded = None
+        if isinstance(body, CachedBody):
+            with _compressed_cache_lock:
+                encoded = _compressed_cache.get(key)
+                if encoded is not None:
+                    _compressed_cache.move_to_end(key)
+        if encoded is None:
+            encoded = compress_body(body, encoding)
+            if isinstance(body, CachedBody):
+                with _compressed_cache_lock:
+                    _compressed_cache[key] = encoded
+                    while len(_compressed_cache) > COMPRESS_CACHE_SIZE:
+                        _compressed_cache.popitem(last=False)
+        record_timing('compress', started)
+        
+        headers['Content-Encoding'] = encoding
+        return {**response, 'headers': headers, 'body': encoded, 'isBase64Encoded': True}
+    return wrapper
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> Tuple[Any, Dict[str, Any]]:
+    """Берёт тёплое соединение из пула контейнера или открывает новое"""
+    started = time.perf_counter()
+    while True:
+        with _db_pool_lock:
+            item = _db_pool.pop() if _db_pool else None
+        if item is None:
+            break
+        conn, released_at = item
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SEC:
+            try:
+                with conn.cursor() as check_cur:
+                    check_cur.execute('SELECT 1')
+            except psycopg2.Error:
+                conn.close()
+                continue
+        record_timing('db_connect', started)
+        return conn, {'reused': True, 'connect_ms': (time.perf_counter() - started) * 1000}
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=PooledConnection)
+    conn.autocommit = True
+    record_timing('db_connect', started)
+    return conn, {'reused': False, 'connect_ms': (time.perf_counter() - started) * 1000}
+
+def release_db_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def statement_metric(query: Any) -> str:
+    """Имя метрики для запроса: q_<имя> для EXECUTE подготовленного запроса"""
+    head = (query[:80].decode('utf-8', errors='replace') if isinstance(query, bytes) else query[:80]).split()
+    if head[:1] == ['EXECUTE']:
+        return f'q_{head[1]}'
+    if head[:1] == ['PREPARE']:
+        return 'db_prepare'
+    return 'db_sql'
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, который записывает время запросов и разбора строк в фазы текущего запроса"""
+    def execute(self, query: Any, vars: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            record_timing(statement_metric(query), started)
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_timing('db_decode', started)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_timing('db_decode', started)
+        return rows
+
+    def fetchall(self) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_timing('db_decode', started)
+        return rows
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит подготовленные на нём запросы"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.cursor_factory = TimedCursor
+
+_stmt_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из PREPARED_STATEMENTS; PREPARE делается один раз на соединение"""
+    conn = cur.connection
+    if name in conn.prepared:
+        _stmt_stats['hits'] += 1
+    else:
+        cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+        _stmt_stats['misses'] += 1
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def note_db_timing(db_timing: Dict[str, Any]) -> None:
+    """Добавляет в лог запроса сведения о соединении и кэше подготовленных запросов"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields.update({
+            'db_reused': db_timing['reused'],
+            'stmt_cache_hits': _stmt_stats['hits'],
+            'stmt_cache_misses': _stmt_stats['misses']
+        })
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '60'))
+
+_session_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def get_auth_token(event: Dict[str, Any]) -> Optional[str]:
+    """Достаёт X-Auth-Token из заголовков запроса"""
+    headers = event.get('headers') or {}
+    return headers.get('X-Auth-Token') or headers.get('x-auth-token')
+
+def verify_auth_token(cur: Any, token: str) -> Optional[int]:
+    """
+    Возвращает user_id сессии или None. Проверенные токены живут в LRU-кэше
+    контейнера не дольше SESSION_CACHE_TTL_SEC — это и есть окно отзыва.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > now:
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+    
+    execute_prepared(cur, 'verify_session', (token_hash,))
+    row = cur.fetchone()
+    
+    with _session_cache_lock:
+        if not row:
+            _session_cache.pop(token_hash, None)
+            return None
+        _session_cache[token_hash] = (row[0], now + min(SESSION_CACHE_TTL_SEC, float(row[1])))
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return row[0]
+
+_escape_json_string = json.encoder.encode_basestring_ascii
+
+class RawJson(str):
+    """Уже закодированный JSON-фрагмент: dumps_body вставляет его как есть"""
+
+def dumps_json(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def dumps_body(fields: Dict[str, Any]) -> str:
+    """Собирает JSON-объект ответа без повторного кодирования RawJson-значений"""
+    started = time.perf_counter()
+    body = '{' + ','.join(
+        f'{_escape_json_string(key)}:{value if isinstance(value, RawJson) else dumps_json(value)}'
+        for key, value in fields.items()
+    ) + '}'
+    record_timing('serialize', started)
+    return body
+
+# Выражения для значения колонки r[i]: для json.dumps-совместимого текста и для orjson
+_JSON_COLUMN_TEXT = {
+    'int': "('null' if r[{i}] is None else str(r[{i}]))",
+    'bool': "('null' if r[{i}] is None else 'true' if r[{i}] else 'false')",
+    'id': "('null' if r[{i}] is None else '\"' + str(r[{i}]) + '\"')",
+    'str': "('null' if r[{i}] is None else esc(r[{i}]))",
+    'ts': "('null' if r[{i}] is None else '\"' + r[{i}].isoformat() + '\"')",
+    'json': "dumps(r[{i}])"
+}
+_JSON_COLUMN_VALUE = {
+    'int': "r[{i}]",
+    'bool': "r[{i}]",
+    'id': "(None if r[{i}] is None else str(r[{i}]))",
+    'str': "r[{i}]",
+    'ts': "r[{i}]",
+    'json': "r[{i}]"
+}
+
+class RowEncoder:
+    """
+    Кодирует строки результата в JSON-массив объектов по схеме колонок (ключ, тип):
+    int, bool, id (число строкой), str, ts (datetime в ISO 8601), json (любое значение);
+    колонка с ключом None пропускается. Выражение для строки собирается один раз,
+    без промежуточных словарей; с orjson словари строятся, но кодирует их orjson.
+    """
+    def __init__(self, *columns: Tuple[Optional[str], str]) -> None:
+        self.columns = columns
+        self.backend = orjson
+        fields = [(i, key, kind) for i, (key, kind) in enumerate(columns) if key is not None]
+        if orjson is not None:
+            source = 'lambda r: {' + ', '.join(
+                f'{key!r}: {_JSON_COLUMN_VALUE[kind].format(i=i)}' for i, key, kind in fields
+            ) + '}'
+        else:
+            source = "lambda r: '{' + " + " + ',' + ".join(
+                f'{_escape_json_string(key) + ":"!r} + {_JSON_COLUMN_TEXT[kind].format(i=i)}' for i, key, kind in fields
+            ) + " + '}'"
+        self.encode_row: Callable[[Tuple], Any] = eval(source, {'esc': _escape_json_string, 'dumps': dumps_json})
+
+    def encode(self, rows: List[Tuple]) -> RawJson:
+        started = time.perf_counter()
+        if self.backend is not None:
+            encoded = RawJson(self.backend.dumps(list(map(self.encode_row, rows))).decode())
+        else:
+            encoded = RawJson('[' + ','.join(map(self.encode_row, rows)) + ']')
+        record_timing('serialize', started)
+        return encoded
+
+# Условные GET: ETag строится из дешёвого токена версии, совпадение отдаёт 304 без основного запроса
+_etag_stats: Dict[str, List[int]] = {}
+_etag_stats_lock = threading.Lock()
+
+def make_etag(*parts: Any) -> str:
+    """Слабый ETag: тело может уйти в разных Content-Encoding, а версия у них одна"""
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    return etag.removeprefix('W/') in [tag.strip().removeprefix('W/') for tag in headers.get('if-none-match', '').split(',')]
+
+def conditional_response(event: Dict[str, Any], route: str, etag: Optional[str]) -> Optional[Dict[str, Any]]:
+    """304, если If-None-Match содержит etag; иначе None. Попадания считаются по маршруту"""
+    if etag is None:
+        return None
+    hit = etag_matches(event, etag)
+    with _etag_stats_lock:
+        stats = _etag_stats.setdefault(route, [0, 0])
+        stats[0] += 1
+        stats[1] += hit
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields['etag'] = 'hit' if hit else 'miss'
+    if not hit:
+        return None
+    return {
+        'statusCode': 304,
+        'headers': {'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def with_etag(response: Dict[str, Any], etag: Optional[str]) -> Dict[str, Any]:
+    """Добавляет ETag к ответу 200; no-cache заставляет браузер перепроверять версию на каждом опросе"""
+    if etag is not None:
+        response['headers'] = {**response['headers'], 'ETag': etag, 'Cache-Control': 'no-cache'}
+    return response
+
+def etag_stats() -> Dict[str, Any]:
+    """Доля ответов 304 по маршрутам с начала жизни контейнера"""
+    with _etag_stats_lock:
+        return {
+            route: {'requests': requests, 'notModified': hits, 'hitRate': round(hits / requests, 3) if requests else 0.0}
+            for route, (requests, hits) in _etag_stats.items()
+        }
+
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'verify_session': """
+        SELECT user_id, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP))
+        FROM t_p37705306_strim_boom_project.sessions
+        WHERE token_hash = $1 AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """,
+    # chat_messages секционирована по created_at, поэтому каждое чтение ограничено
+    # временем стрима: сообщения пишутся только после его создания (started_at), а
+    # верхняя граница отсекает заранее созданные секции будущих дней. Обе границы
+    # вычисляются при выполнении, и Postgres отбрасывает лишние секции (runtime
+    # pruning) и в общем плане подготовленного запроса. Без started_at — все секции.
+    'chat_tail': """
+        SELECT id, username, message, created_at
+        FROM t_p37705306_strim_boom_project.chat_messages
+        WHERE stream_id = $1
+          AND created_at >= COALESCE((SELECT started_at FROM t_p37705306_strim_boom_project.streams WHERE id = $1), '-infinity')
+          AND created_at < LOCALTIMESTAMP + INTERVAL '1 day'
+        ORDER BY id DESC
+        LIMIT $2
+    """,
+    'chat_before': """
+        SELECT id, username, message, created_at
+        FROM t_p37705306_strim_boom_project.chat_messages
+        WHERE stream_id = $1 AND id < $2
+          AND created_at >= COALESCE((SELECT started_at FROM t_p37705306_strim_boom_project.streams WHERE id = $1), '-infinity')
+          AND created_at < LOCALTIMESTAMP + INTERVAL '1 day'
+        ORDER BY id DESC
+        LIMIT $3
+    """,
+    'chat_after': """
+        SELECT id, username, message, created_at
+        FROM t_p37705306_strim_boom_project.chat_messages
+        WHERE stream_id = $1 AND id > $2
+          AND created_at >= COALESCE((SELECT started_at FROM t_p37705306_strim_boom_project.streams WHERE id = $1), '-infinity')
+          AND created_at < LOCALTIMESTAMP + INTERVAL '1 day'
+        ORDER BY id ASC
+        LIMIT $3
+    """,
+    'chat_insert': """
+        INSERT INTO t_p37705306_strim_boom_project.chat_messages (stream_id, user_id, username, message, created_at)
+        VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
+        RETURNING id, username, message, created_at
+    """,
+    'chat_stream_ended': """
+        SELECT ended_at IS NOT NULL OR chat_archived_at IS NOT NULL
+        FROM t_p37705306_strim_boom_project.streams
+        WHERE id = $1
+    """,
+    'chat_archive_before': """
+        SELECT first_id, payload
+        FROM (
+            SELECT first_id, payload,
+                   SUM(message_count) OVER (ORDER BY first_id DESC) - message_count AS newer_count
+            FROM t_p37705306_strim_boom_project.chat_archive_chunks
+            WHERE stream_id = $1 AND first_id < $2
+        ) chunks
+        WHERE newer_count < $3
+        ORDER BY first_id DESC
+    """
+}
+
+CHAT_MAX_LIMIT = 200
+CHAT_MAX_BATCH = int(os.environ.get('CHAT_MAX_BATCH', '1000'))
+CHAT_LONGPOLL_MAX_SEC = float(os.environ.get('CHAT_LONGPOLL_MAX_SEC', '25'))
+CHAT_NOTIFY_CHANNEL = 'chat_messages'
+
+CHAT_LISTENER_PING_SEC = float(os.environ.get('CHAT_LISTENER_PING_SEC', '10'))
+
+_chat_versions: Dict[int, int] = {}
+_chat_listener_epoch = 0
+_chat_listener_alive_at = 0.0
+_chat_cond = threading.Condition()
+_chat_listener_ready = threading.Event()
+_chat_listener_lock = threading.Lock()
+_chat_listener_thread = None
+
+def _chat_listener_loop() -> None:
+    """Один LISTEN на контейнер: будит все ожидающие long-poll запросы"""
+    global _chat_listener_epoch, _chat_listener_alive_at
+    while True:
+        listen_conn = None
+        try:
+            listen_conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connect_timeout=5,
+                                           keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+            listen_conn.autocommit = True
+            with listen_conn.cursor() as listen_cur:
+                listen_cur.execute(f'LISTEN {CHAT_NOTIFY_CHANNEL}')
+            with _chat_cond:
+                # После переподключения уведомления могли потеряться — будим всех
+                _chat_listener_epoch += 1
+                _chat_cond.notify_all()
+            _chat_listener_alive_at = time.monotonic()
+            _chat_listener_ready.set()
+            
+            while True:
+                if select.select([listen_conn], [], [], CHAT_LISTENER_PING_SEC) == ([], [], []):
+                    # Тишина может означать оборванное соединение: без проверки счётчики
+                    # перестали бы меняться, и ETag отдавал бы 304 на новые сообщения
+                    with listen_conn.cursor() as ping_cur:
+                        ping_cur.execute('SELECT 1')
+                else:
+                    listen_conn.poll()
+                _chat_listener_alive_at = time.monotonic()
+                if not listen_conn.notifies:
+                    continue
+                with _chat_cond:
+                    while listen_conn.notifies:
+                        notify = listen_conn.notifies.pop(0)
+                        stream_id = int(notify.payload)
+                        _chat_versions[stream_id] = _chat_versions.get(stream_id, 0) + 1
+                    _chat_cond.notify_all()
+        except (psycopg2.Error, OSError, ValueError):
+            _chat_listener_ready.clear()
+            if listen_conn is not None and not listen_conn.closed:
+                listen_conn.close()
+            time.sleep(1)
+
+def ensure_chat_listener(wait: bool = True) -> None:
+    """Запускает фоновый слушатель NOTIFY, если он ещё не работает"""
+    global _chat_listener_thread
+    with _chat_listener_lock:
+        if _chat_listener_thread is None or not _chat_listener_thread.is_alive():
+            _chat_listener_thread = threading.Thread(target=_chat_listener_loop, daemon=True)
+            _chat_listener_thread.start()
+    if wait:
+        _chat_listener_ready.wait(timeout=5)
+
+def chat_listener_alive() -> bool:
+    """Слушатель подключён и недавно подтвердил, что соединение живо"""
+    return _chat_listener_ready.is_set() and time.monotonic() - _chat_listener_alive_at < 2 * CHAT_LISTENER_PING_SEC + 5
+
+def chat_version(stream_id: int) -> Tuple[int, int]:
+    """Текущая версия чата стрима по данным слушателя"""
+    with _chat_cond:
+        return _chat_listener_epoch, _chat_versions.get(stream_id, 0)
+
+def wait_for_chat_messages(stream_id: int, version: Tuple[int, int], timeout: float) -> bool:
+    """Блокирует до нового сообщения в стриме или до таймаута"""
+    started = time.perf_counter()
+    with _chat_cond:
+        changed = _chat_cond.wait_for(
+            lambda: (_chat_listener_epoch, _chat_versions.get(stream_id, 0)) != version,
+            timeout=timeout
+        )
+    record_timing('wait', started)
+    return changed
+
+CHAT_CONTAINER_ID = os.urandom(4).hex()
+
+def parse_chat_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Разбирает параметры GET до обращения к БД; ValueError несёт текст ответа 400"""
+    def number(name: str, parse: Callable[[str], Any], default: Any = None) -> Any:
+        value = params.get(name)
+        if value is None or value == '':
+            return default
+        try:
+            return parse(value)
+        except ValueError:
+            raise ValueError(f'Invalid {name}') from None
+    
+    stream_id = number('stream_id', int)
+    if not stream_id:
+        raise ValueError('Missing stream_id')
+    return {
+        'stream_id': stream_id,
+        'after_id': number('after_id', int),
+        'before_id': number('before_id', int),
+        'limit': max(1, min(number('limit', int, 50), CHAT_MAX_LIMIT)),
+        'wait': max(0.0, min(number('wait', float, 0.0), CHAT_LONGPOLL_MAX_SEC))
+    }
+
+def chat_etag(query: Dict[str, Any]) -> Optional[str]:
+    """
+    ETag ответа GET из счётчика NOTIFY по стриму. Счётчик свой у каждого контейнера,
+    поэтому в ETag входит id контейнера; версия читается до запроса к БД, так что
+    сообщение, записанное позже, всегда её сменит. Long-poll и запросы, пока слушатель
+    не подключён или не подтвердил соединение, идут без ETag; подключения они не ждут.
+    """
+    if query['wait'] > 0:
+        return None
+    ensure_chat_listener(wait=False)
+    if not chat_listener_alive():
+        return None
+    epoch, version = chat_version(query['stream_id'])
+    return make_etag('chat', CHAT_CONTAINER_ID, epoch, version, query['stream_id'],
+                     query['after_id'], query['before_id'], query['limit'])
+
+def fetch_chat_after(cur: Any, stream_id: int, after_id: int, limit: int) -> List[Tuple]:
+    """Сообщения стрима новее курсора after_id"""
+    execute_prepared(cur, 'chat_after', (stream_id, after_id, limit))
+    return cur.fetchall()
+
+CHAT_ARCHIVE_CHUNK_SIZE = 1000
+CHAT_ARCHIVE_CACHE_CHUNKS = int(os.environ.get('CHAT_ARCHIVE_CACHE_CHUNKS', '64'))
+
+_archive_cache: 'OrderedDict[Tuple[int, int], List[Tuple]]' = OrderedDict()
+_archive_cache_lock = threading.Lock()
+
+def encode_chat_chunk(rows: List[Tuple]) -> bytes:
+    """
+    Пачка сообщений (id, username, message, created_at) по возрастанию id в архивный формат:
+    JSON по колонкам, id и время — разностями с предыдущим сообщением, всё сжато zlib
+    """
+    first_at = rows[0][3]
+    ids, offsets, prev_id, prev_us = [], [], 0, 0
+    for row in rows:
+        us = (row[3] - first_at) // timedelta(microseconds=1)
+        ids.append(row[0] - prev_id)
+        offsets.append(us - prev_us)
+        prev_id, prev_us = row[0], us
+    payload = {
+        'at': first_at.isoformat(),
+        'id': ids,
+        'dt': offsets,
+        'u': [row[1] for row in rows],
+        'm': [row[2] for row in rows]
+    }
+    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 9)
+
+def decode_chat_chunk(payload: bytes) -> List[Tuple]:
+    """Обратное к encode_chat_chunk: строки в формате chat_tail"""
+    data = json.loads(zlib.decompress(payload))
+    first_at = datetime.fromisoformat(data['at'])
+    return [
+        (message_id, username, message, first_at + timedelta(microseconds=us))
+        for message_id, us, username, message in zip(accumulate(data['id']), accumulate(data['dt']), data['u'], data['m'])
+    ]
+
+def fetch_chat_archive(cur: Any, stream_id: int, before_id: int, limit: int) -> List[Tuple]:
+    """Сообщения из архива стрима старше before_id, от новых к старым"""
+    # Пачка на границе курсора может почти целиком быть новее него, поэтому порог с запасом в одну пачку
+    execute_prepared(cur, 'chat_archive_before', (stream_id, before_id, limit + CHAT_ARCHIVE_CHUNK_SIZE))
+    rows: List[Tuple] = []
+    for first_id, payload in cur.fetchall():
+        # Пачки неизменяемы, поэтому распакованные можно держать в памяти контейнера
+        key = (stream_id, first_id)
+        with _archive_cache_lock:
+            chunk = _archive_cache.get(key)
+            if chunk is not None:
+                _archive_cache.move_to_end(key)
+        if chunk is None:
+            started = time.perf_counter()
+            chunk = decode_chat_chunk(payload)
+            record_timing('archive_decode', started)
+            with _archive_cache_lock:
+                _archive_cache[key] = chunk
+                while len(_archive_cache) > CHAT_ARCHIVE_CACHE_CHUNKS:
+                    _archive_cache.popitem(last=False)
+        rows.extend(row for row in reversed(chunk) if row[0] < before_id)
+        if len(rows) >= limit:
+            break
+    return rows[:limit]
+
+CHAT_STREAM_STATE_TTL_SEC = float(os.environ.get('CHAT_STREAM_STATE_TTL_SEC', '60'))
+CHAT_STREAM_STATE_MAX = 100000
+
+_chat_stream_ended: Dict[int, Tuple[bool, float]] = {}
+_chat_stream_ended_lock = threading.Lock()
+
+def chat_stream_ended(cur: Any, stream_id: int) -> bool:
+    """
+    Завершён ли стрим (или уже заархивирован). Завершение необратимо и запоминается
+    навсегда, живой стрим перепроверяется раз в CHAT_STREAM_STATE_TTL_SEC
+    """
+    now = time.monotonic()
+    with _chat_stream_ended_lock:
+        cached = _chat_stream_ended.get(stream_id)
+    if cached is not None and (cached[0] or now < cached[1]):
+        return cached[0]
+    execute_prepared(cur, 'chat_stream_ended', (stream_id,))
+    row = cur.fetchone()
+    ended = bool(row and row[0])
+    with _chat_stream_ended_lock:
+        _chat_stream_ended[stream_id] = (ended, now + CHAT_STREAM_STATE_TTL_SEC)
+        while len(_chat_stream_ended) > CHAT_STREAM_STATE_MAX:
+            _chat_stream_ended.pop(next(iter(_chat_stream_ended)))
+    return ended
+
+def fetch_chat_history(cur: Any, stream_id: int, before_id: Optional[int], limit: int) -> List[Tuple]:
+    """
+    Сообщения стрима старше before_id (или последние), от новых к старым.
+    Живые секции chat_messages всегда новее архива, поэтому архив дочитывается после них.
+    Хвост живого стрима архив не трогает: короткий чат нового стрима опрашивается постоянно;
+    явная прокрутка назад (before_id) дочитывает архив и у живого стрима, чья старая
+    секция уже отсоединена
+    """
+    if before_id:
+        execute_prepared(cur, 'chat_before', (stream_id, before_id, limit))
+    else:
+        execute_prepared(cur, 'chat_tail', (stream_id, limit))
+    rows = cur.fetchall()
+    if len(rows) < limit and (before_id or chat_stream_ended(cur, stream_id)):
+        cursor = rows[-1][0] if rows else (before_id or 2 ** 31 - 1)
+        rows.extend(fetch_chat_archive(cur, stream_id, cursor, limit - len(rows)))
+    return rows
+
+CHAT_USER_RATE = float(os.environ.get('CHAT_USER_RATE', '1'))
+CHAT_USER_BURST = float(os.environ.get('CHAT_USER_BURST', '5'))
+CHAT_STREAM_RATE = float(os.environ.get('CHAT_STREAM_RATE', '50'))
+CHAT_STREAM_BURST = float(os.environ.get('CHAT_STREAM_BURST', '200'))
+CHAT_DUPLICATE_WINDOW_SEC = float(os.environ.get('CHAT_DUPLICATE_WINDOW_SEC', '30'))
+CHAT_COPYPASTA_MAX = int(os.environ.get('CHAT_COPYPASTA_MAX', '5'))
+CHAT_FLOOD_MAX_KEYS = int(os.environ.get('CHAT_FLOOD_MAX_KEYS', '100000'))
+# Пакеты мостов с токеном: отдельный лимит стрима вместо интерактивного
+CHAT_INGEST_RATE = float(os.environ.get('CHAT_INGEST_RATE', '1000'))
+CHAT_INGEST_BURST = float(os.environ.get('CHAT_INGEST_BURST', str(CHAT_MAX_BATCH)))
+# Переопределения для отдельных стримов: {"42": {"user_rate": 0.2, "stream_burst": 500}}
+CHAT_STREAM_LIMITS: Dict[str, Dict[str, float]] = json.loads(os.environ.get('CHAT_STREAM_LIMITS') or '{}')
+
+_flood_buckets: 'OrderedDict[Tuple, Tuple[float, float]]' = OrderedDict()
+_flood_recent: 'OrderedDict[Tuple, Tuple[int, float]]' = OrderedDict()
+_flood_lock = threading.Lock()
+_flood_stats: Dict[str, int] = {'accepted': 0, 'user_rate': 0, 'stream_rate': 0, 'duplicate': 0, 'copypasta': 0}
+_flood_shed_by_stream: Dict[int, int] = {}
+
+def _bounded_put(store: 'OrderedDict[Tuple, Any]', key: Tuple, value: Any) -> None:
+    store[key] = value
+    store.move_to_end(key)
+    while len(store) > CHAT_FLOOD_MAX_KEYS:
+        store.popitem(last=False)
+
+def _bucket_tokens(key: Tuple, rate: float, burst: float, now: float) -> float:
+    tokens, updated_at = _flood_buckets.get(key, (burst, now))
+    return min(burst, tokens + (now - updated_at) * rate)
+
+def _recent_count(key: Tuple, now: float) -> Tuple[int, float]:
+    """Повторы ключа в текущем окне CHAT_DUPLICATE_WINDOW_SEC и начало окна"""
+    count, window_start = _flood_recent.get(key, (0, now))
+    if now - window_start > CHAT_DUPLICATE_WINDOW_SEC:
+        return 0, now
+    return count, window_start
+
+def check_chat_flood(stream_id: int, sender: str, message: str, ingest: bool = False) -> Optional[str]:
+    """
+    Решает до любого SQL, пропускать ли сообщение: повтор от того же отправителя,
+    одинаковый текст от многих отправителей, лимиты отправителя и стрима (для
+    пакетов моста — отдельный лимит приёма). Состояние меняется только для
+    принятого сообщения, чтобы повтор после 429 не считался дублем.
+    Возвращает причину отказа или None.
+    """
+    limits = CHAT_STREAM_LIMITS.get(str(stream_id), {})
+    text_key = hash(' '.join(message.lower().split()))
+    dup_key = ('dup', stream_id, sender, text_key)
+    copy_key = ('copy', stream_id, text_key)
+    user_key = ('user', stream_id, sender)
+    if ingest:
+        stream_key = ('ingest', stream_id)
+        stream_rate, stream_burst = CHAT_INGEST_RATE, CHAT_INGEST_BURST
+    else:
+        stream_key = ('stream', stream_id)
+        stream_rate = limits.get('stream_rate', CHAT_STREAM_RATE)
+        stream_burst = limits.get('stream_burst', CHAT_STREAM_BURST)
+    now = time.monotonic()
+    with _flood_lock:
+        dup_count, dup_window = _recent_count(dup_key, now)
+        copy_count, copy_window = _recent_count(copy_key, now)
+        user_tokens = _bucket_tokens(user_key, limits.get('user_rate', CHAT_USER_RATE),
+                                     limits.get('user_burst', CHAT_USER_BURST), now)
+        stream_tokens = _bucket_tokens(stream_key, stream_rate, stream_burst, now)
+        if dup_count >= 1:
+            reason = 'duplicate'
+        elif copy_count >= int(limits.get('copypasta_max', CHAT_COPYPASTA_MAX)):
+            reason = 'copypasta'
+        elif user_tokens < 1:
+            reason = 'user_rate'
+        elif stream_tokens < 1:
+            reason = 'stream_rate'
+        else:
+            _bounded_put(_flood_recent, dup_key, (dup_count + 1, dup_window))
+            _bounded_put(_flood_recent, copy_key, (copy_count + 1, copy_window))
+            _bounded_put(_flood_buckets, user_key, (user_tokens - 1, now))
+            _bounded_put(_flood_buckets, stream_key, (stream_tokens - 1, now))
+            _flood_stats['accepted'] += 1
+            return None
+        _flood_stats[reason] += 1
+        _flood_shed_by_stream[stream_id] = _flood_shed_by_stream.get(stream_id, 0) + 1
+    return reason
+
+def chat_source_ip(event: Dict[str, Any]) -> str:
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or 'unknown'
+
+def chat_sender_key(event: Dict[str, Any], item: Dict[str, Any], relayed: bool = False) -> str:
+    """
+    Отправитель для лимитов. Анонимный — по IP: user_id и имя из тела можно менять
+    на каждом запросе. С токеном — по токену, а сообщения пакета моста — по своему
+    пользователю, потому что мост пересылает чат многих людей
+    """
+    token = get_auth_token(event)
+    if not token:
+        return f'ip:{chat_source_ip(event)}'
+    if not relayed:
+        return f't:{token}'
+    if item.get('user_id'):
+        return f"u:{item['user_id']}"
+    return f"n:{item.get('username')}"
+
+def shed_chat_flood(event: Dict[str, Any], body_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Прогоняет POST через флуд-контроль. Одиночное сообщение при отказе получает 429;
+    из пакета отбрасываются только отклонённые сообщения.
+    """
+    if 'messages' in body_data:
+        # Пакет уже проверен validate_chat_batch: лимиты тратятся только на то, что будет вставлено
+        ingest = bool(get_auth_token(event))
+        accepted = []
+        for item in body_data['messages']:
+            if check_chat_flood(item['stream_id'], chat_sender_key(event, item, relayed=True), str(item['message']), ingest):
+                continue
+            accepted.append(item)
+        body_data['shed'] = len(body_data['messages']) - len(accepted)
+        if accepted or not body_data['shed']:
+            body_data['messages'] = accepted
+            return None
+        reason = 'batch'
+    else:
+        stream_id = body_data.get('stream_id')
+        message = body_data.get('message')
+        if not stream_id or not message:
+            return None
+        reason = check_chat_flood(int(stream_id), chat_sender_key(event, body_data), str(message))
+        if reason is None:
+            return None
+    
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields['flood_shed'] = reason
+    return {
+        'statusCode': 429,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Retry-After': '1'
+        },
+        'body': json.dumps({'error': 'Too many messages', 'reason': reason}),
+        'isBase64Encoded': False
+    }
+
+def chat_flood_stats() -> Dict[str, Any]:
+    """Счётчики флуд-контроля контейнера и стримы с наибольшим числом отказов"""
+    with _flood_lock:
+        top_streams = sorted(_flood_shed_by_stream.items(), key=lambda item: item[1], reverse=True)[:20]
+        return {
+            **_flood_stats,
+            'shed': sum(_flood_stats.values()) - _flood_stats['accepted'],
+            'topStreams': [{'streamId': stream_id, 'shed': shed} for stream_id, shed in top_streams],
+            'trackedKeys': len(_flood_buckets) + len(_flood_recent)
+        }
+
+CHAT_MESSAGE_ENCODER = RowEncoder(('id', 'int'), ('username', 'str'), ('message', 'str'), ('timestamp', 'ts'))
+CHAT_INSERTED_ENCODER = RowEncoder(('id', 'int'), ('timestamp', 'ts'))
+
+def validate_chat_batch(body_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Проверяет размер и поля пакета до флуд-контроля, чтобы отклонённый пакет не тратил
+    лимиты отправителя. stream_id каждого сообщения приводится к int на месте
+    """
+    batch = body_data.get('messages') or []
+    default_stream_id = body_data.get('stream_id')
+    
+    if not batch or len(batch) > CHAT_MAX_BATCH:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Batch must contain 1..{CHAT_MAX_BATCH} messages'}),
+            'isBase64Encoded': False
+        }
+    
+    for index, item in enumerate(batch):
+        try:
+            item_stream_id = int(item.get('stream_id', default_stream_id) or 0)
+        except (TypeError, ValueError):
+            item_stream_id = 0
+        if not item_stream_id or not item.get('username') or not item.get('message'):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Missing required fields in message {index}'}),
+                'isBase64Encoded': False
+            }
+        item['stream_id'] = item_stream_id
+    body_data['messages'] = batch
+    return None
+
+def insert_chat_batch(cur: Any, body_data: Dict[str, Any], auth_user_id: Optional[int]) -> Dict[str, Any]:
+    """
+    Пакетная вставка проверенных сообщений одним multi-row INSERT, id возвращаются
+    в порядке запроса. Как и у одиночного сообщения, user_id токена важнее тела
+    """
+    values = [
+        (item['stream_id'], auth_user_id or item.get('user_id'), item['username'], item['message'])
+        for item in body_data['messages']
+    ]
+    
+    rows = psycopg2.extras.execute_values(cur, """
+        INSERT INTO t_p37705306_strim_boom_project.chat_messages (stream_id, user_id, username, message)
+        VALUES %s
+        RETURNING id, created_at
+    """, values, page_size=len(values), fetch=True)
+    
+    # id из serial выдаются в порядке строк VALUES, поэтому сортировка восстанавливает порядок запроса
+    rows.sort(key=lambda row: row[0])
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps_body({
+            'count': len(rows),
+            'shed': body_data.get('shed', 0),
+            'messages': CHAT_INSERTED_ENCODER.encode(rows)
+        }),
+        'isBase64Encoded': False
+    }
+
+@instrument_handler('chat')
+@compress_response
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Чат в реальном времени для стримов
-    Args: event с httpMethod, queryStringParameters (stream_id), body (message)
+    Args: event с httpMethod, queryStringParameters (stream_id, after_id, before_id, limit, wait, view=flood|etag), body (message или messages[] для пакетной вставки)
     Returns: HTTP response с сообщениями чата
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -29,56 +1016,100 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    
     try:
-        conn = psycopg2.connect(database_url)
-        conn.autocommit = True
-        cur = conn.cursor()
-        
+        # Флуд-контроль, счётчики и проверка ETag работают в памяти контейнера, до соединения с БД
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
-            stream_id = params.get('stream_id')
-            limit = int(params.get('limit', 50))
+            params = event.get('queryStringParameters') or {}
+            view = params.get('view')
+            if view in ('flood', 'etag'):
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({view: chat_flood_stats() if view == 'flood' else etag_stats()}),
+                    'isBase64Encoded': False
+                }
             
-            if not stream_id:
+            try:
+                query = parse_chat_query(params)
+            except ValueError as e:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing stream_id'}),
+                    'body': json.dumps({'error': str(e)}),
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                SELECT id, username, message, created_at
-                FROM t_p37705306_strim_boom_project.chat_messages
-                WHERE stream_id = {stream_id}
-                ORDER BY created_at DESC
-                LIMIT {limit}
-            """)
-            
-            messages = []
-            for row in cur.fetchall():
-                messages.append({
-                    'id': row[0],
-                    'username': row[1],
-                    'message': row[2],
-                    'timestamp': row[3].isoformat() if row[3] else None
-                })
+            etag = chat_etag(query)
+            not_modified = conditional_response(event, 'messages', etag)
+            if not_modified:
+                return not_modified
+        
+        if method == 'POST':
+            body_data = json.loads(event.get('body', '{}'))
+            if 'messages' in body_data:
+                invalid_batch = validate_chat_batch(body_data)
+                if invalid_batch:
+                    return invalid_batch
+            shed_response = shed_chat_flood(event, body_data)
+            if shed_response:
+                return shed_response
+        
+        conn, db_timing = get_db_connection()
+        cur = conn.cursor()
+        
+        # Токен необязателен, но если передан — он должен быть действительным
+        auth_token = get_auth_token(event)
+        auth_user_id = verify_auth_token(cur, auth_token) if auth_token else None
+        if auth_token and auth_user_id is None:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or expired token'}),
+                'isBase64Encoded': False
+            }
+        
+        if method == 'GET':
+            stream_id = query['stream_id']
+            after_id = query['after_id']
+            limit = query['limit']
             
-            messages.reverse()
+            # Курсорный режим: индекс (stream_id, id) отдаёт только дельту
+            if after_id is not None:
+                wait = query['wait']
+                
+                if wait > 0:
+                    ensure_chat_listener()
+                    version = chat_version(stream_id)
+                
+                rows = fetch_chat_after(cur, stream_id, after_id, limit)
+                
+                # Long-poll: соединение возвращается в пул на время ожидания NOTIFY
+                if not rows and wait > 0:
+                    cur.close()
+                    release_db_connection(conn)
+                    del cur, conn
+                    if wait_for_chat_messages(stream_id, version, wait):
+                        conn, _ = get_db_connection()
+                        cur = conn.cursor()
+                        rows = fetch_chat_after(cur, stream_id, after_id, limit)
+            else:
+                # История: живые секции, а для завершённых стримов — сжатый архив
+                rows = fetch_chat_history(cur, stream_id, query['before_id'], limit)
+                rows.reverse()
             
-            return {
+            return with_etag({
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages}),
+                'body': dumps_body({'messages': CHAT_MESSAGE_ENCODER.encode(rows)}),
                 'isBase64Encoded': False
-            }
+            }, etag)
         
         elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
+            if 'messages' in body_data:
+                return insert_chat_batch(cur, body_data, auth_user_id)
+            
             stream_id = body_data.get('stream_id')
-            user_id = body_data.get('user_id')
+            user_id = auth_user_id or body_data.get('user_id')
             username = body_data.get('username')
             message = body_data.get('message')
             
@@ -90,14 +1121,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            username = escape_sql_string(username)
-            message = escape_sql_string(message)
-            
-            cur.execute(f"""
-                INSERT INTO t_p37705306_strim_boom_project.chat_messages (stream_id, user_id, username, message, created_at)
-                VALUES ({stream_id}, {user_id}, '{username}', '{message}', CURRENT_TIMESTAMP)
-                RETURNING id, username, message, created_at
-            """)
+            execute_prepared(cur, 'chat_insert', (int(stream_id), user_id, username, message))
             
             msg = cur.fetchone()
             
@@ -133,4 +1157,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+        if 'db_timing' in locals():
+            note_db_timing(db_timing)
@@ -1,17 +1,615 @@
 import json
+import hashlib
 import os
-from typing import Dict, Any
+import time
+import threading
+import bisect
+import functools
+import random
+import base64
+import gzip
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
+import psycopg2.errors
 
-def escape_sql_string(s: str) -> str:
-    """Экранирует строки для безопасного использования в SQL"""
-    return s.replace("'", "''")
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            # Ожидание long-poll (фаза wait) не делает запрос медленным
+            if total_ms - timing.phases.get('wait', 0.0) >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', '16'))
+
+_compressed_cache: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+class CachedBody(str):
+    """Тело ответа из кэша контейнера: его сжатые формы тоже кэшируются"""
+
+def accepted_encoding(event: Dict[str, Any]) -> Optional[str]:
+    """Лучшее поддерживаемое кодирование из Accept-Encoding (br, затем gzip); q=0 запрещает"""
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    weights: Dict[str, float] = {}
+    for part in headers.get('accept-encoding', '').split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        if params.strip().startswith('q='):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best = max(supported, key=lambda name: weights.get(name, weights.get('*', 0.0)))
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+def compress_body(body: str, encoding: str) -> str:
+    """Сжатое тело в base64 для шлюза"""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    return base64.b64encode(compressed).decode('ascii')
+
+def compress_response(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+    """
+    Сжимает тело ответа длиннее COMPRESS_MIN_BYTES по Accept-Encoding клиента и отдаёт
+    его шлюзу в base64. Сжатые формы CachedBody кэшируются, остальные сжимаются заново.
+    """
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = handler(event, context)
+        body = response.get('body')
+        if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES:
+            return response
+        headers = dict(response.get('headers') or {})
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = accepted_encoding(event)
+        if encoding is None:
+            return {**response, 'headers': headers}
+        
+        started = time.perf_counter()
+        key = (encoding, body)
+        encoded = None
+        if isinstance(body, CachedBody):
+            with _compressed_cache_lock:
+                encoded = _compressed_cache.get(key)
+                if encoded is not None:
+                    _compressed_cache.move_to_end(key)
+        if encoded is None:
+            encoded = compress_body(body, encoding)
+            if isinstance(body, CachedBody):
+                with _compressed_cache_lock:
+                    _compressed_cache[key] = encoded
+                    while len(_compressed_cache) > COMPRESS_CACHE_SIZE:
+                        _compressed_cache.popitem(last=False)
+        record_timing('compress', started)
+        
+        headers['Content-Encoding'] = encoding
+        return {**response, 'headers': headers, 'body': encoded, 'isBase64Encoded': True}
+    return wrapper
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> Tuple[Any, Dict[str, Any]]:
+    """Берёт тёплое соединение из пула контейнера или открывает новое"""
+    started = time.perf_counter()
+    while True:
+        with _db_pool_lock:
+            item = _db_pool.pop() if _db_pool else None
+        if item is None:
+            break
+        conn, released_at = item
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SEC:
+            try:
+                with conn.cursor() as check_cur:
+                    check_cur.execute('SELECT 1')
+            except psycopg2.Error:
+                conn.close()
+                continue
+        record_timing('db_connect', started)
+        return conn, {'reused': True, 'connect_ms': (time.perf_counter() - started) * 1000}
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=PooledConnection)
+    conn.autocommit = True
+    record_timing('db_connect', started)
+    return conn, {'reused': False, 'connect_ms': (time.perf_counter() - started) * 1000}
+
+def release_db_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def statement_metric(query: Any) -> str:
+    """Имя метрики для запроса: q_<имя> для EXECUTE подготовленного запроса"""
+    head = (query[:80].decode('utf-8', errors='replace') if isinstance(query, bytes) else query[:80]).split()
+    if head[:1] == ['EXECUTE']:
+        return f'q_{head[1]}'
+    if head[:1] == ['PREPARE']:
+        return 'db_prepare'
+    return 'db_sql'
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, который записывает время запросов и разбора строк в фазы текущего запроса"""
+    def execute(self, query: Any, vars: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            record_timing(statement_metric(query), started)
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_timing('db_decode', started)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_timing('db_decode', started)
+        return rows
+
+    def fetchall(self) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_timing('db_decode', started)
+        return rows
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит подготовленные на нём запросы"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.cursor_factory = TimedCursor
+
+_stmt_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из PREPARED_STATEMENTS; PREPARE делается один раз на соединение"""
+    conn = cur.connection
+    if name in conn.prepared:
+        _stmt_stats['hits'] += 1
+    else:
+        cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+        _stmt_stats['misses'] += 1
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def note_db_timing(db_timing: Dict[str, Any]) -> None:
+    """Добавляет в лог запроса сведения о соединении и кэше подготовленных запросов"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields.update({
+            'db_reused': db_timing['reused'],
+            'stmt_cache_hits': _stmt_stats['hits'],
+            'stmt_cache_misses': _stmt_stats['misses']
+        })
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '60'))
+
+_session_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def get_auth_token(event: Dict[str, Any]) -> Optional[str]:
+    """Достаёт X-Auth-Token из заголовков запроса"""
+    headers = event.get('headers') or {}
+    return headers.get('X-Auth-Token') or headers.get('x-auth-token')
+
+def verify_auth_token(cur: Any, token: str) -> Optional[int]:
+    """
+    Возвращает user_id сессии или None. Проверенные токены живут в LRU-кэше
+    контейнера не дольше SESSION_CACHE_TTL_SEC — это и есть окно отзыва.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > now:
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+    
+    execute_prepared(cur, 'verify_session', (token_hash,))
+    row = cur.fetchone()
+    
+    with _session_cache_lock:
+        if not row:
+            _session_cache.pop(token_hash, None)
+            return None
+        _session_cache[token_hash] = (row[0], now + min(SESSION_CACHE_TTL_SEC, float(row[1])))
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return row[0]
+
+DONATION_TOP_N = 10
+
+_escape_json_string = json.encoder.encode_basestring_ascii
+
+class RawJson(str):
+    """Уже закодированный JSON-фрагмент: dumps_body вставляет его как есть"""
+
+def dumps_json(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def dumps_body(fields: Dict[str, Any]) -> str:
+    """Собирает JSON-объект ответа без повторного кодирования RawJson-значений"""
+    started = time.perf_counter()
+    body = '{' + ','.join(
+        f'{_escape_json_string(key)}:{value if isinstance(value, RawJson) else dumps_json(value)}'
+        for key, value in fields.items()
+    ) + '}'
+    record_timing('serialize', started)
+    return body
+
+# Выражения для значения колонки r[i]: для json.dumps-совместимого текста и для orjson
+_JSON_COLUMN_TEXT = {
+    'int': "('null' if r[{i}] is None else str(r[{i}]))",
+    'bool': "('null' if r[{i}] is None else 'true' if r[{i}] else 'false')",
+    'id': "('null' if r[{i}] is None else '\"' + str(r[{i}]) + '\"')",
+    'str': "('null' if r[{i}] is None else esc(r[{i}]))",
+    'ts': "('null' if r[{i}] is None else '\"' + r[{i}].isoformat() + '\"')",
+    'json': "dumps(r[{i}])"
+}
+_JSON_COLUMN_VALUE = {
+    'int': "r[{i}]",
+    'bool': "r[{i}]",
+    'id': "(None if r[{i}] is None else str(r[{i}]))",
+    'str': "r[{i}]",
+    'ts': "r[{i}]",
+    'json': "r[{i}]"
+}
+
+class RowEncoder:
+    """
+    Кодирует строки результата в JSON-массив объектов по схеме колонок (ключ, тип):
+    int, bool, id (число строкой), str, ts (datetime в ISO 8601), json (любое значение);
+    колонка с ключом None пропускается. Выражение для строки собирается один раз,
+    без промежуточных словарей; с orjson словари строятся, но кодирует их orjson.
+    """
+    def __init__(self, *columns: Tuple[Optional[str], str]) -> None:
+        self.columns = columns
+        self.backend = orjson
+        fields = [(i, key, kind) for i, (key, kind) in enumerate(columns) if key is not None]
+        if orjson is not None:
+            source = 'lambda r: {' + ', '.join(
+                f'{key!r}: {_JSON_COLUMN_VALUE[kind].format(i=i)}' for i, key, kind in fields
+            ) + '}'
+        else:
+            source = "lambda r: '{' + " + " + ',' + ".join(
+                f'{_escape_json_string(key) + ":"!r} + {_JSON_COLUMN_TEXT[kind].format(i=i)}' for i, key, kind in fields
+            ) + " + '}'"
+        self.encode_row: Callable[[Tuple], Any] = eval(source, {'esc': _escape_json_string, 'dumps': dumps_json})
+
+    def encode(self, rows: List[Tuple]) -> RawJson:
+        started = time.perf_counter()
+        if self.backend is not None:
+            encoded = RawJson(self.backend.dumps(list(map(self.encode_row, rows))).decode())
+        else:
+            encoded = RawJson('[' + ','.join(map(self.encode_row, rows)) + ']')
+        record_timing('serialize', started)
+        return encoded
+
+# Условные GET: ETag строится из дешёвого токена версии, совпадение отдаёт 304 без основного запроса
+_etag_stats: Dict[str, List[int]] = {}
+_etag_stats_lock = threading.Lock()
+
+def make_etag(*parts: Any) -> str:
+    """Слабый ETag: тело может уйти в разных Content-Encoding, а версия у них одна"""
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    return etag.removeprefix('W/') in [tag.strip().removeprefix('W/') for tag in headers.get('if-none-match', '').split(',')]
+
+def conditional_response(event: Dict[str, Any], route: str, etag: Optional[str]) -> Optional[Dict[str, Any]]:
+    """304, если If-None-Match содержит etag; иначе None. Попадания считаются по маршруту"""
+    if etag is None:
+        return None
+    hit = etag_matches(event, etag)
+    with _etag_stats_lock:
+        stats = _etag_stats.setdefault(route, [0, 0])
+        stats[0] += 1
+        stats[1] += hit
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields['etag'] = 'hit' if hit else 'miss'
+    if not hit:
+        return None
+    return {
+        'statusCode': 304,
+        'headers': {'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def with_etag(response: Dict[str, Any], etag: Optional[str]) -> Dict[str, Any]:
+    """Добавляет ETag к ответу 200; no-cache заставляет браузер перепроверять версию на каждом опросе"""
+    if etag is not None:
+        response['headers'] = {**response['headers'], 'ETag': etag, 'Cache-Control': 'no-cache'}
+    return response
+
+def etag_stats() -> Dict[str, Any]:
+    """Доля ответов 304 по маршрутам с начала жизни контейнера"""
+    with _etag_stats_lock:
+        return {
+            route: {'requests': requests, 'notModified': hits, 'hitRate': round(hits / requests, 3) if requests else 0.0}
+            for route, (requests, hits) in _etag_stats.items()
+        }
+
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'verify_session': """
+        SELECT user_id, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP))
+        FROM t_p37705306_strim_boom_project.sessions
+        WHERE token_hash = $1 AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'donations_recent': """
+        SELECT d.id, d.amount, d.message, d.created_at, COALESCE(u.username, 'Аноним')
+        FROM t_p37705306_strim_boom_project.donations d
+        LEFT JOIN t_p37705306_strim_boom_project.users u ON d.from_user_id = u.id
+        WHERE d.stream_id = $1
+        ORDER BY d.created_at DESC
+        LIMIT 50
+    """,
+    # Донат одним атомарным запросом: условное списание, зачисление стримеру,
+    # запись доната и обновление сводки стрима. Суммы донатеров только растут,
+    # поэтому топ-N пересчитывается слиянием старого топа с одним донатером.
+    # Повтор с тем же ключом идемпотентности ничего не списывает и возвращает
+    # ранее созданный донат.
+    # Параметры: $1 stream_id, $2 from_user_id, $3 amount, $4 message,
+    # $5 idempotency_key, $6 top_n.
+    'donate': """
+        WITH existing AS (
+            SELECT id, amount, message, created_at
+            FROM t_p37705306_strim_boom_project.donations
+            WHERE from_user_id = $2
+              AND idempotency_key = $5
+        ), streamer AS (
+            SELECT user_id FROM t_p37705306_strim_boom_project.streams WHERE id = $1
+        ), locked AS (
+            -- Донатер и стример блокируются в порядке id до списания: встречные
+            -- донаты A→B и B→A иначе берут блокировки в разном порядке и ловят deadlock
+            SELECT id FROM t_p37705306_strim_boom_project.users
+            WHERE id IN ($2, (SELECT user_id FROM streamer))
+            ORDER BY id
+            FOR UPDATE
+        ), debit AS (
+            UPDATE t_p37705306_strim_boom_project.users
+            SET boombucks = boombucks - CASE WHEN id = (SELECT user_id FROM streamer) THEN 0 ELSE $3 END
+            WHERE id = $2
+              AND boombucks >= $3
+              AND NOT EXISTS (SELECT 1 FROM existing)
+              -- count(*) дочитывает locked целиком (EXISTS остановился бы на первой
+              -- строке), а условие без ссылок на users проверяется один раз до скана,
+              -- поэтому обе блокировки взяты раньше, чем debit и credit тронут строки
+              AND (SELECT count(*) FROM locked) > 0
+            RETURNING id, CASE WHEN id = (SELECT user_id FROM streamer) THEN 0 ELSE $3 END AS debited
+        ), credit AS (
+            UPDATE t_p37705306_strim_boom_project.users
+            SET boombucks = boombucks + $3
+            WHERE id = (SELECT user_id FROM streamer)
+              AND id <> $2
+              AND EXISTS (SELECT 1 FROM debit)
+            RETURNING id
+        ), donation AS (
+            INSERT INTO t_p37705306_strim_boom_project.donations (stream_id, from_user_id, amount, message, idempotency_key, created_at)
+            SELECT $1, $2, $3, $4::text, $5, CURRENT_TIMESTAMP
+            FROM debit
+            RETURNING id, stream_id, from_user_id, amount, message, created_at
+        ), ledger AS (
+            INSERT INTO t_p37705306_strim_boom_project.balance_ledger (user_id, delta, reason, ref_id)
+            SELECT db.id, -db.debited, 'donation_sent', d.id FROM debit db, donation d WHERE db.debited <> 0
+            UNION ALL
+            SELECT c.id, d.amount, 'donation_received', d.id FROM credit c, donation d
+            RETURNING id
+        ), donor_total AS (
+            INSERT INTO t_p37705306_strim_boom_project.stream_donor_totals (stream_id, from_user_id, total_amount)
+            SELECT stream_id, from_user_id, amount FROM donation
+            ON CONFLICT (stream_id, from_user_id)
+            DO UPDATE SET total_amount = stream_donor_totals.total_amount + EXCLUDED.total_amount
+            RETURNING stream_id, from_user_id, total_amount
+        ), stats AS (
+            INSERT INTO t_p37705306_strim_boom_project.stream_donation_stats (stream_id, total_amount, donations_count, top_donors)
+            SELECT dt.stream_id, d.amount, 1,
+                   jsonb_build_array(jsonb_build_object('userId', dt.from_user_id, 'amount', dt.total_amount))
+            FROM donor_total dt, donation d
+            ON CONFLICT (stream_id) DO UPDATE SET
+                total_amount = stream_donation_stats.total_amount + EXCLUDED.total_amount,
+                donations_count = stream_donation_stats.donations_count + 1,
+                top_donors = (
+                    SELECT COALESCE(jsonb_agg(merged.donor ORDER BY (merged.donor->>'amount')::bigint DESC), '[]'::jsonb)
+                    FROM (
+                        SELECT candidates.donor
+                        FROM (
+                            SELECT donor
+                            FROM jsonb_array_elements(stream_donation_stats.top_donors) AS elem(donor)
+                            WHERE donor->>'userId' <> EXCLUDED.top_donors->0->>'userId'
+                            UNION ALL
+                            SELECT EXCLUDED.top_donors->0
+                        ) AS candidates
+                        ORDER BY (candidates.donor->>'amount')::bigint DESC
+                        LIMIT $6
+                    ) AS merged
+                ),
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING stream_id
+        )
+        SELECT id, amount, message, created_at, false FROM donation
+        UNION ALL
+        SELECT id, amount, message, created_at, true FROM existing
+    """,
+    'donation_summary': """
+        SELECT s.total_amount, s.donations_count,
+               COALESCE((
+                   SELECT jsonb_agg(jsonb_build_object(
+                       'userId', (donor->>'userId')::int,
+                       'username', COALESCE(u.username, 'Аноним'),
+                       'amount', (donor->>'amount')::bigint
+                   ) ORDER BY ord)
+                   FROM jsonb_array_elements(s.top_donors) WITH ORDINALITY AS top(donor, ord)
+                   LEFT JOIN t_p37705306_strim_boom_project.users u ON u.id = (donor->>'userId')::int
+               ), '[]'::jsonb)
+        FROM t_p37705306_strim_boom_project.stream_donation_stats s
+        WHERE s.stream_id = $1
+    """,
+    # Токен версии для ETag: каждый донат меняет сводку стрима в той же транзакции
+    'donations_version': """
+        SELECT donations_count, total_amount
+        FROM t_p37705306_strim_boom_project.stream_donation_stats
+        WHERE stream_id = $1
+    """
+}
+
+DONATION_ENCODER = RowEncoder(('id', 'int'), ('amount', 'int'), ('message', 'str'), ('timestamp', 'ts'), ('username', 'str'))
+
+@instrument_handler('donations')
+@compress_response
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Система донатов для стримеров
-    Args: event с httpMethod, body (stream_id, from_user_id, amount, message)
+    Args: event с httpMethod, queryStringParameters (stream_id, view=summary|etag), body (stream_id, from_user_id, amount, message, idempotency_key)
     Returns: HTTP response с подтверждением доната
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -22,22 +620,38 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    
     try:
-        conn = psycopg2.connect(database_url)
-        conn.autocommit = True
+        if method == 'GET' and (event.get('queryStringParameters') or {}).get('view') == 'etag':
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'etag': etag_stats()}),
+                'isBase64Encoded': False
+            }
+        
+        conn, db_timing = get_db_connection()
         cur = conn.cursor()
         
+        # Токен необязателен, но если передан — он должен быть действительным
+        auth_token = get_auth_token(event)
+        auth_user_id = verify_auth_token(cur, auth_token) if auth_token else None
+        if auth_token and auth_user_id is None:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or expired token'}),
+                'isBase64Encoded': False
+            }
+        
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
+            params = event.get('queryStringParameters') or {}
             stream_id = params.get('stream_id')
             
             if not stream_id:
@@ -48,40 +662,50 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                SELECT d.id, d.amount, d.message, d.created_at, u.username
-                FROM t_p37705306_strim_boom_project.donations d
-                LEFT JOIN t_p37705306_strim_boom_project.users u ON d.from_user_id = u.id
-                WHERE d.stream_id = {stream_id}
-                ORDER BY d.created_at DESC
-                LIMIT 50
-            """)
+            # Версия — одна строка по первичному ключу; при совпадении ETag основной запрос не выполняется
+            view = 'summary' if params.get('view') == 'summary' else 'recent'
+            execute_prepared(cur, 'donations_version', (int(stream_id),))
+            version = cur.fetchone() or (0, 0)
+            etag = make_etag('donations', view, int(stream_id), *version)
+            not_modified = conditional_response(event, view, etag)
+            if not_modified:
+                return not_modified
             
-            donations = []
-            for row in cur.fetchall():
-                donations.append({
-                    'id': row[0],
-                    'amount': row[1],
-                    'message': row[2],
-                    'timestamp': row[3].isoformat() if row[3] else None,
-                    'username': row[4] or 'Аноним'
-                })
+            if view == 'summary':
+                execute_prepared(cur, 'donation_summary', (int(stream_id),))
+                row = cur.fetchone()
+                
+                return with_etag({
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'summary': {
+                            'streamId': int(stream_id),
+                            'total': row[0] if row else 0,
+                            'count': row[1] if row else 0,
+                            'topDonors': row[2] if row else []
+                        }
+                    }),
+                    'isBase64Encoded': False
+                }, etag)
             
-            return {
+            execute_prepared(cur, 'donations_recent', (int(stream_id),))
+            
+            return with_etag({
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'donations': donations}),
+                'body': dumps_body({'donations': DONATION_ENCODER.encode(cur.fetchall())}),
                 'isBase64Encoded': False
-            }
+            }, etag)
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
             stream_id = body_data.get('stream_id')
-            from_user_id = body_data.get('from_user_id')
+            from_user_id = auth_user_id or body_data.get('from_user_id')
             amount = body_data.get('amount')
             message = body_data.get('message', '')
             
-            if not stream_id or not from_user_id or not amount:
+            if not stream_id or not from_user_id or not amount or int(amount) <= 0:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -89,12 +713,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            message = escape_sql_string(message)
+            headers = event.get('headers') or {}
+            idempotency_key = (
+                headers.get('X-Idempotency-Key')
+                or headers.get('x-idempotency-key')
+                or body_data.get('idempotency_key')
+            )
+            
+            donate_params = (int(stream_id), int(from_user_id), int(amount), message, idempotency_key, DONATION_TOP_N)
             
-            cur.execute(f"SELECT boombucks FROM t_p37705306_strim_boom_project.users WHERE id = {from_user_id}")
-            user = cur.fetchone()
+            try:
+                execute_prepared(cur, 'donate', donate_params)
+            except psycopg2.errors.UniqueViolation:
+                # Параллельный повтор с тем же ключом успел первым — отдаём его донат
+                execute_prepared(cur, 'donate', donate_params)
             
-            if not user or user[0] < amount:
+            donation = cur.fetchone()
+            
+            if not donation:
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -102,30 +738,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                UPDATE t_p37705306_strim_boom_project.users 
-                SET boombucks = boombucks - {amount} 
-                WHERE id = {from_user_id}
-            """)
-            
-            cur.execute(f"SELECT user_id FROM t_p37705306_strim_boom_project.streams WHERE id = {stream_id}")
-            streamer = cur.fetchone()
-            
-            if streamer:
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.users 
-                    SET boombucks = boombucks + {amount} 
-                    WHERE id = {streamer[0]}
-                """)
-            
-            cur.execute(f"""
-                INSERT INTO t_p37705306_strim_boom_project.donations (stream_id, from_user_id, amount, message, created_at)
-                VALUES ({stream_id}, {from_user_id}, {amount}, '{message}', CURRENT_TIMESTAMP)
-                RETURNING id, amount, message, created_at
-            """)
-            
-            donation = cur.fetchone()
-            
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -135,7 +747,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'amount': donation[1],
                         'message': donation[2],
                         'timestamp': donation[3].isoformat() if donation[3] else None
-                    }
+                    },
+                    'replayed': donation[4]
                 }),
                 'isBase64Encoded': False
             }
@@ -158,4 +771,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+            note_db_timing(db_timing)
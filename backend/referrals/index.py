@@ -1,17 +1,613 @@
 import json
+import hashlib
 import os
-from typing import Dict, Any
+import time
+import threading
+import bisect
+import functools
+import random
+import base64
+import gzip
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
 
-def escape_sql_string(s: str) -> str:
-    """Экранирует строки для безопасного использования в SQL"""
-    return s.replace("'", "''")
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REFERRAL_REWARD_THRESHOLD = 3
+REFERRAL_REWARD = 1
+REFERRAL_MAX_BATCH = int(os.environ.get('REFERRAL_MAX_BATCH', '1000'))
+REFERRALS_PAGE_SIZE = 50
+REFERRALS_MAX_PAGE_SIZE = 200
+
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            # Ожидание long-poll (фаза wait) не делает запрос медленным
+            if total_ms - timing.phases.get('wait', 0.0) >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', '16'))
+
+_compressed_cache: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+class CachedBody(str):
+    """Тело ответа из кэша контейнера: его сжатые формы тоже кэшируются"""
+
+def accepted_encoding(event: Dict[str, Any]) -> Optional[str]:
+    """Лучшее поддерживаемое кодирование из Accept-Encoding (br, затем gzip); q=0 запрещает"""
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    weights: Dict[str, float] = {}
+    for part in headers.get('accept-encoding', '').split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        if params.strip().startswith('q='):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best = max(supported, key=lambda name: weights.get(name, weights.get('*', 0.0)))
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+def compress_body(body: str, encoding: str) -> str:
+    """Сжатое тело в base64 для шлюза"""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    return base64.b64encode(compressed).decode('ascii')
+
+def compress_response(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+    """
+    Сжимает тело ответа длиннее COMPRESS_MIN_BYTES по Accept-Encoding клиента и отдаёт
+    его шлюзу в base64. Сжатые формы CachedBody кэшируются, остальные сжимаются заново.
+    """
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = handler(event, context)
+        body = response.get('body')
+        if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES:
+            return response
+        headers = dict(response.get('headers') or {})
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = accepted_encoding(event)
+        if encoding is None:
+            return {**response, 'headers': headers}
+        
+        started = time.perf_counter()
+        key = (encoding, body)
+        encoded = None
+        if isinstance(body, CachedBody):
+            with _compressed_cache_lock:
+                encoded = _compressed_cache.get(key)
+                if encoded is not None:
+                    _compressed_cache.move_to_end(key)
+        if encoded is None:
+            encoded = compress_body(body, encoding)
+            if isinstance(body, CachedBody):
+                with _compressed_cache_lock:
+                    _compressed_cache[key] = encoded
+                    while len(_compressed_cache) > COMPRESS_CACHE_SIZE:
+                        _compressed_cache.popitem(last=False)
+        record_timing('compress', started)
+        
+        headers['Content-Encoding'] = encoding
+        return {**response, 'headers': headers, 'body': encoded, 'isBase64Encoded': True}
+    return wrapper
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> Tuple[Any, Dict[str, Any]]:
+    """Берёт тёплое соединение из пула контейнера или открывает новое"""
+    started = time.perf_counter()
+    while True:
+        with _db_pool_lock:
+            item = _db_pool.pop() if _db_pool else None
+        if item is None:
+            break
+        conn, released_at = item
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SEC:
+            try:
+                with conn.cursor() as check_cur:
+                    check_cur.execute('SELECT 1')
+            except psycopg2.Error:
+                conn.close()
+                continue
+        record_timing('db_connect', started)
+        return conn, {'reused': True, 'connect_ms': (time.perf_counter() - started) * 1000}
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=PooledConnection)
+    conn.autocommit = True
+    record_timing('db_connect', started)
+    return conn, {'reused': False, 'connect_ms': (time.perf_counter() - started) * 1000}
+
+def release_db_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def statement_metric(query: Any) -> str:
+    """Имя метрики для запроса: q_<имя> для EXECUTE подготовленного запроса"""
+    head = (query[:80].decode('utf-8', errors='replace') if isinstance(query, bytes) else query[:80]).split()
+    if head[:1] == ['EXECUTE']:
+        return f'q_{head[1]}'
+    if head[:1] == ['PREPARE']:
+        return 'db_prepare'
+    return 'db_sql'
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, который записывает время запросов и разбора строк в фазы текущего запроса"""
+    def execute(self, query: Any, vars: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            record_timing(statement_metric(query), started)
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_timing('db_decode', started)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_timing('db_decode', started)
+        return rows
+
+    def fetchall(self) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_timing('db_decode', started)
+        return rows
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит подготовленные на нём запросы"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.cursor_factory = TimedCursor
+
+_stmt_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из PREPARED_STATEMENTS; PREPARE делается один раз на соединение"""
+    conn = cur.connection
+    if name in conn.prepared:
+        _stmt_stats['hits'] += 1
+    else:
+        cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+        _stmt_stats['misses'] += 1
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def note_db_timing(db_timing: Dict[str, Any]) -> None:
+    """Добавляет в лог запроса сведения о соединении и кэше подготовленных запросов"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields.update({
+            'db_reused': db_timing['reused'],
+            'stmt_cache_hits': _stmt_stats['hits'],
+            'stmt_cache_misses': _stmt_stats['misses']
+        })
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '60'))
+
+_session_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def get_auth_token(event: Dict[str, Any]) -> Optional[str]:
+    """Достаёт X-Auth-Token из заголовков запроса"""
+    headers = event.get('headers') or {}
+    return headers.get('X-Auth-Token') or headers.get('x-auth-token')
+
+def verify_auth_token(cur: Any, token: str) -> Optional[int]:
+    """
+    Возвращает user_id сессии или None. Проверенные токены живут в LRU-кэше
+    контейнера не дольше SESSION_CACHE_TTL_SEC — это и есть окно отзыва.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > now:
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+    
+    execute_prepared(cur, 'verify_session', (token_hash,))
+    row = cur.fetchone()
+    
+    with _session_cache_lock:
+        if not row:
+            _session_cache.pop(token_hash, None)
+            return None
+        _session_cache[token_hash] = (row[0], now + min(SESSION_CACHE_TTL_SEC, float(row[1])))
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return row[0]
+
+_escape_json_string = json.encoder.encode_basestring_ascii
+
+class RawJson(str):
+    """Уже закодированный JSON-фрагмент: dumps_body вставляет его как есть"""
+
+def dumps_json(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def dumps_body(fields: Dict[str, Any]) -> str:
+    """Собирает JSON-объект ответа без повторного кодирования RawJson-значений"""
+    started = time.perf_counter()
+    body = '{' + ','.join(
+        f'{_escape_json_string(key)}:{value if isinstance(value, RawJson) else dumps_json(value)}'
+        for key, value in fields.items()
+    ) + '}'
+    record_timing('serialize', started)
+    return body
+
+# Выражения для значения колонки r[i]: для json.dumps-совместимого текста и для orjson
+_JSON_COLUMN_TEXT = {
+    'int': "('null' if r[{i}] is None else str(r[{i}]))",
+    'bool': "('null' if r[{i}] is None else 'true' if r[{i}] else 'false')",
+    'id': "('null' if r[{i}] is None else '\"' + str(r[{i}]) + '\"')",
+    'str': "('null' if r[{i}] is None else esc(r[{i}]))",
+    'ts': "('null' if r[{i}] is None else '\"' + r[{i}].isoformat() + '\"')",
+    'json': "dumps(r[{i}])"
+}
+_JSON_COLUMN_VALUE = {
+    'int': "r[{i}]",
+    'bool': "r[{i}]",
+    'id': "(None if r[{i}] is None else str(r[{i}]))",
+    'str': "r[{i}]",
+    'ts': "r[{i}]",
+    'json': "r[{i}]"
+}
+
+class RowEncoder:
+    """
+    Кодирует строки результата в JSON-массив объектов по схеме колонок (ключ, тип):
+    int, bool, id (число строкой), str, ts (datetime в ISO 8601), json (любое значение);
+    колонка с ключом None пропускается. Выражение для строки собирается один раз,
+    без промежуточных словарей; с orjson словари строятся, но кодирует их orjson.
+    """
+    def __init__(self, *columns: Tuple[Optional[str], str]) -> None:
+        self.columns = columns
+        self.backend = orjson
+        fields = [(i, key, kind) for i, (key, kind) in enumerate(columns) if key is not None]
+        if orjson is not None:
+            source = 'lambda r: {' + ', '.join(
+                f'{key!r}: {_JSON_COLUMN_VALUE[kind].format(i=i)}' for i, key, kind in fields
+            ) + '}'
+        else:
+            source = "lambda r: '{' + " + " + ',' + ".join(
+                f'{_escape_json_string(key) + ":"!r} + {_JSON_COLUMN_TEXT[kind].format(i=i)}' for i, key, kind in fields
+            ) + " + '}'"
+        self.encode_row: Callable[[Tuple], Any] = eval(source, {'esc': _escape_json_string, 'dumps': dumps_json})
+
+    def encode(self, rows: List[Tuple]) -> RawJson:
+        started = time.perf_counter()
+        if self.backend is not None:
+            encoded = RawJson(self.backend.dumps(list(map(self.encode_row, rows))).decode())
+        else:
+            encoded = RawJson('[' + ','.join(map(self.encode_row, rows)) + ']')
+        record_timing('serialize', started)
+        return encoded
+
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'verify_session': """
+        SELECT user_id, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP))
+        FROM t_p37705306_strim_boom_project.sessions
+        WHERE token_hash = $1 AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """,
+    # Первая страница вместе с реферальным кодом и сводкой: сводка повторяется в каждой строке,
+    # а если рефералов нет, возвращается одна строка с пустыми колонками страницы
+    'referrals_first_page': """
+        SELECT u.referral_code,
+               COALESCE(s.referred_count, 0), COALESCE(s.purchase_total, 0),
+               COALESCE(s.reward_total, 0), COALESCE(s.pending_count, 0),
+               p.id, p.referrer_id, p.referred_user_id, p.username, p.purchase_amount, p.reward_earned, p.status, p.created_at
+        FROM t_p37705306_strim_boom_project.users u
+        LEFT JOIN t_p37705306_strim_boom_project.referral_stats s ON s.referrer_id = u.id
+        LEFT JOIN LATERAL (
+            SELECT r.id, r.referrer_id, r.referred_user_id, ru.username, r.purchase_amount, r.reward_earned, r.status, r.created_at
+            FROM t_p37705306_strim_boom_project.referrals r
+            JOIN t_p37705306_strim_boom_project.users ru ON r.referred_user_id = ru.id
+            WHERE r.referrer_id = u.id
+            ORDER BY r.created_at DESC, r.id DESC
+            LIMIT $2
+        ) p ON TRUE
+        WHERE u.id = $1
+        ORDER BY p.created_at DESC, p.id DESC
+    """,
+    'referrals_page_after': """
+        SELECT r.id, r.referrer_id, r.referred_user_id, u.username, r.purchase_amount, r.reward_earned, r.status, r.created_at
+        FROM t_p37705306_strim_boom_project.referrals r
+        JOIN t_p37705306_strim_boom_project.users u ON r.referred_user_id = u.id
+        WHERE r.referrer_id = $1 AND (r.created_at, r.id) < ($2::timestamp, $3)
+        ORDER BY r.created_at DESC, r.id DESC
+        LIMIT $4
+    """,
+    # Строки пригласивших пакета блокируются отдельным запросом в порядке id до
+    # начисления: UPDATE ... FROM берёт блокировки в порядке плана, и пересекающиеся
+    # пачки иначе могут зачислять одним и тем же пользователям встречно. $1 id пригласивших.
+    'referrers_lock': """
+        SELECT id FROM t_p37705306_strim_boom_project.users
+        WHERE id = ANY($1::int[])
+        ORDER BY id
+        FOR UPDATE
+    """,
+    # Награда за все рефералы пакета, впервые достигшие порога, и обновление сводок:
+    # $1 id рефералов, $2 порог, $3 награда, $4..$6 — приросты сводки по пригласившим
+    # (id, новые рефералы, сумма покупок). Повторная проверка status = 'pending'
+    # под блокировкой строки исключает двойное начисление.
+    'referral_rewards': """
+        WITH rewarded AS (
+            UPDATE t_p37705306_strim_boom_project.referrals
+            SET status = 'rewarded', reward_earned = $3
+            WHERE id = ANY($1::int[]) AND status = 'pending' AND purchase_amount >= $2
+            RETURNING id, referrer_id
+        ), per_referrer AS (
+            SELECT referrer_id, COUNT(*) AS rewards
+            FROM rewarded
+            GROUP BY referrer_id
+        ), credited AS (
+            UPDATE t_p37705306_strim_boom_project.users u
+            SET boombucks = u.boombucks + p.rewards * $3
+            FROM per_referrer p
+            WHERE u.id = p.referrer_id
+            RETURNING u.id
+        ), logged AS (
+            INSERT INTO t_p37705306_strim_boom_project.transactions (user_id, type, amount, description, status, created_at)
+            SELECT referrer_id, 'referral_reward', $3, 'Referral reward', 'completed', CURRENT_TIMESTAMP
+            FROM rewarded
+            RETURNING id
+        ), ledger AS (
+            INSERT INTO t_p37705306_strim_boom_project.balance_ledger (user_id, delta, reason, ref_id)
+            SELECT referrer_id, $3, 'referral_reward', id
+            FROM rewarded
+            RETURNING id
+        ), stats AS (
+            INSERT INTO t_p37705306_strim_boom_project.referral_stats
+                (referrer_id, referred_count, purchase_total, reward_total, pending_count, updated_at)
+            SELECT d.referrer_id, d.referred, d.purchases, COALESCE(p.rewards, 0) * $3,
+                   d.referred - COALESCE(p.rewards, 0), CURRENT_TIMESTAMP
+            FROM unnest($4::int[], $5::int[], $6::bigint[]) AS d(referrer_id, referred, purchases)
+            LEFT JOIN per_referrer p ON p.referrer_id = d.referrer_id
+            ORDER BY d.referrer_id
+            ON CONFLICT (referrer_id) DO UPDATE
+            SET referred_count = referral_stats.referred_count + EXCLUDED.referred_count,
+                purchase_total = referral_stats.purchase_total + EXCLUDED.purchase_total,
+                reward_total = referral_stats.reward_total + EXCLUDED.reward_total,
+                pending_count = referral_stats.pending_count + EXCLUDED.pending_count,
+                updated_at = EXCLUDED.updated_at
+            RETURNING referrer_id
+        )
+        SELECT (SELECT COUNT(*) FROM logged), (SELECT COUNT(*) FROM credited), (SELECT COUNT(*) FROM stats)
+    """
+}
+
+REFERRAL_ENCODER = RowEncoder(
+    ('id', 'id'), ('referrerId', 'int'), ('referredUserId', 'int'), ('referredUsername', 'str'),
+    ('purchaseAmount', 'int'), ('rewardEarned', 'int'), ('status', 'str'), ('createdAt', 'ts')
+)
+
+def apply_referral_events(conn: Any, cur: Any, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Применяет пачку покупок рефералов за два запроса: upsert сумм через
+    INSERT ... ON CONFLICT и одно множественное начисление наград.
+    """
+    if not events or len(events) > REFERRAL_MAX_BATCH:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Batch must contain 1..{REFERRAL_MAX_BATCH} events'}),
+            'isBase64Encoded': False
+        }
+    
+    # ON CONFLICT не может дважды обновить одну строку в одном запросе, поэтому
+    # покупки одной пары складываются заранее; сортировка задаёт единый порядок блокировок
+    totals: Dict[Tuple[int, int], int] = {}
+    for index, item in enumerate(events):
+        referrer_id = item.get('referrer_id')
+        referred_user_id = item.get('referred_user_id')
+        if not referrer_id or not referred_user_id:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Missing referrer_id or referred_user_id in event {index}'}),
+                'isBase64Encoded': False
+            }
+        key = (int(referrer_id), int(referred_user_id))
+        totals[key] = totals.get(key, 0) + int(item.get('purchase_amount', 0))
+    values = [(referrer_id, referred_user_id, amount) for (referrer_id, referred_user_id), amount in sorted(totals.items())]
+    
+    conn.autocommit = False
+    rows = psycopg2.extras.execute_values(cur, """
+        INSERT INTO t_p37705306_strim_boom_project.referrals (referrer_id, referred_user_id, purchase_amount, status, created_at)
+        VALUES %s
+        ON CONFLICT (referrer_id, referred_user_id) DO UPDATE
+        SET purchase_amount = referrals.purchase_amount + EXCLUDED.purchase_amount
+        RETURNING id, referrer_id, (xmax = 0)
+    """, values, template="(%s, %s, %s, 'pending', CURRENT_TIMESTAMP)", page_size=len(values), fetch=True)
+    
+    # Приросты сводки: xmax = 0 у строк, которые были вставлены, а не обновлены
+    referred: Dict[int, int] = {}
+    purchases: Dict[int, int] = {}
+    for _, referrer_id, inserted in rows:
+        referred[referrer_id] = referred.get(referrer_id, 0) + (1 if inserted else 0)
+    for referrer_id, _, amount in values:
+        purchases[referrer_id] = purchases.get(referrer_id, 0) + amount
+    referrer_ids = sorted(referred)
+    
+    execute_prepared(cur, 'referrers_lock', (referrer_ids,))
+    execute_prepared(cur, 'referral_rewards', (
+        [row[0] for row in rows], REFERRAL_REWARD_THRESHOLD, REFERRAL_REWARD,
+        referrer_ids, [referred[r] for r in referrer_ids], [purchases[r] for r in referrer_ids]
+    ))
+    rewarded, credited_users, _ = cur.fetchone()
+    conn.commit()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'processed': len(events),
+            'referrals': len(rows),
+            'rewarded': rewarded,
+            'rewardedReferrers': credited_users
+        }),
+        'isBase64Encoded': False
+    }
+
+@instrument_handler('referrals')
+@compress_response
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление реферальной системой (получение рефералов, начисление наград)
-    Args: event с httpMethod, queryStringParameters (user_id), body
+    Args: event с httpMethod, queryStringParameters (user_id, limit, cursor), body (одна покупка или events[] для пакетной обработки)
     Returns: HTTP response со списком рефералов или обновлённым рефералом
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -29,16 +625,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    
     try:
-        conn = psycopg2.connect(database_url)
-        conn.autocommit = True
+        conn, db_timing = get_db_connection()
         cur = conn.cursor()
         
+        # Токен необязателен, но если передан — он должен быть действительным
+        auth_token = get_auth_token(event)
+        auth_user_id = verify_auth_token(cur, auth_token) if auth_token else None
+        if auth_token and auth_user_id is None:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid or expired token'}),
+                'isBase64Encoded': False
+            }
+        
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
-            user_id = params.get('user_id')
+            params = event.get('queryStringParameters') or {}
+            user_id = auth_user_id or params.get('user_id')
             
             if not user_id:
                 return {
@@ -48,49 +652,57 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                SELECT r.id, r.referrer_id, r.referred_user_id, u.username,
-                       r.purchase_amount, r.reward_earned, r.status, r.created_at
-                FROM t_p37705306_strim_boom_project.referrals r
-                JOIN t_p37705306_strim_boom_project.users u ON r.referred_user_id = u.id
-                WHERE r.referrer_id = {user_id}
-                ORDER BY r.created_at DESC
-            """)
+            user_id = int(user_id)
+            limit = max(1, min(int(params.get('limit', REFERRALS_PAGE_SIZE)), REFERRALS_MAX_PAGE_SIZE))
+            cursor = params.get('cursor')
+            
+            # Keyset-пагинация по индексу (referrer_id, created_at DESC, id DESC);
+            # первая страница приходит одним запросом вместе с кодом и сводкой
+            summary = None
+            referral_code = None
+            if cursor:
+                cursor_created_at, cursor_id = cursor.rsplit('_', 1)
+                execute_prepared(cur, 'referrals_page_after', (user_id, cursor_created_at, int(cursor_id), limit + 1))
+                rows = cur.fetchall()
+            else:
+                execute_prepared(cur, 'referrals_first_page', (user_id, limit + 1))
+                first_rows = cur.fetchall()
+                if first_rows:
+                    head = first_rows[0]
+                    referral_code = head[0]
+                    summary = {
+                        'totalReferred': head[1],
+                        'totalPurchases': head[2],
+                        'totalRewards': head[3],
+                        'pendingCount': head[4]
+                    }
+                rows = [row[5:] for row in first_rows if row[5] is not None]
             
-            referrals = []
-            for row in cur.fetchall():
-                referrals.append({
-                    'id': str(row[0]),
-                    'referrerId': row[1],
-                    'referredUserId': row[2],
-                    'referredUsername': row[3],
-                    'purchaseAmount': row[4],
-                    'rewardEarned': row[5],
-                    'status': row[6],
-                    'createdAt': row[7].isoformat() if row[7] else None
-                })
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = f"{rows[-1][7].isoformat()}_{rows[-1][0]}"
             
-            cur.execute(f"SELECT referral_code FROM t_p37705306_strim_boom_project.users WHERE id = {user_id}")
-            referral_code_row = cur.fetchone()
-            referral_code = referral_code_row[0] if referral_code_row else None
+            response_body = {'referrals': REFERRAL_ENCODER.encode(rows), 'nextCursor': next_cursor}
+            if not cursor:
+                response_body['referralCode'] = referral_code
+                response_body['summary'] = summary or {
+                    'totalReferred': 0, 'totalPurchases': 0, 'totalRewards': 0, 'pendingCount': 0
+                }
             
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'referrals': referrals,
-                    'referralCode': referral_code
-                }),
+                'body': dumps_body(response_body),
                 'isBase64Encoded': False
             }
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
-            referrer_id = body_data.get('referrer_id')
-            referred_user_id = body_data.get('referred_user_id')
-            purchase_amount = body_data.get('purchase_amount', 0)
+            if 'events' in body_data:
+                return apply_referral_events(conn, cur, body_data['events'])
             
-            if not referrer_id or not referred_user_id:
+            if not body_data.get('referrer_id') or not body_data.get('referred_user_id'):
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -98,57 +710,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(f"""
-                SELECT id, purchase_amount, reward_earned, status
-                FROM t_p37705306_strim_boom_project.referrals
-                WHERE referrer_id = {referrer_id} AND referred_user_id = {referred_user_id}
-            """)
-            existing = cur.fetchone()
-            
-            if existing:
-                new_purchase = existing[1] + purchase_amount
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.referrals
-                    SET purchase_amount = {new_purchase}
-                    WHERE referrer_id = {referrer_id} AND referred_user_id = {referred_user_id}
-                    RETURNING id, purchase_amount, reward_earned, status
-                """)
-                row = cur.fetchone()
-            else:
-                cur.execute(f"""
-                    INSERT INTO t_p37705306_strim_boom_project.referrals (referrer_id, referred_user_id, purchase_amount, status, created_at)
-                    VALUES ({referrer_id}, {referred_user_id}, {purchase_amount}, 'pending', CURRENT_TIMESTAMP)
-                    RETURNING id, purchase_amount, reward_earned, status
-                """)
-                row = cur.fetchone()
-            
-            total_purchase = row[1]
-            status = row[3]
-            
-            if total_purchase >= 3 and status == 'pending':
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.referrals
-                    SET status = 'rewarded', reward_earned = 1
-                    WHERE referrer_id = {referrer_id} AND referred_user_id = {referred_user_id}
-                """)
-                
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.users
-                    SET boombucks = boombucks + 1
-                    WHERE id = {referrer_id}
-                """)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p37705306_strim_boom_project.transactions (user_id, type, amount, description, status, created_at)
-                    VALUES ({referrer_id}, 'referral_reward', 1, 'Referral reward', 'completed', CURRENT_TIMESTAMP)
-                """)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
+            return apply_referral_events(conn, cur, [body_data])
         
         return {
             'statusCode': 400,
@@ -168,4 +730,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+            note_db_timing(db_timing)
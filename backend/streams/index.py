@@ -1,18 +1,726 @@
 import json
+import hashlib
 import os
+import time
+import threading
+import bisect
+import functools
+import random
+import base64
+import gzip
 import secrets
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
 
-def escape_sql_string(s: str) -> str:
-    """Экранирует строки для безопасного использования в SQL"""
-    return s.replace("'", "''")
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            # Ожидание long-poll (фаза wait) не делает запрос медленным
+            if total_ms - timing.phases.get('wait', 0.0) >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', '16'))
+
+_compressed_cache: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+class CachedBody(str):
+    """Тело ответа из кэша контейнера: его сжатые формы тоже кэшируются"""
+
+def accepted_encoding(event: Dict[str, Any]) -> Optional[str]:
+    """Лучшее поддерживаемое кодирование из Accept-Encoding (br, затем gzip); q=0 запрещает"""
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    weights: Dict[str, float] = {}
+    for part in headers.get('accept-encoding', '').split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        if params.strip().startswith('q='):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best = max(supported, key=lambda name: weights.get(name, weights.get('*', 0.0)))
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+def compress_body(body: str, encoding: str) -> str:
+    """Сжатое тело в base64 для шлюза"""
+    data = body.encode('utf-8')
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    return base64.b64encode(compressed).decode('ascii')
+
+def compress_response(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+    """
+    Сжимает тело ответа длиннее COMPRESS_MIN_BYTES по Accept-Encoding клиента и отдаёт
+    его шлюзу в base64. Сжатые формы CachedBody кэшируются, остальные сжимаются заново.
+    """
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = handler(event, context)
+        body = response.get('body')
+        if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES:
+            return response
+        headers = dict(response.get('headers') or {})
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = accepted_encoding(event)
+        if encoding is None:
+            return {**response, 'headers': headers}
+        
+        started = time.perf_counter()
+        key = (encoding, body)
+        encoded = None
+        if isinstance(body, CachedBody):
+            with _compressed_cache_lock:
+                encoded = _compressed_cache.get(key)
+                if encoded is not None:
+                    _compressed_cache.move_to_end(key)
+        if encoded is None:
+            encoded = compress_body(body, encoding)
+            if isinstance(body, CachedBody):
+                with _compressed_cache_lock:
+                    _compressed_cache[key] = encoded
+                    while len(_compressed_cache) > COMPRESS_CACHE_SIZE:
+                        _compressed_cache.popitem(last=False)
+        record_timing('compress', started)
+        
+        headers['Content-Encoding'] = encoding
+        return {**response, 'headers': headers, 'body': encoded, 'isBase64Encoded': True}
+    return wrapper
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+
+_db_pool: List[Tuple[Any, float]] = []
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> Tuple[Any, Dict[str, Any]]:
+    """Берёт тёплое соединение из пула контейнера или открывает новое"""
+    started = time.perf_counter()
+    while True:
+        with _db_pool_lock:
+            item = _db_pool.pop() if _db_pool else None
+        if item is None:
+            break
+        conn, released_at = item
+        if conn.closed:
+            continue
+        if time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SEC:
+            try:
+                with conn.cursor() as check_cur:
+                    check_cur.execute('SELECT 1')
+            except psycopg2.Error:
+                conn.close()
+                continue
+        record_timing('db_connect', started)
+        return conn, {'reused': True, 'connect_ms': (time.perf_counter() - started) * 1000}
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=PooledConnection)
+    conn.autocommit = True
+    record_timing('db_connect', started)
+    return conn, {'reused': False, 'connect_ms': (time.perf_counter() - started) * 1000}
+
+def release_db_connection(conn: Any) -> None:
+    """Возвращает соединение в пул; битые и лишние соединения закрываются"""
+    if conn.closed:
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def statement_metric(query: Any) -> str:
+    """Имя метрики для запроса: q_<имя> для EXECUTE подготовленного запроса"""
+    head = (query[:80].decode('utf-8', errors='replace') if isinstance(query, bytes) else query[:80]).split()
+    if head[:1] == ['EXECUTE']:
+        return f'q_{head[1]}'
+    if head[:1] == ['PREPARE']:
+        return 'db_prepare'
+    return 'db_sql'
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, который записывает время запросов и разбора строк в фазы текущего запроса"""
+    def execute(self, query: Any, vars: Any = None) -> None:
+        started = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            record_timing(statement_metric(query), started)
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_timing('db_decode', started)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_timing('db_decode', started)
+        return rows
+
+    def fetchall(self) -> List[Tuple]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_timing('db_decode', started)
+        return rows
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит подготовленные на нём запросы"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.cursor_factory = TimedCursor
+
+_stmt_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+def execute_prepared(cur: Any, name: str, params: Tuple = ()) -> None:
+    """Выполняет запрос из PREPARED_STATEMENTS; PREPARE делается один раз на соединение"""
+    conn = cur.connection
+    if name in conn.prepared:
+        _stmt_stats['hits'] += 1
+    else:
+        cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared.add(name)
+        _stmt_stats['misses'] += 1
+    if params:
+        cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def note_db_timing(db_timing: Dict[str, Any]) -> None:
+    """Добавляет в лог запроса сведения о соединении и кэше подготовленных запросов"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields.update({
+            'db_reused': db_timing['reused'],
+            'stmt_cache_hits': _stmt_stats['hits'],
+            'stmt_cache_misses': _stmt_stats['misses']
+        })
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SEC = float(os.environ.get('SESSION_CACHE_TTL_SEC', '60'))
+
+_session_cache: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def get_auth_token(event: Dict[str, Any]) -> Optional[str]:
+    """Достаёт X-Auth-Token из заголовков запроса"""
+    headers = event.get('headers') or {}
+    return headers.get('X-Auth-Token') or headers.get('x-auth-token')
+
+def verify_auth_token(cur: Any, token: str) -> Optional[int]:
+    """
+    Возвращает user_id сессии или None. Проверенные токены живут в LRU-кэше
+    контейнера не дольше SESSION_CACHE_TTL_SEC — это и есть окно отзыва.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > now:
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+    
+    execute_prepared(cur, 'verify_session', (token_hash,))
+    row = cur.fetchone()
+    
+    with _session_cache_lock:
+        if not row:
+            _session_cache.pop(token_hash, None)
+            return None
+        _session_cache[token_hash] = (row[0], now + min(SESSION_CACHE_TTL_SEC, float(row[1])))
+        _session_cache.move_to_end(token_hash)
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return row[0]
+
+_escape_json_string = json.encoder.encode_basestring_ascii
+
+class RawJson(str):
+    """Уже закодированный JSON-фрагмент: dumps_body вставляет его как есть"""
+
+def dumps_json(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def dumps_body(fields: Dict[str, Any]) -> str:
+    """Собирает JSON-объект ответа без повторного кодирования RawJson-значений"""
+    started = time.perf_counter()
+    body = '{' + ','.join(
+        f'{_escape_json_string(key)}:{value if isinstance(value, RawJson) else dumps_json(value)}'
+        for key, value in fields.items()
+    ) + '}'
+    record_timing('serialize', started)
+    return body
+
+# Выражения для значения колонки r[i]: для json.dumps-совместимого текста и для orjson
+_JSON_COLUMN_TEXT = {
+    'int': "('null' if r[{i}] is None else str(r[{i}]))",
+    'bool': "('null' if r[{i}] is None else 'true' if r[{i}] else 'false')",
+    'id': "('null' if r[{i}] is None else '\"' + str(r[{i}]) + '\"')",
+    'str': "('null' if r[{i}] is None else esc(r[{i}]))",
+    'ts': "('null' if r[{i}] is None else '\"' + r[{i}].isoformat() + '\"')",
+    'json': "dumps(r[{i}])"
+}
+_JSON_COLUMN_VALUE = {
+    'int': "r[{i}]",
+    'bool': "r[{i}]",
+    'id': "(None if r[{i}] is None else str(r[{i}]))",
+    'str': "r[{i}]",
+    'ts': "r[{i}]",
+    'json': "r[{i}]"
+}
+
+class RowEncoder:
+    """
+    Кодирует строки результата в JSON-массив объектов по схеме колонок (ключ, тип):
+    int, bool, id (число строкой), str, ts (datetime в ISO 8601), json (любое значение);
+    колонка с ключом None пропускается. Выражение для строки собирается один раз,
+    без промежуточных словарей; с orjson словари строятся, но кодирует их orjson.
+    """
+    def __init__(self, *columns: Tuple[Optional[str], str]) -> None:
+        self.columns = columns
+        self.backend = orjson
+        fields = [(i, key, kind) for i, (key, kind) in enumerate(columns) if key is not None]
+        if orjson is not None:
+            source = 'lambda r: {' + ', '.join(
+                f'{key!r}: {_JSON_COLUMN_VALUE[kind].format(i=i)}' for i, key, kind in fields
+            ) + '}'
+        else:
+            source = "lambda r: '{' + " + " + ',' + ".join(
+                f'{_escape_json_string(key) + ":"!r} + {_JSON_COLUMN_TEXT[kind].format(i=i)}' for i, key, kind in fields
+            ) + " + '}'"
+        self.encode_row: Callable[[Tuple], Any] = eval(source, {'esc': _escape_json_string, 'dumps': dumps_json})
+
+    def encode(self, rows: List[Tuple]) -> RawJson:
+        started = time.perf_counter()
+        if self.backend is not None:
+            encoded = RawJson(self.backend.dumps(list(map(self.encode_row, rows))).decode())
+        else:
+            encoded = RawJson('[' + ','.join(map(self.encode_row, rows)) + ']')
+        record_timing('serialize', started)
+        return encoded
+
+# Условные GET: ETag строится из дешёвого токена версии, совпадение отдаёт 304 без основного запроса
+_etag_stats: Dict[str, List[int]] = {}
+_etag_stats_lock = threading.Lock()
+
+def make_etag(*parts: Any) -> str:
+    """Слабый ETag: тело может уйти в разных Content-Encoding, а версия у них одна"""
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    return etag.removeprefix('W/') in [tag.strip().removeprefix('W/') for tag in headers.get('if-none-match', '').split(',')]
+
+def conditional_response(event: Dict[str, Any], route: str, etag: Optional[str]) -> Optional[Dict[str, Any]]:
+    """304, если If-None-Match содержит etag; иначе None. Попадания считаются по маршруту"""
+    if etag is None:
+        return None
+    hit = etag_matches(event, etag)
+    with _etag_stats_lock:
+        stats = _etag_stats.setdefault(route, [0, 0])
+        stats[0] += 1
+        stats[1] += hit
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.fields['etag'] = 'hit' if hit else 'miss'
+    if not hit:
+        return None
+    return {
+        'statusCode': 304,
+        'headers': {'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def with_etag(response: Dict[str, Any], etag: Optional[str]) -> Dict[str, Any]:
+    """Добавляет ETag к ответу 200; no-cache заставляет браузер перепроверять версию на каждом опросе"""
+    if etag is not None:
+        response['headers'] = {**response['headers'], 'ETag': etag, 'Cache-Control': 'no-cache'}
+    return response
+
+def etag_stats() -> Dict[str, Any]:
+    """Доля ответов 304 по маршрутам с начала жизни контейнера"""
+    with _etag_stats_lock:
+        return {
+            route: {'requests': requests, 'notModified': hits, 'hitRate': round(hits / requests, 3) if requests else 0.0}
+            for route, (requests, hits) in _etag_stats.items()
+        }
+
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'verify_session': """
+        SELECT user_id, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP))
+        FROM t_p37705306_strim_boom_project.sessions
+        WHERE token_hash = $1 AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """,
+    'streams_page': """
+        SELECT s.id, s.title, s.description, s.thumbnail, s.category, 
+               s.is_live, s.viewers_count, s.tts_enabled, s.tts_voice,
+               u.username, u.avatar
+        FROM t_p37705306_strim_boom_project.streams s
+        JOIN t_p37705306_strim_boom_project.users u ON s.user_id = u.id
+        WHERE s.is_live = true AND (s.viewers_count, s.id) < ($1, $2)
+        ORDER BY s.viewers_count DESC, s.id DESC
+        LIMIT $3
+    """,
+    'streams_category_page': """
+        SELECT s.id, s.title, s.description, s.thumbnail, s.category, 
+               s.is_live, s.viewers_count, s.tts_enabled, s.tts_voice,
+               u.username, u.avatar
+        FROM t_p37705306_strim_boom_project.streams s
+        JOIN t_p37705306_strim_boom_project.users u ON s.user_id = u.id
+        WHERE s.is_live = true AND s.category = $1 AND (s.viewers_count, s.id) < ($2, $3)
+        ORDER BY s.viewers_count DESC, s.id DESC
+        LIMIT $4
+    """,
+    'streams_search_page': """
+        SELECT s.id, s.title, s.description, s.thumbnail, s.category, 
+               s.is_live, s.viewers_count, s.tts_enabled, s.tts_voice,
+               u.username, u.avatar
+        FROM t_p37705306_strim_boom_project.streams s
+        JOIN t_p37705306_strim_boom_project.users u ON s.user_id = u.id
+        WHERE s.is_live = true
+          AND (s.search_vector @@ plainto_tsquery('russian', $1) OR s.search_text LIKE $2)
+          AND ($3::text IS NULL OR s.category = $3)
+          AND (s.viewers_count, s.id) < ($4, $5)
+        ORDER BY s.viewers_count DESC, s.id DESC
+        LIMIT $6
+    """,
+    'stream_create': """
+        INSERT INTO t_p37705306_strim_boom_project.streams 
+        (user_id, title, description, thumbnail, category, is_live, stream_key, started_at, viewers_count)
+        VALUES ($1, $2, $3, $4, $5, true, $6, CURRENT_TIMESTAMP, 0)
+        RETURNING id, title, description, thumbnail, category, is_live, viewers_count, stream_key
+    """,
+    'stream_stop': """
+        UPDATE t_p37705306_strim_boom_project.streams 
+        SET is_live = false, ended_at = CURRENT_TIMESTAMP
+        WHERE id = $1
+    """
+}
+
+STREAMS_CACHE_TTL_SEC = float(os.environ.get('STREAMS_CACHE_TTL_SEC', '5'))
+STREAMS_CACHE_STALE_SEC = float(os.environ.get('STREAMS_CACHE_STALE_SEC', '30'))
+
+_streams_cache: Dict[str, Any] = {'body': None, 'etag': None, 'expires_at': 0.0, 'stale_until': 0.0, 'generation': 0}
+_streams_cache_lock = threading.Lock()
+_streams_refresh_lock = threading.Lock()
+
+STREAM_ENCODER = RowEncoder(
+    ('id', 'int'), ('title', 'str'), ('description', 'str'), ('thumbnail', 'str'), ('category', 'str'),
+    ('isLive', 'bool'), ('viewers', 'int'), ('ttsEnabled', 'bool'), ('ttsVoice', 'str'),
+    ('username', 'str'), ('avatar', 'str')
+)
+
+STREAMS_PAGE_SIZE = 50
+STREAMS_MAX_PAGE_SIZE = 100
+STREAMS_CURSOR_START = 2 ** 31 - 1
+
+def parse_stream_cursor(cursor: Optional[str]) -> Tuple[int, int]:
+    """Курсор viewers_id в пару (viewers, id); ValueError, если он не разбирается"""
+    if not cursor:
+        return STREAMS_CURSOR_START, STREAMS_CURSOR_START
+    viewers, last_id = cursor.split('_')
+    return int(viewers), int(last_id)
+
+def load_stream_page(cur: Any, category: Optional[str], query: str, after: Tuple[int, int], limit: int) -> str:
+    """
+    Страница живых стримов по убыванию зрителей. Курсор — viewers_id последнего
+    стрима страницы; поиск идёт по полнотекстовому индексу и по подстроке (триграммы)
+    """
+    viewers, last_id = after
+    if query:
+        pattern = '%' + query.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        execute_prepared(cur, 'streams_search_page', (query, pattern, category, viewers, last_id, limit + 1))
+    elif category:
+        execute_prepared(cur, 'streams_category_page', (category, viewers, last_id, limit + 1))
+    else:
+        execute_prepared(cur, 'streams_page', (viewers, last_id, limit + 1))
+    rows = cur.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1][6]}_{rows[-1][0]}"
+    return dumps_body({'streams': STREAM_ENCODER.encode(rows), 'nextCursor': next_cursor})
+
+def load_stream_directory(cur: Any) -> str:
+    """Читает первую страницу каталога живых стримов из БД и сериализует её в JSON"""
+    return load_stream_page(cur, None, '', parse_stream_cursor(None), STREAMS_PAGE_SIZE)
+
+def fresh_directory_etag() -> Optional[str]:
+    """ETag кэшированного каталога, пока кэш свежий; иначе None"""
+    with _streams_cache_lock:
+        if _streams_cache['body'] is not None and time.monotonic() < _streams_cache['expires_at']:
+            return _streams_cache['etag']
+    return None
+
+def get_stream_directory(cur: Any) -> Tuple[str, str]:
+    """
+    Отдаёт каталог и его ETag из кэша контейнера. Устаревший (но не протухший)
+    ответ отдаётся сразу, а обновляет его только один запрос на контейнер.
+    """
+    now = time.monotonic()
+    with _streams_cache_lock:
+        body, etag = _streams_cache['body'], _streams_cache['etag']
+        if body is not None and now < _streams_cache['expires_at']:
+            return body, etag
+        serve_stale = body is not None and now < _streams_cache['stale_until']
+    
+    if not _streams_refresh_lock.acquire(blocking=not serve_stale):
+        return body, etag
+    try:
+        with _streams_cache_lock:
+            if _streams_cache['body'] is not None and time.monotonic() < _streams_cache['expires_at']:
+                return _streams_cache['body'], _streams_cache['etag']
+            generation = _streams_cache['generation']
+        
+        body = CachedBody(load_stream_directory(cur))
+        # ETag по содержимому: если каталог после обновления не изменился, клиент получит 304
+        etag = make_etag('streams', hashlib.sha1(body.encode('utf-8')).hexdigest()[:20])
+        
+        with _streams_cache_lock:
+            # Инвалидация во время запроса делает прочитанные данные недостоверными
+            if _streams_cache['generation'] == generation:
+                refreshed_at = time.monotonic()
+                _streams_cache['body'] = body
+                _streams_cache['etag'] = etag
+                _streams_cache['expires_at'] = refreshed_at + STREAMS_CACHE_TTL_SEC
+                _streams_cache['stale_until'] = refreshed_at + STREAMS_CACHE_STALE_SEC
+        return body, etag
+    finally:
+        _streams_refresh_lock.release()
+
+def invalidate_stream_directory() -> None:
+    """Сбрасывает кэш каталога после создания или остановки стрима"""
+    with _streams_cache_lock:
+        _streams_cache['body'] = None
+        _streams_cache['etag'] = None
+        _streams_cache['expires_at'] = 0.0
+        _streams_cache['stale_until'] = 0.0
+        _streams_cache['generation'] += 1
+
+VIEWERS_FLUSH_INTERVAL_SEC = float(os.environ.get('VIEWERS_FLUSH_INTERVAL_SEC', '2'))
+VIEWERS_FLUSH_MAX_LATENCY_SEC = float(os.environ.get('VIEWERS_FLUSH_MAX_LATENCY_SEC', '5'))
+
+_viewers_dirty: Dict[int, int] = {}
+_viewers_dirty_since: Dict[str, Any] = {'at': None}
+_viewers_lock = threading.Lock()
+_viewers_flush_lock = threading.Lock()
+_viewers_flusher_lock = threading.Lock()
+_viewers_flusher_thread = None
+
+def buffer_viewer_count(stream_id: int, viewers_count: int) -> bool:
+    """
+    Запоминает последний пульс зрителей стрима в памяти контейнера.
+    Возвращает True, если буфер ждёт дольше допустимой задержки и его
+    нужно сбросить прямо в запросе (фоновый поток мог быть заморожен).
+    """
+    ensure_viewers_flusher()
+    now = time.monotonic()
+    with _viewers_lock:
+        _viewers_dirty[stream_id] = viewers_count
+        if _viewers_dirty_since['at'] is None:
+            _viewers_dirty_since['at'] = now
+        return now - _viewers_dirty_since['at'] >= VIEWERS_FLUSH_MAX_LATENCY_SEC
+
+def flush_viewer_counts(cur: Any) -> int:
+    """Пишет все накопленные счётчики одним UPDATE ... FROM (VALUES ...)"""
+    global _viewers_dirty
+    with _viewers_flush_lock:
+        with _viewers_lock:
+            if not _viewers_dirty:
+                return 0
+            batch = _viewers_dirty
+            _viewers_dirty = {}
+            _viewers_dirty_since['at'] = None
+        
+        started = time.perf_counter()
+        try:
+            # Сортировка по id даёт одинаковый порядок блокировок во всех контейнерах
+            psycopg2.extras.execute_values(cur, """
+                UPDATE t_p37705306_strim_boom_project.streams AS s
+                SET viewers_count = v.viewers_count
+                FROM (VALUES %s) AS v(id, viewers_count)
+                WHERE s.id = v.id
+            """, sorted(batch.items()), page_size=len(batch))
+        except Exception:
+            with _viewers_lock:
+                for stream_id, viewers_count in batch.items():
+                    _viewers_dirty.setdefault(stream_id, viewers_count)
+                if _viewers_dirty_since['at'] is None:
+                    _viewers_dirty_since['at'] = time.monotonic()
+            raise
+        
+        print(json.dumps({
+            'fn': 'streams',
+            'viewers_flushed': len(batch),
+            'viewers_flush_ms': round((time.perf_counter() - started) * 1000, 2)
+        }))
+        return len(batch)
+
+def _viewers_flusher_loop() -> None:
+    """Периодически сбрасывает буфер пульсов через соединение из пула"""
+    while True:
+        time.sleep(VIEWERS_FLUSH_INTERVAL_SEC)
+        if not _viewers_dirty:
+            continue
+        try:
+            conn, _ = get_db_connection()
+        except psycopg2.Error:
+            continue
+        try:
+            with conn.cursor() as flush_cur:
+                flush_viewer_counts(flush_cur)
+        except psycopg2.Error:
+            pass
+        finally:
+            release_db_connection(conn)
+
+def ensure_viewers_flusher() -> None:
+    """Запускает фоновый сброс пульсов, если он ещё не работает"""
+    global _viewers_flusher_thread
+    with _viewers_flusher_lock:
+        if _viewers_flusher_thread is None or not _viewers_flusher_thread.is_alive():
+            _viewers_flusher_thread = threading.Thread(target=_viewers_flusher_loop, daemon=True)
+            _viewers_flusher_thread.start()
+
+@instrument_handler('streams')
+@compress_response
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление стримами (создание, список, обновление)
-    Args: event с httpMethod, queryStringParameters, body
+    Args: event с httpMethod, queryStringParameters (category, q, cursor, limit, view=etag), body
     Returns: HTTP response со списком стримов или данными стрима
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -30,51 +738,71 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    
     try:
-        conn = psycopg2.connect(database_url)
-        conn.autocommit = True
-        cur = conn.cursor()
-        
         if method == 'GET':
-            cur.execute("""
-                SELECT s.id, s.title, s.description, s.thumbnail, s.category, 
-                       s.is_live, s.viewers_count, s.tts_enabled, s.tts_voice,
-                       u.username, u.avatar
-                FROM t_p37705306_strim_boom_project.streams s
-                JOIN t_p37705306_strim_boom_project.users u ON s.user_id = u.id
-                WHERE s.is_live = true
-                ORDER BY s.viewers_count DESC
-                LIMIT 50
-            """)
+            params = event.get('queryStringParameters') or {}
+            if params.get('view') == 'etag':
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'etag': etag_stats()}),
+                    'isBase64Encoded': False
+                }
             
-            streams = []
-            for row in cur.fetchall():
-                streams.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'description': row[2],
-                    'thumbnail': row[3],
-                    'category': row[4],
-                    'isLive': row[5],
-                    'viewers': row[6],
-                    'ttsEnabled': row[7],
-                    'ttsVoice': row[8],
-                    'username': row[9],
-                    'avatar': row[10]
-                })
+            category = params.get('category') or None
+            query = (params.get('q') or '').strip()
+            cursor = params.get('cursor')
+            try:
+                limit = max(1, min(int(params.get('limit', STREAMS_PAGE_SIZE)), STREAMS_MAX_PAGE_SIZE))
+                after = parse_stream_cursor(cursor)
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid limit or cursor'}),
+                    'isBase64Encoded': False
+                }
             
+            # Первая страница без фильтров — горячий путь: при свежем кэше 304 отдаётся без соединения с БД
+            is_directory = not (category or query or cursor or limit != STREAMS_PAGE_SIZE)
+            etag = fresh_directory_etag() if is_directory else None
+            if etag is not None and etag_matches(event, etag):
+                return conditional_response(event, 'directory', etag)
+        
+        conn, db_timing = get_db_connection()
+        cur = conn.cursor()
+        
+        # Токен необязателен, но если передан — он должен быть действительным
+        auth_token = get_auth_token(event)
+        auth_user_id = verify_auth_token(cur, auth_token) if auth_token else None
+        if auth_token and auth_user_id is None:
             return {
-                'statusCode': 200,
+                'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'streams': streams}),
+                'body': json.dumps({'error': 'Invalid or expired token'}),
                 'isBase64Encoded': False
             }
         
+        if method == 'GET':
+            if not is_directory:
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': load_stream_page(cur, category, query, after, limit),
+                    'isBase64Encoded': False
+                }
+            
+            body, etag = get_stream_directory(cur)
+            return conditional_response(event, 'directory', etag) or with_etag({
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': body,
+                'isBase64Encoded': False
+            }, etag)
+        
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
-            user_id = body_data.get('user_id')
+            user_id = auth_user_id or body_data.get('user_id')
             title = body_data.get('title')
             category = body_data.get('category', 'Другое')
             description = body_data.get('description', '')
@@ -88,20 +816,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            title = escape_sql_string(title)
-            description = escape_sql_string(description)
-            category = escape_sql_string(category)
-            thumbnail = escape_sql_string(thumbnail)
             stream_key = secrets.token_urlsafe(32)
             
-            cur.execute(f"""
-                INSERT INTO t_p37705306_strim_boom_project.streams 
-                (user_id, title, description, thumbnail, category, is_live, stream_key, started_at, viewers_count)
-                VALUES ({user_id}, '{title}', '{description}', '{thumbnail}', '{category}', true, '{stream_key}', CURRENT_TIMESTAMP, 0)
-                RETURNING id, title, description, thumbnail, category, is_live, viewers_count, stream_key
-            """)
+            execute_prepared(cur, 'stream_create', (int(user_id), title, description, thumbnail, category, stream_key))
             
             stream = cur.fetchone()
+            invalidate_stream_directory()
             
             return {
                 'statusCode': 200,
@@ -127,11 +847,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             action = body_data.get('action')
             
             if action == 'stop':
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.streams 
-                    SET is_live = false, ended_at = CURRENT_TIMESTAMP
-                    WHERE id = {stream_id}
-                """)
+                execute_prepared(cur, 'stream_stop', (int(stream_id),))
+                invalidate_stream_directory()
                 
                 return {
                     'statusCode': 200,
@@ -141,12 +858,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             elif action == 'update_viewers':
+                # Пульсы копятся в памяти и пишутся пачкой; кэш каталога они не сбрасывают
                 viewers_count = body_data.get('viewers_count', 0)
-                cur.execute(f"""
-                    UPDATE t_p37705306_strim_boom_project.streams 
-                    SET viewers_count = {viewers_count}
-                    WHERE id = {stream_id}
-                """)
+                if buffer_viewer_count(int(stream_id), int(viewers_count)):
+                    flush_viewer_counts(cur)
                 
                 return {
                     'statusCode': 200,
@@ -173,4 +888,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+            note_db_timing(db_timing)
@@ -1,101 +1,558 @@
 import json
 import os
+import io
+import re
 import base64
 import hashlib
-import mimetypes
-from typing import Dict, Any
-from datetime import datetime
+import tempfile
+import threading
+import time
+import bisect
+import functools
+import random
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
+TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER', '1') == '1'
+TIMING_LOG_SAMPLE_RATE = float(os.environ.get('TIMING_LOG_SAMPLE_RATE', '1'))
+TIMING_SLOW_MS = float(os.environ.get('TIMING_SLOW_MS', '1000'))
+TIMING_HISTOGRAM_LOG_SEC = float(os.environ.get('TIMING_HISTOGRAM_LOG_SEC', '60'))
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_timing = threading.local()
+_timing_histograms: Dict[str, List[int]] = {}
+_timing_lock = threading.Lock()
+_timing_logged_at = time.monotonic()
+
+class RequestTiming:
+    """Фазы одного вызова handler(): имя метрики Server-Timing -> миллисекунды"""
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, name: str, ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.phases.items())
+
+def record_timing(name: str, started: float) -> None:
+    """Добавляет время с момента started к фазе текущего запроса"""
+    timing = getattr(_request_timing, 'current', None)
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - started) * 1000)
+
+def histogram_percentile(counts: List[int], pct: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попадает перцентиль; None — за последней границей"""
+    rank = sum(counts) * pct / 100
+    seen = 0
+    for bound, count in zip(TIMING_BUCKETS_MS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def observe_timing(function_name: str, timing: RequestTiming) -> None:
+    """Складывает фазы в гистограммы контейнера и раз в TIMING_HISTOGRAM_LOG_SEC пишет их сводку"""
+    global _timing_logged_at
+    with _timing_lock:
+        for name, ms in timing.phases.items():
+            counts = _timing_histograms.setdefault(name, [0] * (len(TIMING_BUCKETS_MS) + 1))
+            counts[bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+        now = time.monotonic()
+        if now - _timing_logged_at < TIMING_HISTOGRAM_LOG_SEC:
+            return
+        _timing_logged_at = now
+        histograms = {name: list(counts) for name, counts in _timing_histograms.items()}
+    print(json.dumps({
+        'fn': function_name,
+        'bucket_le_ms': TIMING_BUCKETS_MS,
+        'histograms': {
+            name: {
+                'count': sum(counts),
+                'p50_le_ms': histogram_percentile(counts, 50),
+                'p95_le_ms': histogram_percentile(counts, 95),
+                'p99_le_ms': histogram_percentile(counts, 99),
+                'buckets': counts
+            }
+            for name, counts in histograms.items()
+        }
+    }))
+
+def instrument_handler(function_name: str) -> Callable:
+    """
+    Оборачивает handler(): фазы запроса (подключение, запросы, разбор строк,
+    сериализация, итог) отдаются в Server-Timing, пишутся в лог с семплированием
+    (медленные запросы — всегда) и копятся в гистограммах контейнера.
+    """
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            timing = RequestTiming()
+            _request_timing.current = timing
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                _request_timing.current = None
+            total_ms = (time.perf_counter() - started) * 1000
+            timing.add('total', total_ms)
+            
+            if TIMING_HEADER_ENABLED:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = timing.header()
+                headers['Timing-Allow-Origin'] = '*'
+                exposed = headers.get('Access-Control-Expose-Headers')
+                headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+                response['headers'] = headers
+            
+            if total_ms >= TIMING_SLOW_MS or random.random() < TIMING_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'fn': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': response.get('statusCode'),
+                    **timing.fields,
+                    'phases_ms': {name: round(ms, 2) for name, ms in timing.phases.items()}
+                }))
+            observe_timing(function_name, timing)
+            return response
+        return wrapper
+    return decorate
+
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+
+UPLOAD_STORAGE_DIR = os.environ.get('UPLOAD_STORAGE_DIR')
+UPLOAD_PUBLIC_URL = os.environ.get('UPLOAD_PUBLIC_URL', '').rstrip('/')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+VARIANT_SIZES = (48, 128, 512)
+VARIANT_QUALITY = 80
+RESIZE_WORKERS = int(os.environ.get('RESIZE_WORKERS', '2'))
+HASH_PATTERN = re.compile(r'[0-9a-f]{64}')
+ORIGINAL_EXTENSIONS = ('.png', '.jpg', '.gif', '.webp')
+
+# Хеши, которые этот контейнер уже видел в хранилище: повтор не делает даже HEAD
+_known_keys: Dict[str, str] = {}
+_known_keys_lock = threading.Lock()
+_s3_client = None
+
+# Ресайз идёт в отдельных процессах, чтобы не держать GIL и не задерживать ответ
+_resize_pool: Optional[ProcessPoolExecutor] = None
+_resize_pool_lock = threading.Lock()
+_pending_variants: Dict[str, Optional[Future]] = {}
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png', 'image/png'),
+    (b'\xff\xd8\xff', '.jpg', 'image/jpeg'),
+    (b'GIF87a', '.gif', 'image/gif'),
+    (b'GIF89a', '.gif', 'image/gif'),
+)
+
+class ImageTooLarge(Exception):
+    pass
+
+class HashingSpool:
+    """Пишет байты во временный файл, на лету считая SHA-256 и размер"""
+    def __init__(self) -> None:
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > MAX_IMAGE_SIZE:
+            raise ImageTooLarge()
+        if len(self.head) < 16:
+            self.head += bytes(chunk[:16 - len(self.head)])
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+
+def spool_base64(data: str, spool: HashingSpool) -> None:
+    """Декодирует base64 кусками, не создавая полную копию изображения"""
+    if '\n' in data or ' ' in data:
+        data = ''.join(data.split())
+    # Размер известен до декодирования — слишком большие файлы отсекаются сразу
+    if len(data) // 4 * 3 - data[-2:].count('=') > MAX_IMAGE_SIZE:
+        raise ImageTooLarge()
+    for start in range(0, len(data), CHUNK_SIZE):
+        spool.write(base64.b64decode(data[start:start + CHUNK_SIZE]))
+
+def spool_bytes(data: memoryview, spool: HashingSpool) -> None:
+    if len(data) > MAX_IMAGE_SIZE:
+        raise ImageTooLarge()
+    for start in range(0, len(data), CHUNK_SIZE):
+        spool.write(data[start:start + CHUNK_SIZE])
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    headers = event.get('headers') or {}
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value or ''
+    return ''
+
+def find_multipart_file(body: bytes, content_type: str) -> Optional[Tuple[str, int, int]]:
+    """Находит в multipart/form-data первую часть с файлом: (filename, начало, конец)"""
+    boundary = None
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            boundary = value.strip('"').encode('latin-1')
+    if not boundary:
+        return None
+    delimiter = b'--' + boundary
+    position = body.find(delimiter)
+    while position != -1:
+        headers_start = position + len(delimiter) + 2
+        headers_end = body.find(b'\r\n\r\n', headers_start)
+        if headers_end == -1:
+            return None
+        next_delimiter = body.find(b'\r\n' + delimiter, headers_end)
+        if next_delimiter == -1:
+            return None
+        part_headers = body[headers_start:headers_end].decode('utf-8', errors='replace')
+        if 'filename=' in part_headers:
+            filename = part_headers.split('filename=', 1)[1].split(';')[0].split('\r\n')[0].strip().strip('"')
+            return filename or 'image.jpg', headers_end + 4, next_delimiter
+        position = next_delimiter + 2
+    return None
+
+def detect_image_type(head: bytes) -> Optional[Tuple[str, str]]:
+    """
+    Расширение и MIME только по сигнатуре растрового изображения. Имя файла и
+    заголовки клиента не учитываются: иначе HTML или SVG со скриптом попали бы
+    в публичное хранилище с типом, который браузер отрисует
+    """
+    for signature, ext, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext, mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp', 'image/webp'
+    return None
+
+def get_s3_client() -> Any:
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+    return _s3_client
+
+def find_stored_image(key: str) -> Optional[str]:
+    """URL уже сохранённого файла с таким ключом или None"""
+    with _known_keys_lock:
+        if key in _known_keys:
+            return _known_keys[key]
+
+    url = f'{UPLOAD_PUBLIC_URL}/{key}'
+    if S3_BUCKET:
+        try:
+            get_s3_client().head_object(Bucket=S3_BUCKET, Key=key)
+        except Exception:
+            return None
+    elif not os.path.exists(os.path.join(UPLOAD_STORAGE_DIR, key)):
+        return None
+
+    with _known_keys_lock:
+        _known_keys[key] = url
+    return url
+
+def store_object(source: Any, key: str, mime_type: str) -> str:
+    """Кладёт файл в хранилище по ключу из хеша содержимого"""
+    source.seek(0)
+    if S3_BUCKET:
+        get_s3_client().upload_fileobj(source, S3_BUCKET, key, ExtraArgs={
+            'ContentType': mime_type,
+            'CacheControl': 'public, max-age=31536000, immutable'
+        })
+    else:
+        path = os.path.join(UPLOAD_STORAGE_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as target:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(chunk)
+        os.replace(target.name, path)
+
+    url = f'{UPLOAD_PUBLIC_URL}/{key}'
+    with _known_keys_lock:
+        _known_keys[key] = url
+    return url
+
+def load_object(key: str) -> bytes:
+    if S3_BUCKET:
+        return get_s3_client().get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+    with open(os.path.join(UPLOAD_STORAGE_DIR, key), 'rb') as f:
+        return f.read()
+
+def variant_key(file_hash: str, size: int) -> str:
+    return f'variants/{file_hash[:2]}/{file_hash}_{size}.webp'
+
+def render_variants(data: bytes, sizes: Tuple[int, ...]) -> Dict[int, bytes]:
+    """Выполняется в процессе пула: уменьшает изображение до каждого размера и кодирует в WebP"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as source:
+        source.seek(0)
+        image = source.convert('RGBA' if source.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    variants = {}
+    for size in sizes:
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=VARIANT_QUALITY, method=4)
+        variants[size] = buffer.getvalue()
+    return variants
+
+def get_resize_pool() -> ProcessPoolExecutor:
+    global _resize_pool
+    with _resize_pool_lock:
+        if _resize_pool is None:
+            _resize_pool = ProcessPoolExecutor(max_workers=RESIZE_WORKERS)
+        return _resize_pool
+
+def store_variants(file_hash: str, future: Future) -> None:
+    try:
+        for size, data in future.result().items():
+            store_object(io.BytesIO(data), variant_key(file_hash, size), 'image/webp')
+    except Exception as e:
+        print(json.dumps({'fn': 'upload-image', 'resize_error': str(e), 'hash': file_hash}))
+    finally:
+        with _resize_pool_lock:
+            _pending_variants.pop(file_hash, None)
+
+def schedule_variants(file_hash: str, data: bytes) -> None:
+    """Ставит ресайз в пул, не дожидаясь результата; повторная постановка того же хеша игнорируется"""
+    with _resize_pool_lock:
+        if file_hash in _pending_variants:
+            return
+        _pending_variants[file_hash] = None
+    try:
+        future = get_resize_pool().submit(render_variants, data, VARIANT_SIZES)
+    except Exception:
+        with _resize_pool_lock:
+            _pending_variants.pop(file_hash, None)
+        raise
+    with _resize_pool_lock:
+        _pending_variants[file_hash] = future
+    future.add_done_callback(lambda done: store_variants(file_hash, done))
+
+def find_original(file_hash: str) -> Optional[str]:
+    """Ключ оригинала по хешу: расширение заранее неизвестно"""
+    for ext in ORIGINAL_EXTENSIONS:
+        key = f'images/{file_hash[:2]}/{file_hash}{ext}'
+        if find_stored_image(key):
+            return key
+    return None
+
+def lookup_variant(params: Dict[str, str]) -> Dict[str, Any]:
+    """URL уменьшенной копии: готовой — сразу, иначе оригинал и постановка ресайза в очередь"""
+    match = HASH_PATTERN.search(params.get('hash') or params.get('url') or '')
+    if not match:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'hash or url is required'})
+        }
+    file_hash = match.group(0)
+    size = params.get('size') or str(VARIANT_SIZES[0])
+    if not size.isdigit() or int(size) not in VARIANT_SIZES:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'size must be one of {", ".join(map(str, VARIANT_SIZES))}'})
+        }
+    size = int(size)
+
+    url = find_stored_image(variant_key(file_hash, size))
+    if url:
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Cache-Control': 'public, max-age=86400'
+            },
+            'body': json.dumps({'url': url, 'size': size, 'ready': True})
+        }
+
+    original = find_original(file_hash)
+    if not original:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Image not found'})
+        }
+    # Например, контейнер перезапустился до окончания ресайза
+    if file_hash not in _pending_variants:
+        schedule_variants(file_hash, load_object(original))
+    return {
+        'statusCode': 202,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'url': f'{UPLOAD_PUBLIC_URL}/{original}', 'size': size, 'ready': False})
+    }
+
+@instrument_handler('upload-image')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Загрузка изображений (аватары, контент) и возврат публичного URL
-    Args: event с httpMethod, body (image_base64, filename)
-    Returns: HTTP response с URL загруженного изображения
+    Business: Загрузка изображений (аватары, контент), их уменьшенные копии и возврат публичного URL
+    Args: event с httpMethod, body (JSON image_base64, multipart/form-data или сырые байты изображения);
+          GET ?hash=|url=&size= — URL уменьшенной копии (size из VARIANT_SIZES)
+    Returns: HTTP response с URL загруженного изображения; variants — только готовые копии,
+             пока они рендерятся, variantsPending = true
     '''
     method: str = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Filename',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
-    
+
+    if method == 'GET' and (S3_BUCKET or UPLOAD_STORAGE_DIR):
+        try:
+            return lookup_variant(event.get('queryStringParameters') or {})
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)})
+            }
+
     if method != 'POST':
         return {
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Method not allowed'})
         }
-    
+
     try:
-        body_data = json.loads(event.get('body', '{}'))
-        image_base64 = body_data.get('image')
-        filename = body_data.get('filename', 'image.jpg')
-        
-        if not image_base64:
+        content_type = get_header(event, 'Content-Type')
+        body = event.get('body') or ''
+        spool = HashingSpool()
+        started = time.perf_counter()
+
+        if content_type.startswith('multipart/form-data'):
+            raw = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('latin-1')
+            part = find_multipart_file(raw, content_type)
+            if not part:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Image data is required'})
+                }
+            _, start, end = part
+            spool_bytes(memoryview(raw)[start:end], spool)
+
+        elif content_type.startswith('image/') or content_type.startswith('application/octet-stream'):
+            if event.get('isBase64Encoded'):
+                spool_base64(body, spool)
+            else:
+                spool_bytes(memoryview(body.encode('latin-1')), spool)
+
+        else:
+            body_data = json.loads(body or '{}')
+            image_base64 = body_data.get('image')
+            if not image_base64:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Image data is required'})
+                }
+
+            # Remove data URL prefix if present
+            if ',' in image_base64[:100]:
+                image_base64 = image_base64.split(',', 1)[1]
+
+            spool_base64(image_base64, spool)
+
+        if spool.size == 0:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Image data is required'})
             }
-        
-        # Remove data URL prefix if present
-        if ',' in image_base64:
-            image_base64 = image_base64.split(',')[1]
-        
-        # Decode base64
-        image_bytes = base64.b64decode(image_base64)
-        
-        # Check file size (max 5MB)
-        max_size = 5 * 1024 * 1024
-        if len(image_bytes) > max_size:
+
+        file_hash = spool.hasher.hexdigest()
+        record_timing('read', started)
+        image_type = detect_image_type(spool.head)
+        if image_type is None:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Image too large. Max 5MB allowed'})
+                'body': json.dumps({'error': 'Unsupported image format. Allowed: PNG, JPEG, GIF, WebP'})
             }
-        
-        # Generate unique filename using hash
-        file_hash = hashlib.md5(image_bytes).hexdigest()
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        # Get file extension from filename or MIME type
-        ext = os.path.splitext(filename)[1]
-        if not ext:
-            ext = '.jpg'
-        
-        unique_filename = f"{timestamp}_{file_hash}{ext}"
-        
-        # For now, we'll use a simple base64 data URL as a fallback
-        # In production, you would upload to S3/CDN here
-        mime_type = mimetypes.guess_type(filename)[0] or 'image/jpeg'
-        data_url = f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode()}"
-        
-        # Temporary solution: return dicebear avatar
-        # TODO: Implement actual S3/CDN upload when storage is configured
-        seed = file_hash[:10]
-        avatar_url = f"https://api.dicebear.com/7.x/avataaars/svg?seed={seed}"
-        
+        ext, mime_type = image_type
+        key = f'images/{file_hash[:2]}/{file_hash}{ext}'
+
+        if not S3_BUCKET and not UPLOAD_STORAGE_DIR:
+            # Хранилище не настроено: отдаём аватар-заглушку по хешу, как раньше
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'url': f'https://api.dicebear.com/7.x/avataaars/svg?seed={file_hash[:10]}',
+                    'filename': os.path.basename(key),
+                    'size': spool.size,
+                    'hash': file_hash,
+                    'message': 'Image uploaded successfully (using placeholder avatar)'
+                })
+            }
+
+        started = time.perf_counter()
+        url = find_stored_image(key)
+        record_timing('lookup', started)
+        deduplicated = url is not None
+        if not deduplicated:
+            started = time.perf_counter()
+            url = store_object(spool.file, key, mime_type)
+            record_timing('store', started)
+        # Копии пишутся по порядку размеров, поэтому наибольшая есть, только когда готовы все;
+        # пока их нет, клиент спрашивает GET ?hash=&size= и получает 202 до конца ресайза
+        variants_ready = deduplicated and find_stored_image(variant_key(file_hash, VARIANT_SIZES[-1])) is not None
+        if not variants_ready:
+            spool.file.seek(0)
+            schedule_variants(file_hash, spool.file.read())
+
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
-                'url': avatar_url,
-                'filename': unique_filename,
-                'size': len(image_bytes),
-                'message': 'Image uploaded successfully (using placeholder avatar)'
+                'url': url,
+                'filename': os.path.basename(key),
+                'size': spool.size,
+                'hash': file_hash,
+                'deduplicated': deduplicated,
+                'variants': {size: f'{UPLOAD_PUBLIC_URL}/{variant_key(file_hash, size)}' for size in VARIANT_SIZES} if variants_ready else {},
+                'variantsPending': not variants_ready,
+                'message': 'Image uploaded successfully'
             })
         }
-    
+
+    except ImageTooLarge:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Image too large. Max 5MB allowed'})
+        }
+
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': str(e)})
         }
+    finally:
+        if 'spool' in locals():
+            spool.file.close()
@@ -0,0 +1,2 @@
+-- Составной индекс для курсорной выборки чата по (stream_id, id)
+CREATE INDEX IF NOT EXISTS idx_chat_messages_stream_id_id ON chat_messages(stream_id, id);
@@ -0,0 +1,11 @@
+-- Уведомляем слушателей чата о новых сообщениях через NOTIFY (payload = stream_id)
+CREATE OR REPLACE FUNCTION notify_chat_message() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('chat_messages', NEW.stream_id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_chat_messages_notify
+    AFTER INSERT ON chat_messages
+    FOR EACH ROW EXECUTE FUNCTION notify_chat_message();
@@ -0,0 +1,4 @@
+-- Ключ идемпотентности для безопасных повторов доната
+ALTER TABLE donations ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_donations_idempotency_key ON donations(from_user_id, idempotency_key);
@@ -0,0 +1,41 @@
+-- Сумма донатов каждого донатера в стриме (источник для топа)
+CREATE TABLE IF NOT EXISTS stream_donor_totals (
+    stream_id INTEGER NOT NULL REFERENCES streams(id),
+    from_user_id INTEGER NOT NULL REFERENCES users(id),
+    total_amount BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (stream_id, from_user_id)
+);
+
+-- Сводка донатов стрима: сумма, количество и топ-10 донатеров
+CREATE TABLE IF NOT EXISTS stream_donation_stats (
+    stream_id INTEGER PRIMARY KEY REFERENCES streams(id),
+    total_amount BIGINT NOT NULL DEFAULT 0,
+    donations_count INTEGER NOT NULL DEFAULT 0,
+    top_donors JSONB NOT NULL DEFAULT '[]'::jsonb,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Заполняем сводки по уже существующим донатам
+INSERT INTO stream_donor_totals (stream_id, from_user_id, total_amount)
+SELECT stream_id, from_user_id, SUM(amount)
+FROM donations
+WHERE stream_id IS NOT NULL AND from_user_id IS NOT NULL
+GROUP BY stream_id, from_user_id
+ON CONFLICT (stream_id, from_user_id) DO NOTHING;
+
+INSERT INTO stream_donation_stats (stream_id, total_amount, donations_count, top_donors)
+SELECT d.stream_id, SUM(d.amount), COUNT(*),
+       COALESCE((
+           SELECT jsonb_agg(jsonb_build_object('userId', t.from_user_id, 'amount', t.total_amount) ORDER BY t.total_amount DESC)
+           FROM (
+               SELECT from_user_id, total_amount
+               FROM stream_donor_totals
+               WHERE stream_id = d.stream_id
+               ORDER BY total_amount DESC
+               LIMIT 10
+           ) t
+       ), '[]'::jsonb)
+FROM donations d
+WHERE d.stream_id IS NOT NULL
+GROUP BY d.stream_id
+ON CONFLICT (stream_id) DO NOTHING;
@@ -0,0 +1,22 @@
+-- Сводка рефералов по каждому пригласившему: обновляется обработчиком вместе с рефералами
+CREATE TABLE IF NOT EXISTS referral_stats (
+    referrer_id INTEGER PRIMARY KEY REFERENCES users(id),
+    referred_count INTEGER NOT NULL DEFAULT 0,
+    purchase_total BIGINT NOT NULL DEFAULT 0,
+    reward_total BIGINT NOT NULL DEFAULT 0,
+    pending_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Заполняем сводку по уже существующим рефералам
+INSERT INTO referral_stats (referrer_id, referred_count, purchase_total, reward_total, pending_count)
+SELECT referrer_id, COUNT(*), SUM(purchase_amount), SUM(reward_earned), COUNT(*) FILTER (WHERE status = 'pending')
+FROM referrals
+GROUP BY referrer_id
+ON CONFLICT (referrer_id) DO NOTHING;
+
+-- Индекс для keyset-пагинации списка рефералов
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer_created_id ON referrals(referrer_id, created_at DESC, id DESC);
+
+-- Одиночный индекс по referrer_id покрывается составным
+DROP INDEX IF EXISTS idx_referrals_referrer_id;
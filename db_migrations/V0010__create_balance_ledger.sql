@@ -0,0 +1,33 @@
+-- Журнал всех изменений баланса boombucks: строки только добавляются
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    delta BIGINT NOT NULL,
+    reason VARCHAR(30) NOT NULL,
+    ref_id INTEGER NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_balance_ledger_user_id ON balance_ledger(user_id, id);
+
+-- Снимки баланса: balance = сумма всех записей журнала пользователя с id <= ledger_id
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    ledger_id BIGINT NOT NULL,
+    balance BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, ledger_id)
+);
+
+-- Текущие балансы становятся начальными записями журнала и первым снимком
+INSERT INTO balance_ledger (user_id, delta, reason)
+SELECT id, boombucks, 'opening'
+FROM users
+WHERE COALESCE(boombucks, 0) <> 0
+  AND NOT EXISTS (SELECT 1 FROM balance_ledger);
+
+INSERT INTO balance_snapshots (user_id, ledger_id, balance)
+SELECT user_id, id, delta
+FROM balance_ledger
+WHERE reason = 'opening'
+ON CONFLICT (user_id, ledger_id) DO NOTHING;
@@ -0,0 +1,84 @@
+-- Секционирование chat_messages по времени (по суткам) и архив чата завершённых стримов.
+-- Старая таблица становится секцией для всего, что было до завтрашнего дня.
+UPDATE chat_messages SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE chat_messages ALTER COLUMN created_at SET NOT NULL;
+
+DROP TRIGGER IF EXISTS trg_chat_messages_notify ON chat_messages;
+DROP INDEX IF EXISTS idx_chat_messages_stream_id;
+DROP INDEX IF EXISTS idx_chat_messages_created_at;
+ALTER TABLE chat_messages RENAME TO chat_messages_legacy;
+ALTER TABLE chat_messages_legacy RENAME CONSTRAINT chat_messages_pkey TO chat_messages_legacy_pkey;
+ALTER INDEX idx_chat_messages_stream_id_id RENAME TO chat_messages_legacy_stream_id_id_idx;
+
+CREATE TABLE chat_messages (
+    id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+    stream_id INTEGER REFERENCES streams(id),
+    user_id INTEGER REFERENCES users(id),
+    username VARCHAR(50) NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Последовательность должна пережить удаление старой секции
+ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id;
+
+CREATE INDEX IF NOT EXISTS idx_chat_messages_stream_id_id ON chat_messages(stream_id, id);
+
+-- Индекс (stream_id, id) старой таблицы совпадает с индексом родителя и переиспользуется
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE chat_messages ATTACH PARTITION chat_messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        CURRENT_DATE + 1
+    );
+END;
+$$;
+
+-- Запасная секция: вставка не падает, даже если секции на день ещё нет
+CREATE TABLE IF NOT EXISTS chat_messages_default PARTITION OF chat_messages DEFAULT;
+
+-- Создаёт суточные секции на days_ahead дней вперёд; уже покрытые дни пропускаются
+CREATE OR REPLACE FUNCTION create_chat_partitions(days_ahead INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    day DATE;
+    created INTEGER := 0;
+BEGIN
+    FOR day IN SELECT generate_series(CURRENT_DATE, CURRENT_DATE + days_ahead, INTERVAL '1 day')::date LOOP
+        IF to_regclass('chat_messages_p' || to_char(day, 'YYYYMMDD')) IS NOT NULL THEN
+            CONTINUE;
+        END IF;
+        BEGIN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF chat_messages FOR VALUES FROM (%L) TO (%L)',
+                'chat_messages_p' || to_char(day, 'YYYYMMDD'), day, day + 1
+            );
+            created := created + 1;
+        EXCEPTION WHEN invalid_object_definition THEN
+            -- День уже покрыт старой секцией
+            NULL;
+        END;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+SELECT create_chat_partitions(7);
+
+CREATE TRIGGER trg_chat_messages_notify
+    AFTER INSERT ON chat_messages
+    FOR EACH ROW EXECUTE FUNCTION notify_chat_message();
+
+-- Архив чата: сообщения стрима сжатыми пачками по возрастанию id
+CREATE TABLE IF NOT EXISTS chat_archive_chunks (
+    stream_id INTEGER NOT NULL REFERENCES streams(id),
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    first_at TIMESTAMP NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    payload BYTEA NOT NULL,
+    PRIMARY KEY (stream_id, first_id)
+);
+
+ALTER TABLE streams ADD COLUMN IF NOT EXISTS chat_archived_at TIMESTAMP NULL;
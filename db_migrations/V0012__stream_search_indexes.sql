@@ -0,0 +1,50 @@
+-- Каталог стримов: фильтр по категории, поиск и курсор по (viewers_count, id)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+UPDATE streams SET viewers_count = 0 WHERE viewers_count IS NULL;
+ALTER TABLE streams ALTER COLUMN viewers_count SET NOT NULL;
+
+-- Текст для поиска: название, описание и ник стримера в нижнем регистре
+ALTER TABLE streams ADD COLUMN IF NOT EXISTS search_text TEXT NOT NULL DEFAULT '';
+
+CREATE OR REPLACE FUNCTION streams_search_text() RETURNS trigger AS $$
+BEGIN
+    NEW.search_text := lower(concat_ws(' ', NEW.title, NEW.description,
+        (SELECT username FROM users WHERE id = NEW.user_id)));
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE TRIGGER trg_streams_search_text
+    BEFORE INSERT OR UPDATE OF title, description, user_id ON streams
+    FOR EACH ROW EXECUTE FUNCTION streams_search_text();
+
+-- Смена ника пересчитывает search_text всех стримов пользователя через триггер выше
+CREATE OR REPLACE FUNCTION users_username_search_text() RETURNS trigger AS $$
+BEGIN
+    UPDATE streams SET title = title WHERE user_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE TRIGGER trg_users_username_search_text
+    AFTER UPDATE OF username ON users
+    FOR EACH ROW WHEN (OLD.username IS DISTINCT FROM NEW.username)
+    EXECUTE FUNCTION users_username_search_text();
+
+UPDATE streams s
+SET search_text = lower(concat_ws(' ', s.title, s.description, u.username))
+FROM users u
+WHERE u.id = s.user_id;
+
+ALTER TABLE streams ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', search_text)) STORED;
+
+-- Все индексы частичные: каталог и поиск показывают только живые стримы
+CREATE INDEX IF NOT EXISTS idx_streams_live_viewers ON streams(viewers_count DESC, id DESC) WHERE is_live;
+CREATE INDEX IF NOT EXISTS idx_streams_live_category_viewers ON streams(category, viewers_count DESC, id DESC) WHERE is_live;
+CREATE INDEX IF NOT EXISTS idx_streams_live_search_vector ON streams USING GIN (search_vector) WHERE is_live;
+CREATE INDEX IF NOT EXISTS idx_streams_live_search_trgm ON streams USING GIN (search_text gin_trgm_ops) WHERE is_live;
+
+-- Заменён частичными индексами выше
+DROP INDEX IF EXISTS idx_streams_is_live;
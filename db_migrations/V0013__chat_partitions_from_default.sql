@@ -0,0 +1,37 @@
+-- create_chat_partitions: строки дня, уже попавшие в chat_messages_default, переносятся
+-- в новую секцию; иначе CREATE ... PARTITION OF падал бы с check_violation и скрипт
+-- обслуживания переставал создавать секции. Ошибка одного дня не мешает остальным.
+CREATE OR REPLACE FUNCTION create_chat_partitions(days_ahead INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    day DATE;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    FOR day IN SELECT generate_series(CURRENT_DATE, CURRENT_DATE + days_ahead, INTERVAL '1 day')::date LOOP
+        partition_name := 'chat_messages_p' || to_char(day, 'YYYYMMDD');
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            CONTINUE;
+        END IF;
+        BEGIN
+            EXECUTE format('CREATE TABLE %I (LIKE chat_messages INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM chat_messages_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved',
+                day, day + 1, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE chat_messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, day, day + 1
+            );
+            created := created + 1;
+        EXCEPTION
+            WHEN invalid_object_definition THEN
+                -- День уже покрыт старой секцией
+                NULL;
+            WHEN check_violation THEN
+                RAISE WARNING 'chat partition % not created: %', partition_name, SQLERRM;
+        END;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
@@ -105,6 +105,12 @@ export const uploadAPI = {
       reader.onerror = () => reject(new Error('Failed to read file'));
       reader.readAsDataURL(imageFile);
     });
+  },
+
+  getVariant: async (imageUrl: string, size: number): Promise<{ url: string; size: number; ready: boolean }> => {
+    const params = new URLSearchParams({ url: imageUrl, size: size.toString() });
+    const response = await fetch(`${API_URLS.uploadImage}?${params}`);
+    return response.json();
   }
 };
 
@@ -114,6 +120,15 @@ export const streamsAPI = {
     return response.json();
   },
 
+  browse: async (category?: string, query?: string, cursor?: string): Promise<{ streams: Stream[]; nextCursor: string | null }> => {
+    const params = new URLSearchParams();
+    if (category) params.set('category', category);
+    if (query) params.set('q', query);
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`${API_URLS.streams}?${params}`);
+    return response.json();
+  },
+
   create: async (userId: number, title: string, category: string, description?: string) => {
     const response = await fetch(API_URLS.streams, {
       method: 'POST',
@@ -143,8 +158,9 @@ export const streamsAPI = {
 };
 
 export const chatAPI = {
-  getMessages: async (streamId: number, limit = 50): Promise<{ messages: ChatMessage[] }> => {
-    const response = await fetch(`${API_URLS.chat}?stream_id=${streamId}&limit=${limit}`);
+  getMessages: async (streamId: number, limit = 50, afterId?: number): Promise<{ messages: ChatMessage[] }> => {
+    const cursor = afterId ? `&after_id=${afterId}` : '';
+    const response = await fetch(`${API_URLS.chat}?stream_id=${streamId}&limit=${limit}${cursor}`);
     return response.json();
   },
 
@@ -175,8 +191,9 @@ export const donationsAPI = {
 };
 
 export const transactionsAPI = {
-  getTransactions: async (userId: number) => {
-    const response = await fetch(`${API_URLS.transactions}?user_id=${userId}`);
+  getTransactions: async (userId: number, cursor?: string) => {
+    const page = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`${API_URLS.transactions}?user_id=${userId}${page}`);
     return response.json();
   },
 
@@ -191,8 +208,10 @@ export const transactionsAPI = {
 };
 
 export const referralsAPI = {
-  getReferrals: async (userId: number) => {
-    const response = await fetch(`${API_URLS.referrals}?user_id=${userId}`);
+  getReferrals: async (userId: number, cursor?: string) => {
+    const params = new URLSearchParams({ user_id: userId.toString() });
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`${API_URLS.referrals}?${params}`);
     return response.json();
   },
 
@@ -0,0 +1,149 @@
+'''
+Бенчмарк донатов: старый путь (5 запросов в autocommit) против атомарного
+запроса из backend/donations/index.py.
+
+Запуск против локального Postgres с применёнными db_migrations:
+    DATABASE_URL=postgresql://localhost/strim python tools/bench_donations.py --threads 8 --seconds 10
+'''
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+import psycopg2
+
+SCHEMA = 't_p37705306_strim_boom_project'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_handler() -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    spec = importlib.util.spec_from_file_location('donations_index', os.path.join(ROOT, 'backend', 'donations', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+
+def seed(conn: Any, donors: int) -> Dict[str, Any]:
+    '''Создаёт стримера, стрим и донатеров с большим балансом'''
+    cur = conn.cursor()
+    suffix = str(int(time.time() * 1000))
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.users (username, email, password_hash, boombucks)
+        VALUES (%s, %s, 'bench', 0) RETURNING id
+    """, (f'bench_streamer_{suffix}', f'bench_streamer_{suffix}@bench.local'))
+    streamer_id = cur.fetchone()[0]
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.streams (user_id, title, is_live, stream_key)
+        VALUES (%s, 'bench', true, %s) RETURNING id
+    """, (streamer_id, f'bench_{suffix}'))
+    stream_id = cur.fetchone()[0]
+    donor_ids = []
+    for i in range(donors):
+        cur.execute(f"""
+            INSERT INTO {SCHEMA}.users (username, email, password_hash, boombucks)
+            VALUES (%s, %s, 'bench', 1000000000) RETURNING id
+        """, (f'bench_donor_{suffix}_{i}', f'bench_donor_{suffix}_{i}@bench.local'))
+        donor_ids.append(cur.fetchone()[0])
+    conn.commit()
+    cur.close()
+    return {'stream_id': stream_id, 'donor_ids': donor_ids}
+
+
+def legacy_donate(cur: Any, stream_id: int, from_user_id: int, amount: int) -> None:
+    '''Повторяет прежнюю последовательность запросов обработчика'''
+    cur.execute(f"SELECT boombucks FROM {SCHEMA}.users WHERE id = {from_user_id}")
+    user = cur.fetchone()
+    if not user or user[0] < amount:
+        return
+    cur.execute(f"UPDATE {SCHEMA}.users SET boombucks = boombucks - {amount} WHERE id = {from_user_id}")
+    cur.execute(f"SELECT user_id FROM {SCHEMA}.streams WHERE id = {stream_id}")
+    streamer = cur.fetchone()
+    if streamer:
+        cur.execute(f"UPDATE {SCHEMA}.users SET boombucks = boombucks + {amount} WHERE id = {streamer[0]}")
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.donations (stream_id, from_user_id, amount, message, created_at)
+        VALUES ({stream_id}, {from_user_id}, {amount}, 'bench', CURRENT_TIMESTAMP)
+        RETURNING id, amount, message, created_at
+    """)
+    cur.fetchone()
+
+
+def run(worker: Callable[[int, int], None], threads: int, seconds: float) -> int:
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def loop(index: int) -> None:
+        n = 0
+        while time.perf_counter() < deadline:
+            worker(index, n)
+            n += 1
+        counts[index] = n
+
+    pool = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(counts)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--amount', type=int, default=1)
+    args = parser.parse_args()
+
+    database_url = os.environ['DATABASE_URL']
+    setup_conn = psycopg2.connect(database_url)
+    data = seed(setup_conn, args.threads)
+    setup_conn.close()
+    stream_id = data['stream_id']
+    donor_ids = data['donor_ids']
+
+    legacy_conns = []
+    for _ in range(args.threads):
+        conn = psycopg2.connect(database_url)
+        conn.autocommit = True
+        legacy_conns.append(conn)
+
+    def legacy_worker(index: int, n: int) -> None:
+        with legacy_conns[index].cursor() as cur:
+            legacy_donate(cur, stream_id, donor_ids[index], args.amount)
+
+    # Пул обработчика должен вмещать все потоки, иначе сравнение нечестное
+    os.environ['DB_POOL_SIZE'] = str(args.threads)
+    handler = load_handler()
+
+    def atomic_worker(index: int, n: int) -> None:
+        handler({
+            'httpMethod': 'POST',
+            'headers': {'X-Idempotency-Key': f'bench-{index}-{n}-{time.time_ns()}'},
+            'body': json.dumps({
+                'stream_id': stream_id,
+                'from_user_id': donor_ids[index],
+                'amount': args.amount,
+                'message': 'bench'
+            })
+        }, None)
+
+    before = run(legacy_worker, args.threads, args.seconds) / args.seconds
+    # Обработчик пишет строку лога на каждый вызов — глушим её на время замера
+    with contextlib.redirect_stdout(io.StringIO()):
+        after = run(atomic_worker, args.threads, args.seconds) / args.seconds
+
+    print(f'before   {before:>10.1f} donations/sec')
+    print(f'after    {after:>10.1f} donations/sec')
+    print(f'speedup  {after / before:.2f}x')
+
+    for conn in legacy_conns:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
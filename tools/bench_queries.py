@@ -0,0 +1,188 @@
+'''
+Бенчмарк всех SQL-запросов обработчиков. Запросы берутся из
+PREPARED_STATEMENTS каждой функции в backend/, параметры подбираются
+по реальным данным (самый популярный стрим, самый активный пользователь).
+Изменяющие запросы выполняются в транзакции и откатываются.
+
+    DATABASE_URL=postgresql://localhost/strim python tools/bench_queries.py --save-baseline
+    DATABASE_URL=postgresql://localhost/strim python tools/bench_queries.py --compare --threshold 20
+'''
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import psycopg2
+
+SCHEMA = 't_p37705306_strim_boom_project'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+BASELINE_PATH = os.path.join(ROOT, 'tools', 'bench_baseline.json')
+
+
+def collect_statements() -> Dict[str, str]:
+    '''Собирает PREPARED_STATEMENTS всех функций; одинаковые запросы берутся один раз'''
+    statements: Dict[str, str] = {}
+    seen_sql = set()
+    for name in sorted(os.listdir(BACKEND)):
+        path = os.path.join(BACKEND, name, 'index.py')
+        if not os.path.isfile(path):
+            continue
+        spec = importlib.util.spec_from_file_location(f"bench_{name.replace('-', '_')}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        for stmt_name, sql in getattr(module, 'PREPARED_STATEMENTS', {}).items():
+            key = ' '.join(sql.split())
+            if key in seen_sql:
+                continue
+            seen_sql.add(key)
+            statements[f'{name}.{stmt_name}'] = sql
+    return statements
+
+
+def sample_context(cur: Any) -> Dict[str, Any]:
+    '''Находит «тяжёлые» реальные ключи для параметров'''
+    ctx: Dict[str, Any] = {}
+    cur.execute(f"""
+        SELECT stream_id, MAX(id) FROM {SCHEMA}.chat_messages
+        GROUP BY stream_id ORDER BY COUNT(*) DESC LIMIT 1
+    """)
+    ctx['stream_id'], ctx['chat_max_id'] = cur.fetchone() or (1, 1)
+    cur.execute(f"""
+        SELECT user_id, MAX(created_at), MAX(id) FROM {SCHEMA}.transactions
+        GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1
+    """)
+    ctx['user_id'], ctx['tx_created_at'], ctx['tx_id'] = cur.fetchone() or (1, '2100-01-01', 1)
+    cur.execute(f"""
+        SELECT referrer_id, MIN(referred_user_id), MIN(id) FROM {SCHEMA}.referrals
+        GROUP BY referrer_id ORDER BY COUNT(*) DESC LIMIT 1
+    """)
+    ctx['referrer_id'], ctx['referred_user_id'], ctx['referral_id'] = cur.fetchone() or (1, 2, 1)
+    cur.execute(f'SELECT email, password_hash FROM {SCHEMA}.users WHERE id = %s', (ctx['user_id'],))
+    ctx['email'], ctx['password_hash'] = cur.fetchone() or ('nobody@seed.local', 'x')
+    ctx['token_hash'] = hashlib.sha256(b'bench').hexdigest()
+    return ctx
+
+
+# Параметры для каждого запроса по его имени в PREPARED_STATEMENTS
+PARAMS: Dict[str, Callable[[Dict[str, Any]], Tuple]] = {
+    'verify_session': lambda c: (c['token_hash'],),
+    'chat_tail': lambda c: (c['stream_id'], 50),
+    'chat_before': lambda c: (c['stream_id'], c['chat_max_id'] // 2, 50),
+    'chat_after': lambda c: (c['stream_id'], c['chat_max_id'] - 20, 50),
+    'chat_insert': lambda c: (c['stream_id'], c['user_id'], 'bench', 'bench message'),
+    'chat_stream_ended': lambda c: (c['stream_id'],),
+    'chat_archive_before': lambda c: (c['stream_id'], c['chat_max_id'], 1050),
+    'donations_recent': lambda c: (c['stream_id'],),
+    'donate': lambda c: (c['stream_id'], c['user_id'], 1, 'bench', secrets.token_hex(8), 10),
+    'donation_summary': lambda c: (c['stream_id'],),
+    'donations_version': lambda c: (c['stream_id'],),
+    'streams_page': lambda c: (2 ** 31 - 1, 2 ** 31 - 1, 51),
+    'streams_category_page': lambda c: ('Игры', 2 ** 31 - 1, 2 ** 31 - 1, 51),
+    'streams_search_page': lambda c: ('стрим', '%стрим%', None, 2 ** 31 - 1, 2 ** 31 - 1, 51),
+    'stream_create': lambda c: (c['user_id'], 'bench', 'bench', '', 'Другое', secrets.token_hex(8)),
+    'stream_stop': lambda c: (c['stream_id'],),
+    'transactions_page': lambda c: (c['user_id'], 101),
+    'transactions_page_after': lambda c: (c['user_id'], str(c['tx_created_at']), c['tx_id'], 101),
+    'transaction_insert': lambda c: (c['user_id'], 'buy', 1, 'RUB', 'bench'),
+    'transaction_buy': lambda c: (c['user_id'], 1, 'RUB', 'bench'),
+    'referrals_first_page': lambda c: (c['referrer_id'], 51),
+    'referrals_page_after': lambda c: (c['referrer_id'], '2100-01-01', 0, 51),
+    'referral_rewards': lambda c: ([c['referral_id']], 3, 1, [c['referrer_id']], [0], [1]),
+    'session_create': lambda c: (secrets.token_hex(32), c['user_id'], 30),
+    'session_revoke': lambda c: (c['token_hash'],),
+    'user_by_email': lambda c: (c['email'],),
+    'user_reregister': lambda c: ('bench', 'bench', 'bench', c['email']),
+    'user_register': lambda c: (f'bench_{secrets.token_hex(6)}', f'{secrets.token_hex(6)}@bench.local', 'bench', 'bench'),
+    'user_login': lambda c: (c['email'], c['password_hash']),
+}
+
+
+def bench_statement(conn: Any, name: str, sql: str, params: Callable[[], Tuple], iterations: int) -> List[float]:
+    cur = conn.cursor()
+    prepared = name.replace('.', '_').replace('-', '_')
+    cur.execute(f'PREPARE {prepared} AS {sql}')
+    samples = []
+    for _ in range(iterations):
+        args = params()
+        placeholders = f' ({", ".join(["%s"] * len(args))})' if args else ''
+        started = time.perf_counter()
+        cur.execute(f'EXECUTE {prepared}{placeholders}', args)
+        if cur.description is not None:
+            cur.fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+        conn.rollback()
+    cur.execute(f'DEALLOCATE {prepared}')
+    conn.rollback()
+    cur.close()
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--only', help='подстрока имени запроса')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--threshold', type=float, default=20, help='допустимый рост p50 в процентах')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    statements = collect_statements()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    ctx = sample_context(cur)
+    conn.rollback()
+    cur.close()
+
+    baseline = {}
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results: Dict[str, Dict[str, float]] = {}
+    regressions = []
+    print(f"{'statement':<44}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}{'vs base':>10}")
+    for name, sql in statements.items():
+        stmt = name.split('.', 1)[1]
+        if args.only and args.only not in name:
+            continue
+        if stmt not in PARAMS:
+            print(f'{name:<44}  skipped: no parameters defined in PARAMS', file=sys.stderr)
+            continue
+        samples = sorted(bench_statement(conn, name, sql, lambda: PARAMS[stmt](ctx), args.iterations))
+        result = {
+            'p50': samples[len(samples) // 2],
+            'p95': samples[int(len(samples) * 0.95) - 1],
+            'mean': statistics.fmean(samples)
+        }
+        results[name] = result
+        delta = ''
+        if name in baseline:
+            change = (result['p50'] / baseline[name]['p50'] - 1) * 100
+            delta = f'{change:+.0f}%'
+            if change > args.threshold:
+                regressions.append(name)
+        print(f"{name:<44}{result['p50']:>10.3f}{result['p95']:>10.3f}{result['mean']:>10.3f}{delta:>10}")
+
+    conn.close()
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline saved to {args.baseline}')
+
+    if regressions:
+        print(f'regressions over {args.threshold:.0f}%: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
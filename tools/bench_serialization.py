@@ -0,0 +1,109 @@
+'''
+Микробенчмарк сериализации списков: прежний путь (словарь на строку,
+isoformat, json.dumps) против RowEncoder из обработчиков — без orjson
+и с orjson, если он установлен. Перед замером проверяется, что все
+варианты дают одинаковый JSON.
+
+    python tools/bench_serialization.py --rows 100 --iterations 5000
+'''
+import argparse
+import importlib.util
+import json
+import os
+import timeit
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+
+
+def load_handler(name: str) -> Any:
+    path = os.path.join(BACKEND, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f"bench_{name.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sample_rows(count: int) -> Dict[str, List[Tuple]]:
+    now = datetime.now()
+    return {
+        'chat': [(i, f'user_{i % 37}', f'сообщение номер {i} gg "lol"', now - timedelta(seconds=i)) for i in range(count)],
+        'donations': [(i, (i % 9 + 1) * 10, f'донат {i}', now - timedelta(minutes=i), f'user_{i}') for i in range(count)],
+        'streams': [(i, f'Стрим {i}', 'описание ' * 5, f'https://cdn.example/{i}.webp', 'Игры', True, 50000 // (i + 1),
+                     i % 2 == 0, 'male1', f'user_{i}', f'https://cdn.example/a/{i}.webp') for i in range(count)],
+        'transactions': [(i, 'buy', i % 1000, 'RUB', 'Покупка boombucks', 'completed', now - timedelta(hours=i)) for i in range(count)],
+        'referrals': [(i, 1, i + 2, f'user_{i}', i % 7, i % 2, 'pending', now - timedelta(days=i)) for i in range(count)],
+    }
+
+
+# Прежняя сериализация каждого обработчика: словарь на строку и json.dumps
+LEGACY: Dict[str, Callable[[List[Tuple]], str]] = {
+    'chat': lambda rows: json.dumps({'messages': [
+        {'id': r[0], 'username': r[1], 'message': r[2], 'timestamp': r[3].isoformat() if r[3] else None} for r in rows
+    ]}),
+    'donations': lambda rows: json.dumps({'donations': [
+        {'id': r[0], 'amount': r[1], 'message': r[2], 'timestamp': r[3].isoformat() if r[3] else None,
+         'username': r[4] or 'Аноним'} for r in rows
+    ]}),
+    'streams': lambda rows: json.dumps({'streams': [
+        {'id': r[0], 'title': r[1], 'description': r[2], 'thumbnail': r[3], 'category': r[4], 'isLive': r[5],
+         'viewers': r[6], 'ttsEnabled': r[7], 'ttsVoice': r[8], 'username': r[9], 'avatar': r[10]} for r in rows
+    ]}),
+    'transactions': lambda rows: json.dumps({'transactions': [
+        {'id': str(r[0]), 'type': r[1], 'amount': r[2], 'currency': r[3], 'description': r[4], 'status': r[5],
+         'date': r[6].isoformat() if r[6] else None} for r in rows
+    ], 'nextCursor': None}),
+    'referrals': lambda rows: json.dumps({'referrals': [
+        {'id': str(r[0]), 'referrerId': r[1], 'referredUserId': r[2], 'referredUsername': r[3], 'purchaseAmount': r[4],
+         'rewardEarned': r[5], 'status': r[6], 'createdAt': r[7].isoformat() if r[7] else None} for r in rows
+    ], 'nextCursor': None}),
+}
+
+# Имя модуля, поле ответа, кодировщик в модуле и дополнительные поля ответа
+ENCODED = {
+    'chat': ('chat', 'messages', 'CHAT_MESSAGE_ENCODER', {}),
+    'donations': ('donations', 'donations', 'DONATION_ENCODER', {}),
+    'streams': ('streams', 'streams', 'STREAM_ENCODER', {}),
+    'transactions': ('transactions', 'transactions', 'TRANSACTION_ENCODER', {'nextCursor': None}),
+    'referrals': ('referrals', 'referrals', 'REFERRAL_ENCODER', {'nextCursor': None}),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = sample_rows(args.rows)
+    print(f"{'endpoint':<14}{'legacy us':>12}{'encoder us':>12}{'orjson us':>12}{'speedup':>10}")
+    for endpoint, legacy in LEGACY.items():
+        module_name, field, encoder_name, extra = ENCODED[endpoint]
+        module = load_handler(module_name)
+        encoder_columns = getattr(module, encoder_name).columns
+        fast_json = module.orjson
+
+        variants = {'legacy': lambda: legacy(rows[endpoint])}
+        for label, backend in (('encoder', None), ('orjson', fast_json)):
+            if label == 'orjson' and backend is None:
+                continue
+            module.orjson = backend
+            encoder = module.RowEncoder(*encoder_columns)
+            variants[label] = (lambda enc=encoder, dumps_body=module.dumps_body:
+                               dumps_body({field: enc.encode(rows[endpoint]), **extra}))
+        module.orjson = fast_json
+
+        expected = json.loads(variants['legacy']())
+        for label, run in variants.items():
+            assert json.loads(run()) == expected, f'{endpoint}: {label} output differs'
+
+        timings = {label: timeit.timeit(run, number=args.iterations) / args.iterations * 1e6 for label, run in variants.items()}
+        best = min(timings['encoder'], timings.get('orjson', timings['encoder']))
+        orjson_cell = f"{timings['orjson']:>12.1f}" if 'orjson' in timings else f"{'-':>12}"
+        print(f"{endpoint:<14}{timings['legacy']:>12.1f}{timings['encoder']:>12.1f}{orjson_cell}{timings['legacy'] / best:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+'''
+Обслуживание секционированного chat_messages (запускать по расписанию,
+например раз в час):
+
+1. создаёт суточные секции на --days-ahead дней вперёд;
+2. переносит чат стримов, завершённых больше --grace-hours назад, в
+   chat_archive_chunks (сжатые пачки, формат — encode_chat_chunk из
+   backend/chat) и удаляет его из живых секций;
+3. секции старше --retention-days сначала архивирует, затем отсоединяет
+   (DETACH PARTITION), а с --drop и удаляет.
+
+    DATABASE_URL=postgresql://localhost/strim python tools/chat_retention.py --retention-days 30
+    DATABASE_URL=postgresql://localhost/strim python tools/chat_retention.py --retention-days 30 --drop
+'''
+import argparse
+import importlib.util
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, List, Optional, Tuple
+
+import psycopg2
+
+SCHEMA = 't_p37705306_strim_boom_project'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_PATH = os.path.join(ROOT, 'backend', 'chat', 'index.py')
+
+INSERT_CHUNK = f"""
+    INSERT INTO {SCHEMA}.chat_archive_chunks
+        (stream_id, first_id, last_id, message_count, first_at, last_at, payload)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (stream_id, first_id) DO NOTHING
+"""
+
+# Секции chat_messages с верхней границей диапазона; DEFAULT не попадает
+PARTITIONS = f"""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = '{SCHEMA}.chat_messages'::regclass
+    ORDER BY c.relname
+"""
+
+
+def load_chat() -> Any:
+    spec = importlib.util.spec_from_file_location('retention_chat', CHAT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def archive_rows(conn: Any, chat: Any, query: str, params: Tuple) -> Tuple[int, int]:
+    '''
+    Пишет строки (stream_id, id, username, message, created_at), упорядоченные
+    по stream_id, id, в архив пачками не больше CHAT_ARCHIVE_CHUNK_SIZE
+    '''
+    reader = conn.cursor(name='chat_archive_reader')
+    reader.itersize = 10000
+    reader.execute(query, params)
+    writer = conn.cursor()
+    chunks = messages = 0
+    chunk: List[Tuple] = []
+    stream_id = None
+
+    def flush() -> None:
+        nonlocal chunks, messages
+        times = [row[3] for row in chunk]
+        writer.execute(INSERT_CHUNK, (stream_id, chunk[0][0], chunk[-1][0], len(chunk), min(times), max(times),
+                                      psycopg2.Binary(chat.encode_chat_chunk(chunk))))
+        chunks += 1
+        messages += len(chunk)
+        chunk.clear()
+
+    for row in reader:
+        if chunk and (row[0] != stream_id or len(chunk) >= chat.CHAT_ARCHIVE_CHUNK_SIZE):
+            flush()
+        stream_id = row[0]
+        chunk.append(row[1:])
+    if chunk:
+        flush()
+    reader.close()
+    writer.close()
+    return chunks, messages
+
+
+def archive_ended_streams(conn: Any, chat: Any, grace_hours: float) -> Tuple[int, int]:
+    '''Чат каждого завершённого стрима архивируется и удаляется в своей транзакции'''
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT id FROM {SCHEMA}.streams
+        WHERE ended_at < CURRENT_TIMESTAMP - make_interval(hours => %s) AND chat_archived_at IS NULL
+        ORDER BY ended_at
+    """, (grace_hours,))
+    stream_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    total = 0
+    for stream_id in stream_ids:
+        cur.execute(f'SELECT MAX(id) FROM {SCHEMA}.chat_messages WHERE stream_id = %s', (stream_id,))
+        last_id = cur.fetchone()[0]
+        if last_id is not None:
+            _, messages = archive_rows(conn, chat, f"""
+                SELECT stream_id, id, username, message, created_at
+                FROM {SCHEMA}.chat_messages
+                WHERE stream_id = %s AND id <= %s
+                ORDER BY stream_id, id
+            """, (stream_id, last_id))
+            # Сообщения, пришедшие после чтения, остаются в живых секциях и видны в истории
+            cur.execute(f'DELETE FROM {SCHEMA}.chat_messages WHERE stream_id = %s AND id <= %s', (stream_id, last_id))
+            total += messages
+        cur.execute(f'UPDATE {SCHEMA}.streams SET chat_archived_at = CURRENT_TIMESTAMP WHERE id = %s', (stream_id,))
+        conn.commit()
+    cur.close()
+    return len(stream_ids), total
+
+
+def partition_upper_bound(bound: str) -> Optional[date]:
+    '''Верхняя граница из FOR VALUES FROM (...) TO ('...'); None для DEFAULT'''
+    match = re.search(r"TO \('([^']+)'\)", bound)
+    return datetime.fromisoformat(match.group(1)).date() if match else None
+
+
+def expire_partitions(conn: Any, chat: Any, retention_days: int, drop: bool) -> List[Tuple[str, int]]:
+    '''Архивирует и отсоединяет секции, целиком лежащие старше срока хранения'''
+    cur = conn.cursor()
+    cur.execute(PARTITIONS)
+    cutoff = date.today() - timedelta(days=retention_days)
+    expired = [name for name, bound in cur.fetchall()
+               if (upper := partition_upper_bound(bound)) is not None and upper <= cutoff]
+    conn.commit()
+    done = []
+    for name in expired:
+        _, messages = archive_rows(conn, chat, f"""
+            SELECT stream_id, id, username, message, created_at
+            FROM {SCHEMA}.{name}
+            WHERE stream_id IS NOT NULL
+            ORDER BY stream_id, id
+        """, ())
+        cur.execute(f'ALTER TABLE {SCHEMA}.chat_messages DETACH PARTITION {SCHEMA}.{name}')
+        if drop:
+            cur.execute(f'DROP TABLE {SCHEMA}.{name}')
+        conn.commit()
+        done.append((name, messages))
+    cur.close()
+    return done
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days-ahead', type=int, default=7, help='сколько суточных секций создать вперёд')
+    parser.add_argument('--grace-hours', type=float, default=1, help='через сколько часов после ended_at архивировать чат')
+    parser.add_argument('--retention-days', type=int, default=30, help='сколько дней держать живые секции')
+    parser.add_argument('--drop', action='store_true', help='удалять отсоединённые секции')
+    args = parser.parse_args()
+
+    chat = load_chat()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+
+    started = time.perf_counter()
+    cur.execute(f'SELECT {SCHEMA}.create_chat_partitions(%s)', (args.days_ahead,))
+    print(f'{cur.fetchone()[0]} partitions created')
+    conn.commit()
+
+    streams, messages = archive_ended_streams(conn, chat, args.grace_hours)
+    print(f'{streams} ended streams archived, {messages} messages')
+
+    for name, count in expire_partitions(conn, chat, args.retention_days, args.drop):
+        print(f'{name}: {count} messages archived, partition {"dropped" if args.drop else "detached"}')
+
+    conn.close()
+    print(f'done in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''
+Генератор нагрузки для tools/local_server.py. Проигрывает сценарии из
+backend/*/tests.json (или записанный журнал событий) с заданным RPS и
+печатает p50/p95/p99 задержки по каждой функции.
+
+    python tools/load_test.py --rps 200 --duration 30
+    python tools/load_test.py --events events.jsonl --rps 500 --functions chat,streams
+'''
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+
+
+def load_test_scenarios(functions: Optional[List[str]]) -> List[Dict[str, Any]]:
+    '''Собирает запросы из tests.json каждой функции'''
+    scenarios = []
+    for name in sorted(os.listdir(BACKEND)):
+        tests_path = os.path.join(BACKEND, name, 'tests.json')
+        if not os.path.isfile(tests_path) or (functions and name not in functions):
+            continue
+        with open(tests_path) as f:
+            for test in json.load(f).get('tests', []):
+                body = test.get('body')
+                scenarios.append({
+                    'function': name,
+                    'method': test.get('method', 'GET'),
+                    'path': f"/{name}{test.get('path', '/')}",
+                    'headers': test.get('headers', {}),
+                    'body': json.dumps(body) if body is not None else ''
+                })
+    return scenarios
+
+
+def load_recorded_events(path: str, functions: Optional[List[str]]) -> List[Dict[str, Any]]:
+    '''Читает журнал, записанный local_server.py --record'''
+    scenarios = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            name = record['function']
+            if functions and name not in functions:
+                continue
+            event = record['event']
+            query = urlencode(event.get('queryStringParameters') or {})
+            scenarios.append({
+                'function': name,
+                'method': event.get('httpMethod', 'GET'),
+                'path': f"/{name}{event.get('path') or '/'}" + (f'?{query}' if query else ''),
+                'headers': event.get('headers') or {},
+                'body': event.get('body') or ''
+            })
+    return scenarios
+
+
+async def send(host: str, port: int, scenario: Dict[str, Any], timeout: float) -> int:
+    '''Один HTTP/1.1 запрос на отдельном соединении, возвращает код ответа'''
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        payload = scenario['body'].encode('utf-8')
+        lines = [f"{scenario['method']} {scenario['path']} HTTP/1.1", f'Host: {host}', 'Connection: close',
+                 f'Content-Length: {len(payload)}']
+        skip = {'host', 'connection', 'content-length'}
+        lines += [f'{k}: {v}' for k, v in scenario['headers'].items() if k.lower() not in skip]
+        if payload:
+            lines.append('Content-Type: application/json')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(args: argparse.Namespace, scenarios: List[Dict[str, Any]]) -> None:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    statuses: Dict[str, Counter] = defaultdict(Counter)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = []
+
+    async def fire(scenario: Dict[str, Any], scheduled: float) -> None:
+        # Задержка считается от запланированного момента отправки: ожидание семафора
+        # и опоздание цикла входят в неё, иначе перегрузка прячется (coordinated omission)
+        async with semaphore:
+            try:
+                status = await send(args.host, args.port, scenario, args.timeout)
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                status = 0
+            latencies[scenario['function']].append((time.perf_counter() - scheduled) * 1000)
+            statuses[scenario['function']][status] += 1
+
+    # Открытый цикл: запросы уходят по расписанию независимо от задержки ответов
+    total = int(args.rps * args.duration)
+    start = time.perf_counter()
+    for i in range(total):
+        scheduled = start + i / args.rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(fire(scenarios[i % len(scenarios)], scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    print(f'{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} rps achieved, {args.rps} target)')
+    print(f"{'function':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  statuses")
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        codes = ' '.join(f'{code}:{n}' for code, n in sorted(statuses[name].items()))
+        print(f'{name:<14}{len(values):>8}{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}'
+              f'{percentile(values, 99):>10.1f}{values[-1]:>10.1f}  {codes}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rps', type=float, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='секунд')
+    parser.add_argument('--concurrency', type=int, default=256, help='максимум запросов в полёте')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--events', help='JSONL-журнал от local_server.py --record вместо tests.json')
+    parser.add_argument('--functions', help='список функций через запятую')
+    args = parser.parse_args()
+
+    functions = args.functions.split(',') if args.functions else None
+    scenarios = load_recorded_events(args.events, functions) if args.events else load_test_scenarios(functions)
+    if not scenarios:
+        parser.error('no scenarios to replay')
+    asyncio.run(run(args, scenarios))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+'''
+Локальный сервер, который поднимает все облачные функции из backend/
+в одном процессе: функция доступна по пути /<имя из func2url.json>/.
+
+Запуск против локального Postgres с применёнными db_migrations:
+    DATABASE_URL=postgresql://localhost/strim python tools/local_server.py --port 8080
+
+Флаг --record пишет каждое событие в JSONL-файл для tools/load_test.py --events.
+'''
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+def load_handlers() -> Dict[str, Callable[[Dict[str, Any], Any], Dict[str, Any]]]:
+    '''Импортирует handler() каждой функции из func2url.json'''
+    with open(os.path.join(BACKEND, 'func2url.json')) as f:
+        names = sorted(json.load(f))
+    handlers = {}
+    for name in names:
+        path = os.path.join(BACKEND, name, 'index.py')
+        spec = importlib.util.spec_from_file_location(f"backend_{name.replace('-', '_')}", path)
+        module = importlib.util.module_from_spec(spec)
+        # Нужно для pickle: upload-image передаёт функции в пул процессов
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        handlers[name] = module.handler
+    return handlers
+
+
+class FunctionContext:
+    '''Минимальный аналог context облачной функции'''
+
+    def __init__(self, function_name: str) -> None:
+        self.function_name = function_name
+        self.request_id = f'{function_name}-{time.time_ns()}'
+
+
+def build_event(method: str, target: str, headers: Dict[str, str], body: bytes, source_ip: str) -> Tuple[str, Dict[str, Any]]:
+    '''Превращает HTTP-запрос в event в формате шлюза'''
+    parts = urlsplit(target)
+    segments = [s for s in parts.path.split('/') if s]
+    function_name = segments[0] if segments else ''
+    # Бинарное тело (изображения, multipart) шлюз передаёт в base64
+    try:
+        text, is_base64 = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text, is_base64 = base64.b64encode(body).decode('ascii'), True
+    event = {
+        'httpMethod': method,
+        'path': '/' + '/'.join(segments[1:]),
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+        'body': text,
+        'isBase64Encoded': is_base64,
+        'requestContext': {'requestTime': time.time(), 'identity': {'sourceIp': source_ip}}
+    }
+    return function_name, event
+
+
+class LocalServer:
+    def __init__(self, handlers: Dict[str, Callable], workers: int, record_path: Optional[str]) -> None:
+        self.handlers = handlers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.record_file = open(record_path, 'a') if record_path else None
+        self.record_lock = threading.Lock()
+
+    def invoke(self, function_name: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        if self.record_file is not None:
+            with self.record_lock:
+                self.record_file.write(json.dumps({'function': function_name, 'event': event}, ensure_ascii=False) + '\n')
+                self.record_file.flush()
+        return self.handlers[function_name](event, FunctionContext(function_name))
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip()] = value.strip()
+                lower = {k.lower(): v for k, v in headers.items()}
+                length = int(lower.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                function_name, event = build_event(method, target, headers, body, peer[0] if peer else '')
+                if function_name not in self.handlers:
+                    response = {'statusCode': 404, 'headers': {'Content-Type': 'application/json'},
+                                'body': json.dumps({'error': f'Unknown function {function_name}'})}
+                else:
+                    response = await loop.run_in_executor(self.executor, self.invoke, function_name, event)
+
+                keep_alive = lower.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(encode_response(response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def encode_response(response: Dict[str, Any], keep_alive: bool) -> bytes:
+    '''Собирает HTTP-ответ из результата handler()'''
+    status = response.get('statusCode', 200)
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        payload = base64.b64decode(body)
+    else:
+        payload = body.encode('utf-8') if isinstance(body, str) else body
+    lines = [f'HTTP/1.1 {status} {REASONS.get(status, "Status")}']
+    for key, value in (response.get('headers') or {}).items():
+        lines.append(f'{key}: {value}')
+    lines.append(f'Content-Length: {len(payload)}')
+    lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload
+
+
+async def serve(args: argparse.Namespace) -> None:
+    handlers = load_handlers()
+    server = LocalServer(handlers, args.workers, args.record)
+    tcp = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f'Serving {", ".join(handlers)} on http://{args.host}:{args.port}/<function>/', file=sys.stderr)
+    async with tcp:
+        await tcp.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=32, help='потоков для синхронных handler()')
+    parser.add_argument('--record', help='дописывать события в JSONL-файл')
+    args = parser.parse_args()
+    if not os.environ.get('DATABASE_URL'):
+        parser.error('DATABASE_URL is not set')
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
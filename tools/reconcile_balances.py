@@ -0,0 +1,147 @@
+'''
+Сверка users.boombucks с журналом balance_ledger. Баланс по журналу — это
+последний снимок из balance_snapshots плюс записи журнала после него, поэтому
+проверка читает только записи с момента последнего снимка. Пользователи
+делятся на диапазоны id, каждый диапазон проверяется отдельным соединением.
+
+    DATABASE_URL=postgresql://localhost/strim python tools/reconcile_balances.py --workers 8
+    DATABASE_URL=postgresql://localhost/strim python tools/reconcile_balances.py --snapshot
+    DATABASE_URL=postgresql://localhost/strim python tools/reconcile_balances.py --user-id 42 --rebuild
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+SCHEMA = 't_p37705306_strim_boom_project'
+
+# Баланс по журналу для пользователей из диапазона id
+LEDGER_BALANCES = f"""
+    SELECT u.id, COALESCE(u.boombucks, 0), COALESCE(s.balance, 0) + COALESCE(l.delta, 0), l.entries
+    FROM {SCHEMA}.users u
+    LEFT JOIN LATERAL (
+        SELECT ledger_id, balance
+        FROM {SCHEMA}.balance_snapshots
+        WHERE user_id = u.id
+        ORDER BY ledger_id DESC
+        LIMIT 1
+    ) s ON TRUE
+    CROSS JOIN LATERAL (
+        SELECT SUM(delta) AS delta, COUNT(*) AS entries
+        FROM {SCHEMA}.balance_ledger
+        WHERE user_id = u.id AND id > COALESCE(s.ledger_id, 0)
+    ) l
+    WHERE u.id BETWEEN %s AND %s
+"""
+
+# Новый снимок для пользователей с записями после прошлого снимка. Записи моложе
+# lag секунд не входят: их транзакции могли ещё не зафиксироваться, а меньший id
+# из последовательности, зафиксированный позже снимка, выпал бы из сверки навсегда
+TAKE_SNAPSHOTS = f"""
+    INSERT INTO {SCHEMA}.balance_snapshots (user_id, ledger_id, balance)
+    SELECT u.id, l.last_id, COALESCE(s.balance, 0) + l.delta
+    FROM {SCHEMA}.users u
+    LEFT JOIN LATERAL (
+        SELECT ledger_id, balance
+        FROM {SCHEMA}.balance_snapshots
+        WHERE user_id = u.id
+        ORDER BY ledger_id DESC
+        LIMIT 1
+    ) s ON TRUE
+    CROSS JOIN LATERAL (
+        SELECT MAX(id) AS last_id, SUM(delta) AS delta
+        FROM {SCHEMA}.balance_ledger
+        WHERE user_id = u.id AND id > COALESCE(s.ledger_id, 0)
+          AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    ) l
+    WHERE u.id BETWEEN %s AND %s AND l.last_id IS NOT NULL
+    ON CONFLICT (user_id, ledger_id) DO NOTHING
+"""
+
+
+def id_ranges(cur: Any, chunks: int, user_id: int) -> List[Tuple[int, int]]:
+    if user_id:
+        return [(user_id, user_id)]
+    cur.execute(f'SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), -1) FROM {SCHEMA}.users')
+    low, high = cur.fetchone()
+    step = max(1, (high - low + chunks) // chunks)
+    return [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+
+def check_range(dsn: str, bounds: Tuple[int, int], rebuild: bool) -> Tuple[int, int, List[Tuple[int, int, int]]]:
+    '''Сверяет диапазон в одном снимке REPEATABLE READ: баланс и журнал меняются в одной транзакции'''
+    conn = psycopg2.connect(dsn)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    try:
+        cur = conn.cursor()
+        cur.execute(LEDGER_BALANCES, bounds)
+        rows = cur.fetchall()
+        mismatches = [(user_id, stored, expected) for user_id, stored, expected, _ in rows if stored != expected]
+        conn.rollback()
+        if rebuild and mismatches:
+            # Баланс пересчитывается под блокировкой строки пользователя, чтобы не затереть параллельный донат
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+            for user_id, _, _ in mismatches:
+                cur.execute(f'SELECT 1 FROM {SCHEMA}.users WHERE id = %s FOR UPDATE', (user_id,))
+                cur.execute(LEDGER_BALANCES, (user_id, user_id))
+                _, _, expected, _ = cur.fetchone()
+                cur.execute(f'UPDATE {SCHEMA}.users SET boombucks = %s WHERE id = %s', (expected, user_id))
+                conn.commit()
+        return len(rows), sum(row[3] for row in rows), mismatches
+    finally:
+        conn.close()
+
+
+def snapshot_range(dsn: str, bounds: Tuple[int, int], lag: float) -> int:
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(TAKE_SNAPSHOTS, (lag, *bounds))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='параллельных соединений')
+    parser.add_argument('--chunks', type=int, default=64, help='на сколько диапазонов id делить пользователей')
+    parser.add_argument('--user-id', type=int, default=0, help='проверить одного пользователя')
+    parser.add_argument('--snapshot', action='store_true', help='записать новые снимки вместо сверки')
+    parser.add_argument('--lag', type=float, default=60, help='возраст записей журнала для снимка, секунд')
+    parser.add_argument('--rebuild', action='store_true', help='исправить users.boombucks по журналу')
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    conn = psycopg2.connect(dsn)
+    ranges = id_ranges(conn.cursor(), args.chunks, args.user_id)
+    conn.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        if args.snapshot:
+            written = sum(pool.map(lambda bounds: snapshot_range(dsn, bounds, args.lag), ranges))
+            print(f'{written} snapshots written in {time.perf_counter() - started:.1f}s')
+            return
+        results = list(pool.map(lambda bounds: check_range(dsn, bounds, args.rebuild), ranges))
+
+    users = sum(result[0] for result in results)
+    entries = sum(result[1] for result in results)
+    mismatches = [mismatch for result in results for mismatch in result[2]]
+    print(f'{users} users, {entries} ledger entries since snapshots, {time.perf_counter() - started:.1f}s')
+    for user_id, stored, expected in mismatches[:50]:
+        print(f'user {user_id}: boombucks {stored}, ledger {expected}')
+    if mismatches:
+        print(f'{len(mismatches)} mismatches' + (' rebuilt' if args.rebuild else ''))
+        if not args.rebuild:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+'''
+Заливает в локальный Postgres синтетические данные продового масштаба через COPY.
+Популярность стримов и активность пользователей распределены по Ципфу:
+несколько стримов собирают основную часть чата и донатов.
+
+    DATABASE_URL=postgresql://localhost/strim python tools/seed_data.py \\
+        --users 500000 --streams 20000 --chat-messages 30000000 \\
+        --donations 3000000 --transactions 5000000 --referrals 200000
+'''
+import argparse
+import io
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterator, List
+
+import psycopg2
+
+SCHEMA = 't_p37705306_strim_boom_project'
+BATCH = 50000
+WORDS = ('gg', 'lol', 'привет', 'топ', 'стрим', 'донат', 'wow', 'ахах', 'го', 'круто', 'бан', 'клип', 'ez', 'pog')
+CATEGORIES = ('Игры', 'Музыка', 'IRL', 'Творчество', 'Спорт', 'Образование', 'Другое')
+
+
+class RowStream(io.TextIOBase):
+    '''Файлоподобный поток строк для copy_expert: данные генерируются на лету'''
+
+    def __init__(self, rows: Iterator[str]) -> None:
+        self.rows = rows
+        self.buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            chunk = ''.join(itertools.islice(self.rows, 1000))
+            if not chunk:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    readline = read
+
+
+def zipf_weights(n: int, s: float) -> List[float]:
+    '''Накопленные веса для random.choices с распределением Ципфа'''
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def skewed(ids: List[int], cum_weights: List[float], count: int) -> Iterator[int]:
+    for start in range(0, count, BATCH):
+        yield from random.choices(ids, cum_weights=cum_weights, k=min(BATCH, count - start))
+
+
+def clean(text: str) -> str:
+    return text.replace('\t', ' ').replace('\n', ' ').replace('\\', '')
+
+
+def random_time(now: datetime, days: int) -> str:
+    return (now - timedelta(seconds=random.randint(0, days * 86400))).isoformat(sep=' ')
+
+
+def random_time_since(start: datetime, now: datetime) -> str:
+    return (start + (now - start) * random.random()).isoformat(sep=' ')
+
+
+def copy_rows(cur: Any, table: str, columns: str, rows: Iterator[str]) -> None:
+    cur.copy_expert(f'COPY {SCHEMA}.{table} ({columns}) FROM STDIN', RowStream(rows))
+
+
+def next_id(cur: Any, table: str) -> int:
+    cur.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {SCHEMA}.{table}')
+    return cur.fetchone()[0]
+
+
+def sync_sequence(cur: Any, table: str) -> None:
+    cur.execute(f"SELECT setval(pg_get_serial_sequence('{SCHEMA}.{table}', 'id'), (SELECT MAX(id) FROM {SCHEMA}.{table}))")
+
+
+def refresh_donation_aggregates(cur: Any) -> None:
+    '''Пересобирает сводки донатов после заливки в обход обработчика'''
+    cur.execute(f'TRUNCATE {SCHEMA}.stream_donation_stats, {SCHEMA}.stream_donor_totals')
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.stream_donor_totals (stream_id, from_user_id, total_amount)
+        SELECT stream_id, from_user_id, SUM(amount)
+        FROM {SCHEMA}.donations
+        WHERE stream_id IS NOT NULL AND from_user_id IS NOT NULL
+        GROUP BY stream_id, from_user_id
+    """)
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.stream_donation_stats (stream_id, total_amount, donations_count, top_donors)
+        SELECT d.stream_id, SUM(d.amount), COUNT(*),
+               COALESCE((
+                   SELECT jsonb_agg(jsonb_build_object('userId', t.from_user_id, 'amount', t.total_amount) ORDER BY t.total_amount DESC)
+                   FROM (
+                       SELECT from_user_id, total_amount
+                       FROM {SCHEMA}.stream_donor_totals
+                       WHERE stream_id = d.stream_id
+                       ORDER BY total_amount DESC
+                       LIMIT 10
+                   ) t
+               ), '[]'::jsonb)
+        FROM {SCHEMA}.donations d
+        WHERE d.stream_id IS NOT NULL
+        GROUP BY d.stream_id
+    """)
+
+
+def refresh_referral_stats(cur: Any) -> None:
+    '''Пересобирает сводку рефералов после заливки в обход обработчика'''
+    cur.execute(f'TRUNCATE {SCHEMA}.referral_stats')
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.referral_stats (referrer_id, referred_count, purchase_total, reward_total, pending_count)
+        SELECT referrer_id, COUNT(*), SUM(purchase_amount), SUM(reward_earned), COUNT(*) FILTER (WHERE status = 'pending')
+        FROM {SCHEMA}.referrals
+        GROUP BY referrer_id
+    """)
+
+
+def open_balance_ledger(cur: Any) -> None:
+    '''Начальные балансы залитых пользователей становятся записями журнала и снимком'''
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.balance_ledger (user_id, delta, reason)
+        SELECT u.id, u.boombucks, 'opening'
+        FROM {SCHEMA}.users u
+        WHERE u.boombucks <> 0
+          AND NOT EXISTS (SELECT 1 FROM {SCHEMA}.balance_ledger l WHERE l.user_id = u.id)
+    """)
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.balance_snapshots (user_id, ledger_id, balance)
+        SELECT user_id, id, delta FROM {SCHEMA}.balance_ledger WHERE reason = 'opening'
+        ON CONFLICT (user_id, ledger_id) DO NOTHING
+    """)
+
+
+def timed(label: str, count: int, action: Callable[[], None]) -> None:
+    started = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - started
+    print(f'{label:<16}{count:>12} rows  {elapsed:>8.1f}s  {count / max(elapsed, 1e-9):>12.0f} rows/s')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--streams', type=int, default=5000)
+    parser.add_argument('--chat-messages', type=int, default=10000000)
+    parser.add_argument('--donations', type=int, default=1000000)
+    parser.add_argument('--transactions', type=int, default=2000000)
+    parser.add_argument('--referrals', type=int, default=100000)
+    parser.add_argument('--live-share', type=float, default=0.2, help='доля стримов в эфире')
+    parser.add_argument('--skew', type=float, default=1.1, help='показатель распределения Ципфа')
+    parser.add_argument('--days', type=int, default=90, help='глубина истории')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    now = datetime.now()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+
+    first_user = next_id(cur, 'users')
+    user_ids = list(range(first_user, first_user + args.users))
+    timed('users', args.users, lambda: copy_rows(cur, 'users', 'id, username, email, password_hash, avatar, boombucks, referral_code', (
+        f'{uid}\tseed_user_{uid}\tseed_user_{uid}@seed.local\tseed\t'
+        f'https://api.dicebear.com/7.x/avataaars/svg?seed={uid}\t{random.randint(0, 5000)}\tSEED{uid:08d}\n'
+        for uid in user_ids
+    )))
+    sync_sequence(cur, 'users')
+    timed('balance_ledger', args.users, lambda: open_balance_ledger(cur))
+
+    first_stream = next_id(cur, 'streams')
+    stream_ids = list(range(first_stream, first_stream + args.streams))
+    streamer_ids = random.sample(user_ids, min(args.streams, len(user_ids)))
+    # Чат стрима пишется после его начала — на этом держится отсечение секций chat_messages
+    started = {sid: datetime.fromisoformat(random_time(now, args.days)) for sid in stream_ids}
+    timed('streams', args.streams, lambda: copy_rows(
+        cur, 'streams', 'id, user_id, title, description, category, is_live, viewers_count, stream_key, started_at', (
+            f'{sid}\t{streamer_ids[i % len(streamer_ids)]}\tSeed stream {sid}\t{clean(" ".join(random.choices(WORDS, k=12)))}\t'
+            f'{random.choice(CATEGORIES)}\t{"t" if random.random() < args.live_share else "f"}\t'
+            f'{int(50000 / (i + 1) ** args.skew)}\tseed_{sid}\t{started[sid].isoformat(sep=" ")}\n'
+            for i, sid in enumerate(stream_ids)
+        )))
+    sync_sequence(cur, 'streams')
+
+    stream_weights = zipf_weights(len(stream_ids), args.skew)
+    user_weights = zipf_weights(len(user_ids), args.skew)
+
+    timed('chat_messages', args.chat_messages, lambda: copy_rows(
+        cur, 'chat_messages', 'stream_id, user_id, username, message, created_at', (
+            f'{sid}\t{uid}\tseed_user_{uid}\t{" ".join(random.choices(WORDS, k=random.randint(1, 8)))}\t{random_time_since(started[sid], now)}\n'
+            for sid, uid in zip(skewed(stream_ids, stream_weights, args.chat_messages),
+                                skewed(user_ids, user_weights, args.chat_messages))
+        )))
+
+    timed('donations', args.donations, lambda: copy_rows(
+        cur, 'donations', 'stream_id, from_user_id, amount, message, created_at', (
+            f'{sid}\t{uid}\t{int(random.paretovariate(1.5)) * 10}\t{random.choice(WORDS)}\t{random_time(now, args.days)}\n'
+            for sid, uid in zip(skewed(stream_ids, stream_weights, args.donations),
+                                skewed(user_ids, user_weights, args.donations))
+        )))
+
+    types = ('buy', 'donation', 'referral_reward', 'withdraw')
+    timed('transactions', args.transactions, lambda: copy_rows(
+        cur, 'transactions', 'user_id, type, amount, currency, description, status, created_at', (
+            f'{uid}\t{random.choice(types)}\t{random.randint(1, 1000)}\tRUB\tSeed transaction\tcompleted\t{random_time(now, args.days)}\n'
+            for uid in skewed(user_ids, user_weights, args.transactions)
+        )))
+
+    def referral_rows() -> Iterator[str]:
+        seen = set()
+        for referrer in skewed(user_ids, user_weights, args.referrals * 2):
+            referred = random.choice(user_ids)
+            if referrer == referred or (referrer, referred) in seen:
+                continue
+            seen.add((referrer, referred))
+            purchase = random.randint(0, 6)
+            rewarded = purchase >= 3
+            yield (f'{referrer}\t{referred}\t{purchase}\t{1 if rewarded else 0}\t'
+                   f'{"rewarded" if rewarded else "pending"}\t{random_time(now, args.days)}\n')
+            if len(seen) >= args.referrals:
+                break
+
+    timed('referrals', args.referrals, lambda: copy_rows(
+        cur, 'referrals', 'referrer_id, referred_user_id, purchase_amount, reward_earned, status, created_at', referral_rows()))
+
+    timed('aggregates', args.donations, lambda: refresh_donation_aggregates(cur))
+    timed('referral_stats', args.referrals, lambda: refresh_referral_stats(cur))
+
+    conn.commit()
+    cur.execute('ANALYZE')
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()